@@ -1,6 +1,5 @@
 import getopt
 import re
-from builds.build_query import BuildQuery
 import logger
 import ConfigParser
 import os
@@ -358,6 +357,8 @@ class TestInputParser():
             # let's extract version from this url
             pass
         if option == "-v":
+            # BuildQuery pulls in BeautifulSoup, only import it when needed
+            from builds.build_query import BuildQuery
             allbuilds = BuildQuery().get_all_builds()
             for build in allbuilds:
                 if build.product_version == argument:
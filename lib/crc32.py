@@ -4,6 +4,8 @@
 # * src/usr.bin/cksum/crc32.c.
 # */
 
+import zlib
+
 
 crc32tab = [
   0x00000000, 0x77073096, 0xee0e612c, 0x990951ba,
@@ -72,8 +74,32 @@ crc32tab = [
   0xb40bbe37, 0xc30c8ea1, 0x5a05df1b, 0x2d02ef8d]
 
 
-def crc32_hash(key):
+def crc32_hash_py(key):
     crc = pow(2,32) - 1
     for ch in key:
         crc = (crc >> 8) ^ crc32tab[int((crc ^ ord(ch)) & 0xff)]
-    return ((~crc) >> 16) & 0x7fff
\ No newline at end of file
+    return ((~crc) >> 16) & 0x7fff
+
+
+# zlib.crc32 computes the same standard CRC-32 in C, and bits 16-30 of
+# its result are exactly what crc32_hash_py() returns.  Only keys that
+# zlib can't take as bytes (non-ascii unicode) fall back to the table.
+def crc32_hash(key):
+    try:
+        return (zlib.crc32(key) >> 16) & 0x7fff
+    except (UnicodeError, TypeError):
+        return crc32_hash_py(key)
+
+
+def vbucket_id(key, num_vbuckets):
+    return crc32_hash(key) & (num_vbuckets - 1)
+
+
+# Maps a whole list of keys to their vbucket ids in one call.
+def crc32_hash_many(keys, num_vbuckets):
+    mask = 0x7fff & (num_vbuckets - 1)
+    crc = zlib.crc32
+    try:
+        return [(crc(key) >> 16) & mask for key in keys]
+    except (UnicodeError, TypeError):
+        return [crc32_hash(key) & mask for key in keys]
\ No newline at end of file
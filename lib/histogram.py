@@ -0,0 +1,140 @@
+"""
+Fixed-size, log-linear latency histogram.
+
+Samples are recorded in microseconds into an array('l') of counters.
+Values below 2**sub_bits get a bucket each; every following power of
+two is split into 2**(sub_bits - 1) equal buckets, so a bucket never
+spans more than about 2**(1 - sub_bits) of its value.  Recording is
+O(1), and histograms with the same precision merge by adding counts,
+which is how per-thread, per-process and per-client results combine.
+"""
+
+import array
+import math
+
+# Values past 2**MAX_BITS usec (about 19 hours) land in the last bucket.
+MAX_BITS = 36
+
+USEC = 1000000.0
+
+
+class Histogram(object):
+    """Latency histogram, with samples given in seconds.
+
+    precision is the number of significant decimal digits kept per
+    sample, like mcsoda's histo-precision."""
+
+    def __init__(self, precision=2):
+        self.precision = precision
+        self.sub_bits = max(1, int(math.ceil(math.log(2 * 10 ** precision, 2))))
+        self.sub_count = 1 << self.sub_bits
+        self.half_count = self.sub_count >> 1
+        self.max_shift = max(0, MAX_BITS - self.sub_bits)
+        self.counts = array.array('l', [0]) * \
+            (self.sub_count + self.max_shift * self.half_count)
+        self.total = 0
+        self.sum = 0.0
+
+    def index(self, usec):
+        if usec < self.sub_count:
+            return max(0, usec)
+        shift = usec.bit_length() - self.sub_bits
+        if shift > self.max_shift:
+            return len(self.counts) - 1
+        return self.sub_count + (shift - 1) * self.half_count + \
+            (usec >> shift) - self.half_count
+
+    def value(self, idx):
+        """Midpoint of bucket idx, in seconds."""
+        if idx < self.sub_count:
+            return idx / USEC
+        shift = (idx - self.sub_count) // self.half_count + 1
+        lo = ((idx - self.sub_count) % self.half_count + self.half_count) << shift
+        return (lo + ((1 << shift) - 1) / 2.0) / USEC
+
+    def record(self, seconds, count=1):
+        self.counts[self.index(int(seconds * USEC))] += count
+        self.total += count
+        self.sum += seconds * count
+
+    def merge(self, other):
+        if other.sub_bits != self.sub_bits:
+            raise ValueError("cannot merge histograms of precision %s and %s" %
+                             (self.precision, other.precision))
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            if count:
+                counts[i] += count
+        self.total += other.total
+        self.sum += other.sum
+        return self
+
+    def reset(self):
+        self.counts = array.array('l', [0]) * len(self.counts)
+        self.total = 0
+        self.sum = 0.0
+
+    def copy(self):
+        rv = Histogram(self.precision)
+        rv.counts = array.array('l', self.counts)
+        rv.total = self.total
+        rv.sum = self.sum
+        return rv
+
+    def mean(self):
+        if not self.total:
+            return 0.0
+        return self.sum / self.total
+
+    # The percentiles must be sorted, ascending, like [0.90, 0.99].
+    # Returns a list of (percentile, seconds) tuples.
+    def percentiles(self, percentiles):
+        rv = []
+        if not self.total:
+            return rv
+        percentiles = list(percentiles)
+        v_cur = 0 # Running total.
+        for idx, count in enumerate(self.counts):
+            if not count:
+                continue
+            v_cur += count
+            while percentiles and v_cur >= percentiles[0] * self.total:
+                rv.append((percentiles.pop(0), self.value(idx)))
+            if not percentiles:
+                break
+        return rv
+
+    def percentile(self, p):
+        rv = self.percentiles([p])
+        if rv:
+            return rv[0][1]
+        return 0.0
+
+    def to_dict(self):
+        """Returns {bucket seconds: count} for the non-empty buckets."""
+        return dict([(self.value(idx), count)
+                     for idx, count in enumerate(self.counts) if count])
+
+    def to_json(self):
+        """Returns a sparse, JSON-friendly form, see from_json()."""
+        return {"precision": self.precision,
+                "total": self.total,
+                "sum": self.sum,
+                "counts": [[idx, count]
+                           for idx, count in enumerate(self.counts) if count]}
+
+    @staticmethod
+    def from_json(obj):
+        rv = Histogram(obj["precision"])
+        for idx, count in obj["counts"]:
+            rv.counts[idx] += count
+        rv.total = obj["total"]
+        rv.sum = obj["sum"]
+        return rv
+
+    def __nonzero__(self):
+        return self.total > 0
+
+    def __repr__(self):
+        return "<Histogram total=%d mean=%f p99=%f>" % \
+            (self.total, self.mean(), self.percentile(0.99))
@@ -0,0 +1,58 @@
+"""
+Import time profiling.
+
+install() wraps __import__ and, at exit, prints for every module that was
+loaded the time spent importing it, both in total and without the modules
+it imported in turn.  Install it before anything else is imported, e.g.
+./testrunner --profile-imports ...
+"""
+
+import __builtin__
+import atexit
+import sys
+import time
+
+# Modules shown in the report.
+TOP = 30
+
+_original_import = __builtin__.__import__
+# [name, time spent in nested imports] of the imports in progress
+_stack = []
+# name -> [total seconds, self seconds]
+_times = {}
+
+
+def _import(name, *args, **kwargs):
+    loaded = len(sys.modules)
+    frame = [name, 0.0]
+    _stack.append(frame)
+    start = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        _stack.pop()
+        if _stack:
+            _stack[-1][1] += elapsed
+        # only imports that loaded something count, the others were
+        # answered from sys.modules
+        if len(sys.modules) > loaded:
+            times = _times.setdefault(name or "(from . import)", [0.0, 0.0])
+            times[0] += elapsed
+            times[1] += elapsed - frame[1]
+
+
+def install():
+    if __builtin__.__import__ is not _import:
+        __builtin__.__import__ = _import
+        atexit.register(report)
+
+
+def report(out=None, top=TOP):
+    out = out or sys.stderr
+    modules = sorted(_times.items(), key=lambda item: item[1][1], reverse=True)
+    total = sum([times[1] for name, times in modules])
+    out.write("import time: {0:.3f} seconds in {1} imports\n".format(total, len(modules)))
+    out.write("{0:>10} {1:>10}  module\n".format("self ms", "total ms"))
+    for name, (cumulative, own) in modules[:top]:
+        out.write("{0:10.1f} {1:10.1f}  {2}\n".format(own * 1000, cumulative * 1000, name))
@@ -7,7 +7,7 @@ from TestInput import TestInputServer
 
 import mc_bin_client
 from membase.api.rest_client import RestConnection
-from memcached.helper.data_helper import VBucketAwareMemcached
+from memcached.helper.data_helper import VBucketAwareMemcached, VBucketMapCache
 
 
 class FakeMemcachedClient(object):
@@ -91,14 +91,15 @@ class LoadThread(threading.Thread):
 #            self.server.sasl_auth_plain(self.bucket_name,self.bucket_password)
 
 
-    def _poxi(self):
+    # max_age=0 fetches the vbucket map again after an error
+    def _poxi(self, max_age=VBucketMapCache.MAX_AGE):
         tServer = TestInputServer()
         tServer.ip = self.server_ip
         tServer.rest_username = "Administrator"
         tServer.rest_password = "password"
         tServer.port = 8091
         rest = RestConnection(tServer)
-        return VBucketAwareMemcached(rest, self.bucket_name)
+        return VBucketAwareMemcached(rest, self.bucket_name, max_age=max_age)
 
     def run(self):
         while True:
@@ -159,7 +160,7 @@ class LoadThread(threading.Thread):
                     self.mutation_index += 1
                 except mc_bin_client.MemcachedError as e:
                     self.poxi.done()
-                    self.poxi = self._poxi()
+                    self.poxi = self._poxi(max_age=0)
                     print "now connected to {0} memcacheds".format(len(self.poxi.memcacheds))
                     if self.backoff < 0:
                         self.backoff = 0
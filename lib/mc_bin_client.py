@@ -7,7 +7,6 @@ Copyright (c) 2007  Dustin Sallings <dustin@spy.net>
 
 import hmac
 import socket
-import select
 import random
 import struct
 import exceptions
@@ -18,6 +17,14 @@ from memcacheConstants import REQ_PKT_FMT, RES_PKT_FMT, MIN_RECV_PACKET
 from memcacheConstants import SET_PKT_FMT, DEL_PKT_FMT, INCRDECR_RES_FMT
 import memcacheConstants
 
+# Default number of requests the *_multi() calls keep in flight.
+MULTI_WINDOW = 1024
+
+# Initial size of the per-connection receive buffer.
+RECV_BUFFER_SIZE = 64 * 1024
+
+RES_HDR = struct.Struct(RES_PKT_FMT)
+
 class MemcachedError(exceptions.Exception):
     """Error raised when a command fails."""
 
@@ -42,7 +49,11 @@ class MemcachedClient(object):
         self.s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.timeout = timeout
         self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Socket timeouts replace a select() before every send and recv.
+        self.s.settimeout(timeout)
         self.s.connect_ex((host, port))
+        self.rbuf = bytearray(RECV_BUFFER_SIZE)
+        self.rstart = self.rend = 0
         self.r=random.Random()
         self.vbucket_count = 1024
 
@@ -56,44 +67,61 @@ class MemcachedClient(object):
         self._sendMsg(cmd, key, val, opaque, extraHeader=extraHeader, cas=cas,
                       vbucketId=self.vbucketId)
 
-    def _sendMsg(self, cmd, key, val, opaque, extraHeader='', cas=0,
-                 dtype=0, vbucketId=0,
-                 fmt=REQ_PKT_FMT, magic=REQ_MAGIC_BYTE):
+    def _encodeMsg(self, cmd, key, val, opaque, extraHeader='', cas=0,
+                   dtype=0, vbucketId=0,
+                   fmt=REQ_PKT_FMT, magic=REQ_MAGIC_BYTE):
         msg=struct.pack(fmt, magic,
             cmd, len(key), len(extraHeader), dtype, vbucketId,
                 len(key) + len(extraHeader) + len(val), opaque, cas)
-        _, w, _ = select.select([], [self.s], [], self.timeout)
-        if w:
-            self.s.send(msg + extraHeader + key + val)
-        else:
+        return msg + extraHeader + key + val
+
+    def _sendMsg(self, cmd, key, val, opaque, extraHeader='', cas=0,
+                 dtype=0, vbucketId=0,
+                 fmt=REQ_PKT_FMT, magic=REQ_MAGIC_BYTE):
+        self._sendRaw(self._encodeMsg(cmd, key, val, opaque, extraHeader, cas,
+                                      dtype, vbucketId, fmt, magic))
+
+    def _sendRaw(self, msg):
+        try:
+            self.s.sendall(msg)
+        except socket.timeout:
             raise exceptions.EOFError("Timeout waiting for socket send. from {0}".format(self.host))
 
-    def _recvMsg(self):
-        response = ""
-        while len(response) < MIN_RECV_PACKET:
-            r, _, _ = select.select([self.s], [], [], self.timeout)
-            if r:
-                data = self.s.recv(MIN_RECV_PACKET - len(response))
-                if data == '':
-                    raise exceptions.EOFError("Got empty data (remote died?). from {0}".format(self.host))
-                response += data
-            else:
+    def _fillBuffer(self, n):
+        """Make sure at least n bytes are buffered after self.rstart."""
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+            if len(self.rbuf) > RECV_BUFFER_SIZE:
+                self.rbuf = bytearray(RECV_BUFFER_SIZE)
+        while self.rend - self.rstart < n:
+            if self.rstart + n > len(self.rbuf):
+                # Move the partial response to the front, growing the
+                # buffer when a single response does not fit.
+                avail = self.rend - self.rstart
+                buf = self.rbuf
+                if n > len(buf):
+                    buf = bytearray(max(n, RECV_BUFFER_SIZE))
+                buf[0:avail] = self.rbuf[self.rstart:self.rend]
+                self.rbuf, self.rstart, self.rend = buf, 0, avail
+            try:
+                got = self.s.recv_into(memoryview(self.rbuf)[self.rend:])
+            except socket.timeout:
                 raise exceptions.EOFError("Timeout waiting for socket recv. from {0}".format(self.host))
-        assert len(response) == MIN_RECV_PACKET
+            if not got:
+                raise exceptions.EOFError("Got empty data (remote died?). from {0}".format(self.host))
+            self.rend += got
+
+    def _recvMsg(self):
+        self._fillBuffer(MIN_RECV_PACKET)
         magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, cas=\
-            struct.unpack(RES_PKT_FMT, response)
+            RES_HDR.unpack_from(self.rbuf, self.rstart)
+        self.rstart += MIN_RECV_PACKET
 
         rv = ""
-        while remaining > 0:
-            r, _, _ = select.select([self.s], [], [], self.timeout)
-            if r:
-                data = self.s.recv(remaining)
-                if data == '':
-                    raise exceptions.EOFError("Got empty data (remote died?). from {0}".format(self.host))
-                rv += data
-                remaining -= len(data)
-            else:
-                raise exceptions.EOFError("Timeout waiting for socket recv. from {0}".format(self.host))
+        if remaining > 0:
+            self._fillBuffer(remaining)
+            rv = str(self.rbuf[self.rstart:self.rstart + remaining])
+            self.rstart += remaining
 
         assert (magic in (RES_MAGIC_BYTE, REQ_MAGIC_BYTE)), "Got magic: %d" % magic
         return cmd, errcode, opaque, cas, keylen, extralen, rv
@@ -150,7 +178,7 @@ class MemcachedClient(object):
 
     def set(self, key, exp, flags, val, vbucket=-1):
         if vbucket == -1:
-            self.vbucketId = crc32.crc32_hash(key) & (self.vbucket_count - 1)
+            self.vbucketId = crc32.vbucket_id(key, self.vbucket_count)
         else:
             self.vbucketId = vbucket
         """Set a value in the memcached server."""
@@ -158,7 +186,7 @@ class MemcachedClient(object):
 
     def send_set(self, key, exp, flags, val):
         """Set a value in the memcached server without handling the response"""
-        self.vbucketId = crc32.crc32_hash(key) & (self.vbucket_count - 1)
+        self.vbucketId = crc32.vbucket_id(key, self.vbucket_count)
         opaque = self.r.randint(0, 2 ** 32)
         self._sendCmd(memcacheConstants.CMD_SET, key, val, opaque, struct.pack(SET_PKT_FMT, flags, exp), 0)
 
@@ -178,7 +206,7 @@ class MemcachedClient(object):
     def get(self, key, vbucket=-1):
         """Get the value for a given key within the memcached server."""
         if vbucket == -1:
-            self.vbucketId = crc32.crc32_hash(key) & (self.vbucket_count - 1)
+            self.vbucketId = crc32.vbucket_id(key, self.vbucket_count)
         else:
             self.vbucketId = vbucket
         parts=self._doCmd(memcacheConstants.CMD_GET, key, '')
@@ -199,7 +227,7 @@ class MemcachedClient(object):
     def getr(self, key, vbucket=-1):
         """Get the value for a given key within the memcached server from a replica vbucket."""
         if vbucket == -1:
-            self.vbucketId = crc32.crc32_hash(key) & (self.vbucket_count - 1)
+            self.vbucketId = crc32.vbucket_id(key, self.vbucket_count)
         else:
             self.vbucketId = vbucket
         parts=self._doCmd(memcacheConstants.CMD_GET_REPLICA, key, '')
@@ -306,24 +334,100 @@ class MemcachedClient(object):
         """Get values for any available keys in the given iterable.
 
         Returns a dict of matched keys to their values."""
-        opaqued=dict(enumerate(keys))
-        terminal=len(opaqued)+10
-        # Send all of the keys in quiet
-        for k,v in opaqued.iteritems():
-            self._sendCmd(memcacheConstants.CMD_GETQ, v, '', k)
+        keys = list(keys)
+        responses = self._doMulti(memcacheConstants.CMD_GETQ, keys,
+                                  window=len(keys), vbucket=self.vbucketId)
+        rv = {}
+        for opaque in sorted(responses.keys()):
+            errcode, cas, extralen, data = responses[opaque]
+            if errcode:
+                raise MemcachedError(errcode, data)
+            rv[keys[opaque]] = self.__parseGet((opaque, cas, data))
+        return rv
 
-        self._sendCmd(memcacheConstants.CMD_NOOP, '', '', terminal)
+    def _doMulti(self, cmd, keys, vals=None, extras=None,
+                 window=MULTI_WINDOW, vbucket=-1):
+        """Pipeline a quiet command for each of the keys.
 
-        # Handle the response
-        rv={}
-        done=False
-        while not done:
-            opaque, cas, data=self._handleSingleResponse(None)
-            if opaque != terminal:
-                rv[opaqued[opaque]]=self.__parseGet((opaque, cas, data))
-            else:
-                done=True
+        Requests go out window at a time, each window followed by a NOOP
+        and written with a single sendall(), and the responses are read
+        back until that NOOP.  The opaque of each request is its index in
+        keys.  Returns a dict of opaque to (errcode, cas, extralen, data)
+        for the requests that got a response."""
+        if vbucket == -1:
+            vbucketIds = crc32.crc32_hash_many(keys, self.vbucket_count)
+        else:
+            vbucketIds = [vbucket] * len(keys)
+        terminal = len(keys)
+        window = max(1, window)
+        rv = {}
+        for start in xrange(0, len(keys), window):
+            end = min(start + window, len(keys))
+            msgs = []
+            for i in xrange(start, end):
+                msgs.append(self._encodeMsg(cmd, keys[i],
+                                            vals and vals[i] or '', i,
+                                            extras and extras[i] or '',
+                                            vbucketId=vbucketIds[i]))
+            msgs.append(self._encodeMsg(memcacheConstants.CMD_NOOP, '', '',
+                                        terminal))
+            self._sendRaw(''.join(msgs))
+
+            while True:
+                rcmd, errcode, opaque, cas, keylen, extralen, data = self._recvMsg()
+                if opaque == terminal:
+                    break
+                rv[opaque] = (errcode, cas, extralen, data)
+        return rv
+
+    def set_multi(self, items, window=MULTI_WINDOW, vbucket=-1):
+        """Set many values with pipelined quiet SETs.
+
+        items is a list of (key, exp, flags, val) tuples.  Returns a dict
+        of key to status, which is 0 on success or the memcached error."""
+        keys = [item[0] for item in items]
+        vals = [item[3] for item in items]
+        extras = [struct.pack(SET_PKT_FMT, item[2], item[1]) for item in items]
+        responses = self._doMulti(memcacheConstants.CMD_SETQ, keys, vals, extras,
+                                  window=window, vbucket=vbucket)
+        rv = dict.fromkeys(keys, 0)
+        for opaque, (errcode, cas, extralen, data) in responses.iteritems():
+            rv[keys[opaque]] = errcode
+        return rv
+
+    def delete_multi(self, keys, window=MULTI_WINDOW, vbucket=-1):
+        """Delete many keys with pipelined quiet DELETEs.
+
+        Returns a dict of key to status, which is 0 on success or the
+        memcached error."""
+        keys = list(keys)
+        responses = self._doMulti(memcacheConstants.CMD_DELETEQ, keys,
+                                  window=window, vbucket=vbucket)
+        rv = dict.fromkeys(keys, 0)
+        for opaque, (errcode, cas, extralen, data) in responses.iteritems():
+            rv[keys[opaque]] = errcode
+        return rv
+
+    def get_multi(self, keys, window=MULTI_WINDOW, vbucket=-1):
+        """Get many keys with pipelined quiet GETs.
 
+        Returns a dict of key to (status, flags, cas, value) for every
+        key, where a miss has status ERR_NOT_FOUND and value None."""
+        keys = list(keys)
+        responses = self._doMulti(memcacheConstants.CMD_GETQ, keys,
+                                  window=window, vbucket=vbucket)
+        rv = {}
+        for i in xrange(len(keys)):
+            response = responses.get(i)
+            if response is None:
+                rv[keys[i]] = (memcacheConstants.ERR_NOT_FOUND, 0, 0, None)
+                continue
+            errcode, cas, extralen, data = response
+            if errcode:
+                rv[keys[i]] = (errcode, 0, cas, data)
+            else:
+                flags = struct.unpack(memcacheConstants.GET_RES_FMT, data[:4])[0]
+                rv[keys[i]] = (0, flags, cas, data[extralen:])
         return rv
 
     def stats(self, sub=''):
@@ -346,7 +450,7 @@ class MemcachedClient(object):
 
     def delete(self, key, cas=0, vbucket=-1):
         if vbucket == -1:
-            self.vbucketId = crc32.crc32_hash(key) & (self.vbucket_count - 1)
+            self.vbucketId = crc32.vbucket_id(key, self.vbucket_count)
         """Delete the value for a given key within the memcached server."""
         return self._doCmd(memcacheConstants.CMD_DELETE, key, '', '', cas)
 
@@ -8,6 +8,7 @@ class MembaseHttpExceptionTypes(object):
     BUCKET_CREATION_ERROR = 1004
     STATS_UNAVAILABLE = 1005
     REMOTE_CLUSTER_JOIN_FAILED = 1006
+    QUERY_VIEW_FAILED = 1007
 
 #base exception class for membase apis
 class MembaseHttpException(Exception):
@@ -54,6 +55,15 @@ class StatsUnavailableException(MembaseHttpException):
         self._message = 'unable to get stats'
 
 
+class QueryViewException(MembaseHttpException):
+    def __init__(self, view_name, reason, status=None):
+        self.parameters = dict()
+        self.parameters['view_name'] = view_name
+        self.parameters['status'] = status
+        self.type = MembaseHttpExceptionTypes.QUERY_VIEW_FAILED
+        self._message = 'error querying view {0} : {1}'.format(view_name, reason)
+
+
 class ServerUnavailableException(MembaseHttpException):
     def __init__(self,ip = ''):
         self.parameters = dict()
@@ -1,12 +1,16 @@
 import base64
+import httplib
 import json
 import urllib
-import httplib2
+import urlparse
 import socket
+import sys
+import threading
 import time
 import logger
 from exception import ServerAlreadyJoinedException, ServerUnavailableException, InvalidArgumentException
-from membase.api.exception import BucketCreationException, ServerJoinException, ClusterRemoteException
+from membase.api.exception import BucketCreationException, ServerJoinException, ClusterRemoteException, \
+    QueryViewException
 
 log = logger.Logger.get_logger()
 #helper library methods built on top of RestConnection interface
@@ -142,6 +146,359 @@ class RestHelper(object):
         return replicated
 
 
+# Requests RestConnection.fan_out() keeps in flight at once; it matches
+# the idle connections a node's pool keeps.
+FAN_OUT_CONCURRENCY = 8
+
+# Methods that may be sent again when a pooled connection turns out to
+# have been closed by the server in the meantime.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# Path segments that are followed by a name chosen by the test, like a
+# design document, a view or a document id.
+NAMED_SEGMENTS = ('_design', '_view', '_spatial', 'docs', 'nodes')
+
+
+class HttpConnectionPool(object):
+    """Persistent HTTP/1.1 connections to one host:port.
+
+    Every RestConnection of the process shares the pool of a node, so the
+    polling loops reuse a handful of keep-alive connections instead of
+    opening one per request. A connection is used by one request at a
+    time. Requests are counted per endpoint, see endpoint_stats()."""
+
+    # Idle connections kept per host:port; the rest are closed.
+    MAX_IDLE = 8
+
+    _lock = threading.Lock()
+    _pools = {}
+    _stats = {}
+
+    @staticmethod
+    def get(host, port):
+        key = (host, port)
+        HttpConnectionPool._lock.acquire()
+        try:
+            pool = HttpConnectionPool._pools.get(key)
+            if pool is None:
+                pool = HttpConnectionPool(host, port)
+                HttpConnectionPool._pools[key] = pool
+            return pool
+        finally:
+            HttpConnectionPool._lock.release()
+
+    #sends a request to an absolute http url and returns (status, content)
+    @staticmethod
+    def request_url(url, method='GET', body=None, headers=None, timeout=120):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        pool = HttpConnectionPool.get(parts.hostname, parts.port or 80)
+        return pool.request(method, path, body, headers or {}, timeout)
+
+    #returns {"METHOD /path": {"count", "errors", "seconds", "max"}}, where
+    #ids, numbers and names in the path are replaced with *
+    @staticmethod
+    def endpoint_stats():
+        HttpConnectionPool._lock.acquire()
+        try:
+            return dict([(endpoint, dict(stats))
+                         for endpoint, stats in HttpConnectionPool._stats.items()])
+        finally:
+            HttpConnectionPool._lock.release()
+
+    #"GET /couchBase/default%2F12/_design/dev_1/_view/v?limit=10" becomes
+    #"GET /couchBase/*/_design/*/_view/*", so the stats stay bounded
+    @staticmethod
+    def _endpoint(method, path):
+        segments = path.split('?')[0].split('/')
+        for i, segment in enumerate(segments):
+            if i > 0 and segments[i - 1] in NAMED_SEGMENTS and segment != 'self':
+                segments[i] = '*'
+            elif '%' in segment or [c for c in segment if c.isdigit()]:
+                segments[i] = '*'
+        return "{0} {1}".format(method, '/'.join(segments))
+
+    @staticmethod
+    def _record(method, path, seconds, error):
+        endpoint = HttpConnectionPool._endpoint(method, path)
+        HttpConnectionPool._lock.acquire()
+        try:
+            stats = HttpConnectionPool._stats.get(endpoint)
+            if stats is None:
+                stats = {"count": 0, "errors": 0, "seconds": 0.0, "max": 0.0}
+                HttpConnectionPool._stats[endpoint] = stats
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            if error:
+                stats["errors"] += 1
+        finally:
+            HttpConnectionPool._lock.release()
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _lease(self, timeout):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                conn = self.idle.pop()
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        finally:
+            self.lock.release()
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout), False
+
+    def _release(self, conn):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < HttpConnectionPool.MAX_IDLE:
+                self.idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def request(self, method, path, body, headers, timeout):
+        start = time.time()
+        error = True
+        try:
+            conn, reused = self._lease(timeout)
+            try:
+                status, content, will_close = self._send(conn, method, path, body, headers)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                # A reused connection may have been closed by the server
+                # while it sat in the pool; that is worth one retry on a
+                # new connection, as long as the request can be repeated.
+                if not reused or method not in IDEMPOTENT_METHODS:
+                    raise
+                conn = httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+                try:
+                    status, content, will_close = self._send(conn, method, path, body, headers)
+                except (socket.error, httplib.HTTPException):
+                    conn.close()
+                    raise
+            if will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            error = status >= 400
+            return status, content
+        finally:
+            HttpConnectionPool._record(method, path, time.time() - start, error)
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        content = response.read()
+        return response.status, content, response.will_close
+
+    #sends a GET and returns (status, chunks), where chunks is a generator
+    #over the response body. the connection goes back to the pool once
+    #the body has been read to the end, and is closed if it is not. the
+    #request is recorded in endpoint_stats() once the body is done with.
+    def stream(self, path, headers, timeout, chunk_size=64 * 1024):
+        start = time.time()
+        conn, reused = self._lease(timeout)
+        try:
+            try:
+                conn.request('GET', path, None, headers)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                conn = httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+                try:
+                    conn.request('GET', path, None, headers)
+                    response = conn.getresponse()
+                except (socket.error, httplib.HTTPException):
+                    conn.close()
+                    raise
+        except:
+            HttpConnectionPool._record('GET', path, time.time() - start, True)
+            raise
+
+        def chunks():
+            complete = False
+            try:
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                complete = True
+            finally:
+                if complete and not response.will_close:
+                    self._release(conn)
+                else:
+                    conn.close()
+                HttpConnectionPool._record('GET', path, time.time() - start,
+                                           not complete or response.status >= 400)
+
+        return response.status, chunks()
+
+
+# Rows fetched per request by RestConnection.view_rows().
+VIEW_PAGE_SIZE = 10000
+
+
+class ViewRowStream(object):
+    """Iterates over the rows of a view response while it is read.
+
+    The body is parsed incrementally, one row at a time, so memory use
+    is bounded by the largest row rather than by the response. The other
+    top level fields, like total_rows or errors, are collected in
+    fields as they go by."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.fields = {}
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _more(self):
+        for chunk in self.chunks:
+            if self.pos > len(self.buf) / 2:
+                self.buf = self.buf[self.pos:]
+                self.pos = 0
+            self.buf += chunk
+            return True
+        return False
+
+    def _skip(self, chars=' \t\r\n'):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in chars:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                # the connection went away in the middle of the response
+                raise httplib.IncompleteRead(self.buf[self.pos:])
+
+    def _expect(self, char):
+        if self._skip() != char:
+            raise ValueError("expected {0!r} at {1!r}".format(char, self.buf[self.pos:self.pos + 40]))
+        self.pos += 1
+
+    # A value is complete once something follows it; numbers at the end
+    # of the buffer might still grow.
+    def _value(self):
+        self._skip()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf):
+                    self.pos = end
+                    return value
+            except ValueError:
+                pass
+            if not self._more():
+                try:
+                    value, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                except ValueError:
+                    # the response ends in the middle of a value
+                    raise httplib.IncompleteRead(self.buf[self.pos:])
+                return value
+
+    def __iter__(self):
+        for row in self._parse():
+            yield row
+        # read the body to its end, so the connection can be reused
+        for chunk in self.chunks:
+            pass
+
+    def _parse(self):
+        self._expect('{')
+        if self._skip() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'rows':
+                self._expect('[')
+                if self._skip() != ']':
+                    while True:
+                        yield self._value()
+                        if self._skip() == ']':
+                            break
+                        self._expect(',')
+                self.pos += 1
+            else:
+                self.fields[key] = self._value()
+            if self._skip() == '}':
+                return
+            self._expect(',')
+
+
+class ViewRows(object):
+    """Iterates over all the rows of a view query, page by page.
+
+    Every page is requested with limit=page_size and streamed with
+    ViewRowStream; the next one starts at the last row seen, with
+    startkey and startkey_docid (for map rows), and skips the rows with
+    that same key and docid already returned. A doc that emits the same
+    key several times gives several such rows, so skip is their count
+    rather than 1. total_rows and errors are taken from the responses."""
+
+    def __init__(self, rest, bucket, type_, name, params, page_size=VIEW_PAGE_SIZE,
+                 limit=None, timeout=120):
+        self.rest = rest
+        self.bucket = bucket
+        self.type_ = type_
+        self.name = name
+        self.params = dict(params)
+        self.page_size = page_size
+        self.limit = limit
+        self.timeout = timeout
+        self.total_rows = None
+        self.errors = []
+
+    def __iter__(self):
+        params = dict(self.params)
+        returned = 0
+        last = None
+        # rows with the key and docid of the last row seen so far
+        repeats = 0
+        while True:
+            page_size = self.page_size
+            if self.limit is not None:
+                page_size = min(page_size, self.limit - returned)
+                if page_size <= 0:
+                    return
+            stream = self.rest._index_stream(self.bucket, self.type_, self.name,
+                                             params, page_size, self.timeout)
+            count = 0
+            for row in stream:
+                count += 1
+                if last is not None and \
+                   (row.get("key"), row.get("id")) == (last.get("key"), last.get("id")):
+                    repeats += 1
+                else:
+                    repeats = 1
+                last = row
+                yield row
+            returned += count
+            if self.total_rows is None:
+                self.total_rows = stream.fields.get("total_rows")
+            self.errors.extend(stream.fields.get("errors", []))
+            if count < page_size:
+                return
+            params["startkey"] = last["key"]
+            if "id" in last:
+                params["startkey_docid"] = last["id"]
+            params["skip"] = repeats
+
+
 class RestConnection(object):
     #port is always 8091
     def __init__(self, ip, username='Administrator', password='password'):
@@ -201,27 +558,32 @@ class RestConnection(object):
         vBuckets = self.get_vbuckets(bucket)
         views_not_found = []
         views_per_vbucket = {}
-        for vBucket in vBuckets:
+
+        def get_view(vBucket):
             masterIp = vBucket.master.split(":")[0]
-            vb = vBucket.id
             api = "http://{0}:{1}/".format(masterIp, self.port)
-            api += 'couchBase/{0}%2F{1}/_design/{2}'.format(bucket, vb, view)
+            api += 'couchBase/{0}%2F{1}/_design/{2}'.format(bucket, vBucket.id, view)
             try:
-                response, content = httplib2.Http().request(api, headers=self._create_capi_headers())
-                if response['status'] == '404' or response['status'] == '400':
-                    json_parsed = json.loads(content)
-                    if "error" in json_parsed:
-#                        msg = "unable to retrieve the view : {0} , reason {1}"
-#                        log.error(msg.format(view, json_parsed["reason"]))
-                        views_not_found.append(vb)
-                elif response['status'] == '200':
-                    json_parsed = json.loads(content)
-                    views_per_vbucket[vb] = json_parsed
+                return HttpConnectionPool.request_url(api, headers=self._create_capi_headers())
             except socket.error as socket_error:
                 log.error(socket_error)
                 raise ServerUnavailableException(ip=self.ip)
-            except httplib2.ServerNotFoundError:
+            except httplib.HTTPException:
                 raise ServerUnavailableException(ip=self.ip)
+
+        responses = self.fan_out(vBuckets, get_view)
+        for vBucket in vBuckets:
+            vb = vBucket.id
+            status, content = responses[vBucket]
+            if status == 404 or status == 400:
+                json_parsed = json.loads(content)
+                if "error" in json_parsed:
+#                    msg = "unable to retrieve the view : {0} , reason {1}"
+#                    log.error(msg.format(view, json_parsed["reason"]))
+                    views_not_found.append(vb)
+            elif status == 200:
+                json_parsed = json.loads(content)
+                views_per_vbucket[vb] = json_parsed
         if views_not_found:
             log.error("unable to get view for vbucket : {0}".format(views_not_found))
         return views_per_vbucket
@@ -295,8 +657,40 @@ class RestConnection(object):
         return json
 
 
+    #iterates over every row of a view, paging and parsing the response as
+    #it arrives, see ViewRows
+    def view_rows(self, bucket, view, params={}, page_size=VIEW_PAGE_SIZE, limit=None, timeout=120):
+        return ViewRows(self, bucket, "view", view, params, page_size, limit, timeout)
+
+    #returns a ViewRowStream over one response
+    def _index_stream(self, bucket, type_, name, params, limit, timeout=120):
+        api = self._index_url(bucket, type_, name, params, limit)
+        log.info("index query url: {0}".format(api))
+        parts = urlparse.urlsplit(api)
+        pool = HttpConnectionPool.get(parts.hostname, parts.port or 80)
+        try:
+            status, chunks = pool.stream(api[api.index('/', len('http://')):],
+                                         self._create_capi_headers(), timeout)
+        except socket.error:
+            raise ServerUnavailableException(ip=self.ip)
+        if status not in [200, 201, 202]:
+            content = ''.join(chunks)
+            log.error('{0} error {1} {2}'.format(api, status, content))
+            raise QueryViewException(name, "unable to obtain {0} results : {1}".format(type_, content),
+                                     status)
+        return ViewRowStream(chunks)
+
     # type_ is "view" or "spatial"
     def _index_results(self, bucket, type_, name, params, limit, timeout=120):
+        api = self._index_url(bucket, type_, name, params, limit)
+        log.info("index query url: {0}".format(api))
+        status, content = self._http_request(api, headers=self._create_capi_headers(), timeout=timeout)
+
+        json_parsed = json.loads(content)
+
+        return status, json_parsed
+
+    def _index_url(self, bucket, type_, name, params, limit):
         if type_ == 'all_docs':
             api = self.baseUrl + 'couchBase/{0}/_all_docs'.format(bucket)
         else:
@@ -313,17 +707,15 @@ class RestConnection(object):
             else:
                 api += "?"
             num_params += 1
-            if param in ["key", "startkey", "endkey"] or params[param] == True or params[param] == False:
+            if param in ["key", "startkey", "endkey"]:
+                api += "{0}={1}".format(param, urllib.quote(json.dumps(params[param])))
+            elif params[param] == True or params[param] == False:
                 api += "{0}={1}".format(param, json.dumps(params[param]))
+            elif param in ["startkey_docid", "endkey_docid"]:
+                api += "{0}={1}".format(param, urllib.quote(unicode(params[param]).encode("utf-8")))
             else:
                 api += "{0}={1}".format(param, params[param])
-
-        log.info("index query url: {0}".format(api))
-        status, content = self._http_request(api, headers=self._create_capi_headers(), timeout=timeout)
-
-        json_parsed = json.loads(content)
-
-        return status, json_parsed
+        return api
 
     def all_docs(self, bucket, params={}, limit=None):
         status, json = self._index_results(bucket, 'all_docs', '', params,
@@ -396,12 +788,19 @@ class RestConnection(object):
                 'Accept': '*/*'}
 
 
+    _auth_headers = {}
+
     #authorization must be a base64 string of username:password
     def _create_headers(self):
-        authorization = base64.encodestring('%s:%s' % (self.username, self.password))
-        return {'Content-Type': 'application/x-www-form-urlencoded',
-                'Authorization': 'Basic %s' % authorization,
-                'Accept': '*/*'}
+        key = (self.username, self.password)
+        headers = RestConnection._auth_headers.get(key)
+        if headers is None:
+            authorization = base64.b64encode('%s:%s' % key)
+            headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                       'Authorization': 'Basic %s' % authorization,
+                       'Accept': '*/*'}
+            RestConnection._auth_headers[key] = headers
+        return dict(headers)
 
 
     def _http_request(self, api, method='GET', params='', headers=None, timeout=120):
@@ -411,26 +810,67 @@ class RestConnection(object):
         end_time = time.time() + timeout
         while True:
             try:
-                response, content = httplib2.Http(timeout=timeout).request(api, method, params, headers)
-                if response['status'] in ['200', '201', '202']:
+                status, content = HttpConnectionPool.request_url(api, method, params, headers, timeout)
+                if status in [200, 201, 202]:
                     return True, content
                 else:
                     json_parsed = json.loads(content)
                     reason = "unknown"
                     if "error" in json_parsed:
                         reason = json_parsed["error"]
-                    log.error('{0} error {1} reason: {2} {3}'.format(api, response['status'], reason, content))
+                    log.error('{0} error {1} reason: {2} {3}'.format(api, status, reason, content))
                     return False, content
             except socket.error as e:
                 log.error("socker error while connecting to {0}:{1} error {2}: ".format(self.ip, self.port, e))
                 if time.time() > end_time:
                     raise ServerUnavailableException(ip=self.ip)
-            except httplib2.ServerNotFoundError as e:
-                log.error("ServerNotFoundError error while connecting to {0}:{1} error {2}: ".format(self.ip, self.port, e))
+            except httplib.HTTPException as e:
+                log.error("http error while connecting to {0}:{1} error {2}: ".format(self.ip, self.port, e))
                 if time.time() > end_time:
                     raise ServerUnavailableException(ip=self.ip)
             time.sleep(1)
 
+    #calls function(key) for every key, concurrency calls at a time, and
+    #returns {key: result}. the first exception raised by any call is
+    #raised again once all the calls are done.
+    def fan_out(self, keys, function, concurrency=FAN_OUT_CONCURRENCY):
+        keys = list(keys)
+        results = {}
+        errors = []
+        lock = threading.Lock()
+        pending = iter(keys)
+        done = object()
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    key = next(pending, done)
+                    if key is done or errors:
+                        return
+                finally:
+                    lock.release()
+                try:
+                    result = function(key)
+                except Exception:
+                    lock.acquire()
+                    errors.append(sys.exc_info())
+                    lock.release()
+                    return
+                lock.acquire()
+                results[key] = result
+                lock.release()
+
+        threads = [threading.Thread(target=worker, name="fan-out-{0}".format(i))
+                   for i in range(min(concurrency, len(keys)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
 
     def init_cluster(self, username='Administrator', password='password'):
         api = self.baseUrl + 'settings/web'
@@ -847,6 +1287,13 @@ class RestConnection(object):
 
         return stats
 
+    #returns {node: stats} with get_bucket_stats_for_node() of every node,
+    #fetched concurrently
+    def get_bucket_stats_for_nodes(self, bucket='default', nodes=None):
+        if nodes is None:
+            nodes = self.get_nodes()
+        return self.fan_out(nodes, lambda node: self.get_bucket_stats_for_node(bucket, node))
+
 
     def get_nodes(self):
         nodes = []
@@ -1063,7 +1510,7 @@ class RestConnection(object):
         vbucket = self.get_vbuckets(bucket)
         for i in range(len(vbucket)):
             api = self.baseUrl + "couchBase/{0}%2F{1}".format(bucket, i)
-            status, content = httplib2.Http().request(api, "GET")
+            status, content = HttpConnectionPool.request_url(api, "GET")
             data = json.loads(content)
             if data["compact_running"] == True:
                 return True, i
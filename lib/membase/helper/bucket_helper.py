@@ -1,4 +1,3 @@
-import copy
 import time
 import uuid
 import zlib
@@ -9,9 +8,7 @@ import socket
 import ctypes
 from membase.api.rest_client import RestConnection, RestHelper
 import memcacheConstants
-from memcached.helper.data_helper import MemcachedClientHelper, VBucketAwareMemcached
-from threading import Thread
-import Queue
+from memcached.helper.data_helper import MemcachedClientHelper, VBucketAwareMemcached, KeyVerifier
 
 
 class BucketOperationHelper():
@@ -258,62 +255,40 @@ class BucketOperationHelper():
     @staticmethod
     def verify_data(server, keys, value_equal_to_key, verify_flags, test, debug=False, bucket="default"):
         log = logger.Logger.get_logger()
-        log_error_count = 0
-        #verify all the keys
-        client = MemcachedClientHelper.direct_client(server, bucket)
-        vbucket_count = len(RestConnection(server).get_vbuckets(bucket))
-        #populate key
-        index = 0
-        all_verified = True
-        keys_failed = []
-        for key in keys:
-            try:
-                index += 1
-                vbucketId = crc32.crc32_hash(key) & (vbucket_count - 1)
-                client.vbucketId = vbucketId
-                flag, keyx, value = client.get(key=key)
-                if value_equal_to_key:
-                    test.assertEquals(value, key, msg='values dont match')
-                if verify_flags:
-                    actual_flag = socket.ntohl(flag)
-                    expected_flag = ctypes.c_uint32(zlib.adler32(value)).value
-                    test.assertEquals(actual_flag, expected_flag, msg='flags dont match')
-                if debug:
-                    log.info("verified key #{0} : {1}".format(index, key))
-            except mc_bin_client.MemcachedError as error:
-                if debug:
-                    log_error_count += 1
-                    if log_error_count < 100:
-                        log.error(error)
-                        log.error(
-                            "memcachedError : {0} - unable to get a pre-inserted key : {0}".format(error.status, key))
-                keys_failed.append(key)
-                all_verified = False
-        client.close()
-        if len(keys_failed) > 0:
-            log.error('unable to verify #{0} keys'.format(len(keys_failed)))
-        return all_verified
+
+        def check(key, flag, value):
+            if value_equal_to_key and value != key:
+                return 'values dont match'
+            if verify_flags:
+                actual_flag = socket.ntohl(flag)
+                expected_flag = ctypes.c_uint32(zlib.adler32(value)).value
+                if actual_flag != expected_flag:
+                    return 'flags dont match'
+
+        #verify all the keys, grouped by the server that owns them
+        report = KeyVerifier(server, bucket).verify(keys, check=check)
+        if debug:
+            log.info("verified {0} keys : {1}".format(len(keys), report))
+        if report.ok():
+            return True
+        report.log_failures(log)
+        log.error('unable to verify #{0} keys'.format(len(report.failed)))
+        mismatched = [key for key, (status, reason) in report.failed.iteritems() if status == 0]
+        if mismatched:
+            key = mismatched[0]
+            test.fail('{0} of {1} keys dont match, e.g. {2} : {3}'.format(
+                len(mismatched), len(keys), key, report.failed[key][1]))
+        return False
 
     @staticmethod
     def keys_dont_exist(server, keys, bucket):
         log = logger.Logger.get_logger()
         #verify all the keys
-        client = MemcachedClientHelper.direct_client(server, bucket)
-        vbucket_count = len(RestConnection(server).get_vbuckets(bucket))
-        #populate key
-        for key in keys:
-            try:
-                vbucketId = crc32.crc32_hash(key) & (vbucket_count - 1)
-                client.vbucketId = vbucketId
-                client.get(key=key)
-                client.close()
-                log.error('key {0} should not exist in the bucket'.format(key))
-                return False
-            except mc_bin_client.MemcachedError as error:
-                log.error(error)
-                log.error("expected memcachedError : {0} - unable to get a pre-inserted key : {1}".format(error.status, key))
-        client.close()
-        return True
+        report = KeyVerifier(server, bucket).verify(keys, missing=True)
+        if not report.ok():
+            report.log_failures(log)
+            log.error('{0} keys should not exist in the bucket'.format(len(report.failed)))
+        return report.ok()
 
     @staticmethod
     def chunks(l, n):
@@ -324,62 +299,23 @@ class BucketOperationHelper():
             index += 1
         return keys_chunks
 
+    # KeyVerifier already verifies every server in parallel, so this is
+    # keys_exist_or_assert; concurrency is kept for existing callers.
     @staticmethod
     def keys_exist_or_assert_in_parallel(keys, server, bucket_name, test, concurrency=2):
-        log = logger.Logger.get_logger()
-        verification_threads = []
-        queue = Queue.Queue()
-        for i in range(concurrency):
-            keys_chunk = BucketOperationHelper.chunks(keys, len(keys) / concurrency)
-            t = Thread(target=BucketOperationHelper.keys_exist_or_assert,
-                       name="verification-thread-{0}".format(i),
-                       args=(keys_chunk.get(i), server, bucket_name, test, queue))
-            verification_threads.append(t)
-        for t in verification_threads:
-            t.start()
-        for t in verification_threads:
-            log.info("thread {0} finished".format(t.name))
-            t.join()
-        while not queue.empty():
-            item = queue.get()
-            if item is False:
-                return False
-        return True
+        return BucketOperationHelper.keys_exist_or_assert(keys, server, bucket_name, test)
 
     @staticmethod
     def keys_exist_or_assert(keys, server, bucket_name, test, queue=None):
         #we should try out at least three times
         log = logger.Logger.get_logger()
-        #verify all the keys
-        client = MemcachedClientHelper.proxy_client(server, bucket_name)
-        #populate key
-        retry = 1
-
-        keys_left_to_verify = []
-        keys_left_to_verify.extend(copy.deepcopy(keys))
-        log_count = 0
-        while retry < 6 and len(keys_left_to_verify) > 0:
-            msg = "trying to verify {0} keys - attempt #{1} : {2} keys left to verify"
-            log.info(msg.format(len(keys), retry, len(keys_left_to_verify)))
-            keys_not_verified = []
-            for key in keys_left_to_verify:
-                try:
-                    client.get(key=key)
-                except mc_bin_client.MemcachedError as error:
-                    keys_not_verified.append(key)
-                    if log_count < 100:
-                        log.error("key {0} does not exist because {1}".format(key, error))
-                        log_count += 1
-            retry += 1
-            keys_left_to_verify = keys_not_verified
-        if len(keys_left_to_verify) > 0:
-            log_count = 0
-            for key in keys_left_to_verify:
-                log.error("key {0} not found".format(key))
-                log_count += 1
-                if log_count > 100:
-                    break
-            msg = "unable to verify {0} keys".format(len(keys_left_to_verify))
+        #verify all the keys, retrying only the ones that failed
+        verifier = KeyVerifier(server, bucket_name, retries=4)
+        log.info("trying to verify {0} keys".format(len(keys)))
+        report = verifier.verify(keys)
+        if not report.ok():
+            report.log_failures(log)
+            msg = "unable to verify {0} keys".format(len(report.failed))
             log.error(msg)
             if test:
                 test.fail(msg=msg)
@@ -387,6 +323,7 @@ class BucketOperationHelper():
                 return False
             else:
                 queue.put(False)
+                return
         log.info("verified that {0} keys exist".format(len(keys)))
         if queue is None:
             return True
@@ -420,7 +357,7 @@ class BucketOperationHelper():
         keys = ["key_%s_%d" % (testuuid, i) for i in range(number_of_buckets)]
         inserted_keys = []
         for key in keys:
-            vbucketId = crc32.crc32_hash(key) & (vbucket_count - 1)
+            vbucketId = crc32.vbucket_id(key, vbucket_count)
             client.vbucketId = vbucketId
             try:
                 client.set(key, 0, 0, key)
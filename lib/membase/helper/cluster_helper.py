@@ -1,6 +1,6 @@
 from membase.api.rest_client import RestConnection, RestHelper
 from memcached.helper.data_helper import MemcachedClientHelper
-from remote.remote_util import RemoteMachineShellConnection
+from remote.remote_util import RemoteMachineShellConnection, ClusterShell
 from mc_bin_client import MemcachedClient, MemcachedError
 from membase.api.exception import ServerAlreadyJoinedException
 
@@ -169,21 +169,21 @@ class ClusterOperationHelper(object):
 
     @staticmethod
     def start_cluster(servers):
-        for server in servers:
-            shell = RemoteMachineShellConnection(server)
+        def start(shell):
             if shell.is_membase_installed():
                 shell.start_membase()
             else:
                 shell.start_couchbase()
+        ClusterShell.call_all(servers, start)
 
     @staticmethod
     def stop_cluster(servers):
-        for server in servers:
-            shell = RemoteMachineShellConnection(server)
+        def stop(shell):
             if shell.is_membase_installed():
                 shell.stop_membase()
             else:
                 shell.stop_couchbase()
+        ClusterShell.call_all(servers, stop)
 
     @staticmethod
     def cleanup_cluster(servers, wait_for_rebalance=True):
@@ -219,13 +219,17 @@ class ClusterOperationHelper(object):
     @staticmethod
     def flush_os_caches(servers):
         log = logger.Logger.get_logger()
-        for server in servers:
+
+        def flush(shell):
             try:
-                shell = RemoteMachineShellConnection(server)
                 shell.flush_os_caches()
-                log.info("Clearing os caches on {0}".format(server))
+                log.info("Clearing os caches on {0}".format(shell.ip))
             except:
                 pass
+        try:
+            ClusterShell.call_all(servers, flush)
+        except:
+            pass
 
     @staticmethod
     def flushctl_set(servers, key, val):
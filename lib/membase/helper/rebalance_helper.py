@@ -4,6 +4,7 @@ import logger
 from membase.api.exception import StatsUnavailableException
 from membase.api.rest_client import RestConnection, RestHelper
 from membase.helper.bucket_helper import BucketOperationHelper
+from membase.helper.stats_watcher import ClusterStatsWatcher, StatsSubscription
 from memcached.helper.data_helper import MemcachedClientHelper
 from mc_bin_client import MemcachedClient, MemcachedError
 
@@ -18,194 +19,144 @@ class RebalanceHelper():
     def wait_for_mc_stats_all_nodes(master, bucket, stat_key, stat_value, timeout_in_seconds=120, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to match {2} on {3}".format(bucket, stat_key, \
                                                                                 stat_value, master.ip))
-        time_to_timeout = 0
-        previous_stat_value = -1
-        curr_stat_value = -1
-        verified = False
-        all_stats = {}
-        while not verified:
-            rest = RestConnection(master)
-            nodes = rest.node_statuses()
-            for node in nodes:
-                _server = {"ip": node.ip, "port": node.port, "username": master.rest_username,
-                           "password": master.rest_password}
-                mc = MemcachedClientHelper.direct_client(_server, bucket)
-                n_stats = mc.stats("")
-                mc.close()
-                all_stats[node.id] = n_stats
-            actual_stat_value = -1
-            for k in all_stats:
-                if all_stats[k] and stat_key in all_stats[k]:
-                    if actual_stat_value == -1:
-                        print all_stats[k][stat_key]
-                        actual_stat_value = int(all_stats[k][stat_key])
-                    else:
-                        actual_stat_value += int(all_stats[k][stat_key])
-            if actual_stat_value == stat_value:
-                log.info("{0} : {1}".format(stat_key, actual_stat_value))
-                verified = True
-                break
-            else:
-                if verbose:
-                    log.info("{0} : {1}".format(stat_key, actual_stat_value))
-                curr_stat_value = actual_stat_value
 
-                # values are changing so clear any timeout
-                if curr_stat_value != previous_stat_value:
-                    time_to_timeout = 0
-                else:
-                    if time_to_timeout == 0:
-                        time_to_timeout = time.time() + timeout_in_seconds
-                    if time_to_timeout < time.time():
-                        log.info("no change in {0} stat after {1} seconds (value = {2})".format(stat_key, timeout_in_seconds, curr_stat_value))
-                        break
+        #sum of the stat over all nodes, -1 if no node has it
+        def total(samples):
+            values = [int(stats[stat_key]) for stats in samples.values()
+                      if stats and stat_key in stats]
+            if not values:
+                return -1
+            return sum(values)
 
-                previous_stat_value = curr_stat_value
+        subscription = StatsSubscription("mc", total, lambda value: value == stat_value,
+                                         timeout=timeout_in_seconds, stall=True,
+                                         name=stat_key, verbose=verbose)
+        return ClusterStatsWatcher.get(master, bucket).wait(subscription)
 
-                if not verbose:
-                    time.sleep(0.1)
-                else:
-                    time.sleep(2)
-        return verified
+    @staticmethod
+    #returns the value of stat_key on the only node in samples
+    def _node_stat(samples, stat_key, default=None):
+        for stats in samples.values():
+            if stats and stat_key in stats:
+                return stats[stat_key]
+        return default
 
     @staticmethod
     #bucket is a json object that contains name,port,password
     def wait_for_stats(master, bucket, stat_key, stat_value, timeout_in_seconds=120, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to match {2} on {3}".format(bucket, stat_key, \
                                                                                 stat_value, master.ip))
-        time_to_timeout = 0
-        previous_stat_value = -1
-        curr_stat_value = -1
-        verified = False
-        while not verified:
-            rest = RestConnection(master)
-            try:
-                stats = rest.get_bucket_stats(bucket)
-                if stats and stat_key in stats and stats[stat_key] == stat_value:
-                    log.info("{0} : {1}".format(stat_key, stats[stat_key]))
-                    verified = True
-                    break
-                else:
-                    if stats and stat_key in stats:
-                        if verbose:
-                            log.info("{0} : {1}".format(stat_key, stats[stat_key]))
-                        curr_stat_value = stats[stat_key]
-
-                    # values are changing so clear any timeout
-                    if curr_stat_value != previous_stat_value:
-                        time_to_timeout = 0
-                    else:
-                        if time_to_timeout == 0:
-                            time_to_timeout = time.time() + timeout_in_seconds
-                        if time_to_timeout < time.time():
-                            log.info("no change in {0} stat after {1} seconds (value = {2})".format(stat_key, timeout_in_seconds, curr_stat_value))
-                            break
-
-                    previous_stat_value = curr_stat_value
-
-                    if not verbose:
-                        time.sleep(0.1)
-                    else:
-                        time.sleep(2)
-            except:
-                log.info("unable to collect stats from server {0}".format(master))
-                verified = True #TODO: throw ex and assume caller catches
-                break
-
-        return verified
+        #TODO: throw ex and assume caller catches instead of on_error=True
+        subscription = StatsSubscription("rest",
+                                         lambda samples: RebalanceHelper._node_stat(samples, stat_key),
+                                         lambda value: value == stat_value,
+                                         timeout=timeout_in_seconds, stall=True, servers=[master],
+                                         on_error=True, name=stat_key, verbose=verbose)
+        return ClusterStatsWatcher.get(master, bucket).wait(subscription)
 
     @staticmethod
     def wait_for_stats_no_timeout(master, bucket, stat_key, stat_value, timeout_in_seconds=-1, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to match {2} on {3}".format(bucket, stat_key, \
                                                                                 stat_value, master.ip))
-        rest = RestConnection(master)
-        stats = rest.get_bucket_stats(bucket)
-
-        while stats.get(stat_key, -1) != stat_value:
-            stats = rest.get_bucket_stats(bucket)
-            if verbose:
-                log.info("{0} : {1}".format(stat_key, stats.get(stat_key, -1)))
-            time.sleep(5)
-        return True
+        subscription = StatsSubscription("rest",
+                                         lambda samples: RebalanceHelper._node_stat(samples, stat_key, -1),
+                                         lambda value: value == stat_value,
+                                         servers=[master], name=stat_key, verbose=verbose)
+        return ClusterStatsWatcher.get(master, bucket).wait(subscription)
 
     @staticmethod
     #bucket is a json object that contains name,port,password
     def wait_for_mc_stats(master, bucket, stat_key, stat_value, timeout_in_seconds=120, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to match {2} on {3}".format(bucket, stat_key, \
                                                                                 stat_value, master.ip))
-        start = time.time()
-        verified = False
-        while (time.time() - start) <= timeout_in_seconds:
-            c = MemcachedClient(master.ip, 11210)
-            stats = c.stats()
-            c.close()
-            if stats and stat_key in stats and str(stats[stat_key]) == str(stat_value):
-                log.info("{0} : {1}".format(stat_key, stats[stat_key]))
-                verified = True
-                break
-            else:
-                if stats and stat_key in stats:
-                    if verbose:
-                        log.info("{0} : {1}".format(stat_key, stats[stat_key]))
-                if not verbose:
-                    time.sleep(0.1)
-                else:
-                    time.sleep(2)
-        return verified
+        subscription = StatsSubscription("mc",
+                                         lambda samples: RebalanceHelper._node_stat(samples, stat_key),
+                                         lambda value: str(value) == str(stat_value),
+                                         timeout=timeout_in_seconds, servers=[master],
+                                         name=stat_key, verbose=verbose)
+        return ClusterStatsWatcher.get(master, bucket).wait(subscription)
 
     @staticmethod
     def wait_for_mc_stats_no_timeout(master, bucket, stat_key, stat_value, timeout_in_seconds=-1, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to match {2} on {3}".format(bucket, stat_key, \
                                                                                 stat_value, master.ip))
-        c = MemcachedClient(master.ip, 11210)
-        stats = c.stats()
-        c.close()
-
-        while str(stats[stat_key]) != str(stat_value):
-            c = MemcachedClient(master.ip, 11210)
-            stats = c.stats()
-            c.close()
-            if verbose:
-                log.info("{0} : {1}".format(stat_key, stats[stat_key]))
-            time.sleep(5)
-        return True
+        subscription = StatsSubscription("mc",
+                                         lambda samples: RebalanceHelper._node_stat(samples, stat_key),
+                                         lambda value: str(value) == str(stat_value),
+                                         servers=[master], name=stat_key, verbose=verbose)
+        return ClusterStatsWatcher.get(master, bucket).wait(subscription)
 
     @staticmethod
     #bucket is a json object that contains name,port,password
     def wait_for_stats_int_value(master, bucket, stat_key, stat_value, option="==",timeout_in_seconds=120, verbose=True):
         log.info("waiting for bucket {0} stat : {1} to {2} {3} on {4}".format(bucket, stat_key,option, \
                                                                                 stat_value, master.ip))
-        start = time.time()
-        verified = False
-        while (time.time() - start) <= timeout_in_seconds:
-            rest = RestConnection(master)
-            stats = rest.get_bucket_stats(bucket)
+
+        def accept(actual):
             #some stats are in memcached
-            if stats and stat_key in stats:
-                actual = int(stats[stat_key])
-                if option == "==":
-                    verified = stat_value == actual
-                elif option == ">":
-                    verified = stat_value > actual
-                elif option == "<":
-                    verified = stat_value < actual
-                elif option == ">=":
-                    verified = stat_value >= actual
-                elif option == "<=":
-                    verified = stat_value <= actual
-                if verified:
-                    log.info("verified {0} : {1}".format(stat_key, actual))
-                    break
-                if verbose:
-                    log.info("{0} : {1} isn't {2} {3}".format(stat_key, stat_value, option, actual))
-            time.sleep(2)
-        return verified
+            if actual is None:
+                return False
+            actual = int(actual)
+            if option == "==":
+                return stat_value == actual
+            elif option == ">":
+                return stat_value > actual
+            elif option == "<":
+                return stat_value < actual
+            elif option == ">=":
+                return stat_value >= actual
+            elif option == "<=":
+                return stat_value <= actual
+            return False
+
+        subscription = StatsSubscription("rest",
+                                         lambda samples: RebalanceHelper._node_stat(samples, stat_key),
+                                         accept, timeout=timeout_in_seconds, servers=[master],
+                                         name=stat_key, verbose=verbose)
+        return ClusterStatsWatcher.get(master, bucket).wait(subscription)
 
     @staticmethod
     #bucket is a json object that contains name,port,password
     def wait_for_stats_on_all(master, bucket, stat_key, stat_value, timeout_in_seconds=120,
                               fn=None):
         fn = fn or RebalanceHelper.wait_for_stats
+        if fn in (RebalanceHelper.wait_for_stats, RebalanceHelper.wait_for_stats_no_timeout):
+            source = "rest"
+            accept = lambda value: value == stat_value
+        elif fn == RebalanceHelper.wait_for_mc_stats_no_timeout:
+            source = "mc"
+            accept = lambda value: str(value) == str(stat_value)
+        else:
+            return RebalanceHelper._wait_for_stats_on_each(master, bucket, stat_key, stat_value,
+                                                           timeout_in_seconds, fn)
+
+        #like the per server waits, which returned True when they could not
+        #get the stats, a node that can not be sampled counts as verified,
+        #even when that is every node
+        def node_values(samples):
+            return dict([(node, stats.get(stat_key)) for node, stats in samples.items()
+                         if stats is not None])
+
+        def all_accept(values):
+            return not [node for node, value in values.items() if not accept(value)]
+
+        timeout = timeout_in_seconds
+        if fn != RebalanceHelper.wait_for_stats:
+            timeout = None
+        log.info("waiting for bucket {0} stat : {1} to match {2} on all nodes".format(bucket, stat_key,
+                                                                                     stat_value))
+        start_time = time.time()
+        subscription = StatsSubscription(source, node_values, all_accept, timeout=timeout, stall=True,
+                                         name=stat_key)
+        verified = ClusterStatsWatcher.get(master, bucket).wait(subscription)
+        if not verified:
+            log.info("bucket {0}: stat_key {1} timed out in {2} (values = {3})".format(bucket, stat_key, \
+                                                                                      time.time() - start_time,
+                                                                                      subscription.value))
+        return verified
+
+    @staticmethod
+    def _wait_for_stats_on_each(master, bucket, stat_key, stat_value, timeout_in_seconds, fn):
         rest = RestConnection(master)
         servers = rest.get_nodes()
         verified = False
@@ -298,9 +249,10 @@ class RebalanceHelper():
         all_server_stats = []
         stats_received = 0
         nodes = rest.get_nodes()
+        nodes_stats = rest.get_bucket_stats_for_nodes(bucket, nodes)
         for server in nodes:
             #get the stats
-            server_stats = rest.get_bucket_stats_for_node(bucket, server)
+            server_stats = nodes_stats[server]
             if not server_stats:
                 log.info("unable to get stats from {0}:{1}".format(server.ip, server.port))
             else:
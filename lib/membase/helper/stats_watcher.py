@@ -0,0 +1,304 @@
+import sys
+import threading
+import time
+import logger
+from membase.api.rest_client import RestConnection
+from memcached.helper.data_helper import MemcachedClientHelper
+
+log = logger.Logger.get_logger()
+
+
+class StatsSubscription(object):
+    """A wait registered with a ClusterStatsWatcher.
+
+    value_fn gets the latest samples of source ("mc" or "rest"), a dict
+    of node key ("ip:port") to stats, or None for a node that could not
+    be sampled, and returns the value to watch. servers limits the
+    samples to those servers, by default all nodes of the cluster are
+    sampled. The wait is over once
+    accept(value) holds. timeout is counted from the start of the wait,
+    or with stall=True from the last change of the value; None waits
+    forever. With on_error set, the wait ends with that result as soon as
+    one of its nodes cannot be sampled. Without servers, the wait only
+    gets samples once the node list has been fetched after it started, so
+    nodes that just joined are not missed."""
+
+    def __init__(self, source, value_fn, accept, timeout=None, stall=False,
+                 servers=None, on_error=None, name=None, verbose=False):
+        self.source = source
+        self.value_fn = value_fn
+        self.accept = accept
+        self.timeout = timeout
+        self.stall = stall
+        self.servers = servers
+        self.nodes = None
+        if servers is not None:
+            self.nodes = [ClusterStatsWatcher.node_key(server) for server in servers]
+        self.on_error = on_error
+        self.name = name
+        self.verbose = verbose
+        self.value = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.started = time.time()
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+
+    # Returns True if the value changed.
+    def update(self, samples):
+        if self.on_error is not None and \
+           [node for node, stats in samples.items() if stats is None]:
+            log.info("unable to collect {0} stats for {1}".format(self.source, self.name))
+            self.finish(self.on_error)
+            return False
+        value = self.value_fn(samples)
+        changed = value != self.value
+        self.value = value
+        if changed and self.verbose:
+            log.info("{0} : {1}".format(self.name, value))
+        if self.accept(value):
+            log.info("{0} : {1}".format(self.name, value))
+            self.finish(True)
+        else:
+            self.expire(changed)
+        return changed
+
+    # Ends the wait with False once its timeout is over.
+    def expire(self, changed=False):
+        if self.deadline is not None:
+            if changed and self.stall:
+                self.deadline = time.time() + self.timeout
+            elif time.time() > self.deadline:
+                if self.stall:
+                    log.info("no change in {0} after {1} seconds (value = {2})".format(
+                        self.name, self.timeout, self.value))
+                else:
+                    log.info("{0} did not reach the expected value in {1} seconds (value = {2})".format(
+                        self.name, self.timeout, self.value))
+                self.finish(False)
+
+    def finish(self, result):
+        self.result = result
+        self.done.set()
+
+
+class ClusterStatsWatcher(object):
+    """Samples memcached and REST bucket stats of all nodes of a cluster.
+
+    One watcher per (cluster, bucket) is shared by every wait in the
+    process. Its thread keeps a memcached connection per node and the
+    pooled REST connections open, samples only the sources and nodes
+    that current subscriptions need, and wakes each waiter as soon as its
+    condition holds. The interval starts at MIN_INTERVAL, doubles up to
+    MAX_INTERVAL while nothing changes, and drops back on any change or
+    new subscription. The thread exits, closing its connections, once it
+    has had no subscriptions for IDLE_TIMEOUT seconds."""
+
+    MIN_INTERVAL = 0.1
+    MAX_INTERVAL = 2
+    IDLE_TIMEOUT = 30
+    # How often the node list is fetched again.
+    NODES_REFRESH = 30
+
+    _lock = threading.Lock()
+    _watchers = {}
+
+    @staticmethod
+    def get(master, bucket='default'):
+        rest = RestConnection(master)
+        key = (rest.ip, rest.port, bucket)
+        ClusterStatsWatcher._lock.acquire()
+        try:
+            watcher = ClusterStatsWatcher._watchers.get(key)
+            if watcher is None:
+                watcher = ClusterStatsWatcher(master, bucket)
+                ClusterStatsWatcher._watchers[key] = watcher
+            return watcher
+        finally:
+            ClusterStatsWatcher._lock.release()
+
+    @staticmethod
+    def node_key(server):
+        rest = RestConnection(server)
+        return "{0}:{1}".format(rest.ip, rest.port)
+
+    def __init__(self, master, bucket):
+        self.master = master
+        self.bucket = bucket
+        self.cond = threading.Condition()
+        self.subscriptions = []
+        self.thread = None
+        self.subscribed = 0
+        self.nodes = {}
+        # when the node list was last fetched, and whether it has to be
+        # fetched again before the next sample
+        self.nodes_fetched = 0
+        self.nodes_stale = True
+        # servers named by subscriptions, which may not be known under
+        # the same address in the node list
+        self.pinned = {}
+        self.clients = {}
+
+    def wait(self, subscription):
+        """Blocks until subscription is over and returns its result."""
+        self.cond.acquire()
+        try:
+            self.subscriptions.append(subscription)
+            self.subscribed += 1
+            # the cluster may have changed since the last listing, e.g. by
+            # a rebalance that just ended
+            self.nodes_stale = True
+            for server in subscription.servers or []:
+                self.pinned[self.node_key(server)] = server
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self._run,
+                                               name="stats-watcher-{0}".format(self.bucket))
+                self.thread.daemon = True
+                self.thread.start()
+            thread = self.thread
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        try:
+            while not subscription.done.wait(1):
+                if not thread.isAlive():
+                    raise Exception("stats watcher for bucket {0} died".format(self.bucket))
+        finally:
+            self._unsubscribe(subscription)
+        if subscription.error:
+            raise subscription.error[0], subscription.error[1], subscription.error[2]
+        return subscription.result
+
+    def _unsubscribe(self, subscription):
+        self.cond.acquire()
+        try:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        interval = self.MIN_INTERVAL
+        idle_since = None
+        try:
+            while True:
+                self.cond.acquire()
+                try:
+                    subscriptions = [s for s in self.subscriptions if not s.done.isSet()]
+                    subscribed = self.subscribed
+                    if not subscriptions:
+                        if idle_since is None:
+                            idle_since = time.time()
+                        elif time.time() - idle_since > self.IDLE_TIMEOUT:
+                            self._close()
+                            self.thread = None
+                            return
+                        self.cond.wait(1)
+                        interval = self.MIN_INTERVAL
+                        continue
+                    idle_since = None
+                finally:
+                    self.cond.release()
+
+                samples = self._sample(subscriptions)
+                changed = False
+                for subscription in subscriptions:
+                    if subscription.nodes is None and self.nodes_fetched < subscription.started:
+                        # the node list could not be fetched since the
+                        # wait started, it may miss nodes
+                        subscription.expire()
+                        continue
+                    node_samples = samples[subscription.source]
+                    if subscription.nodes is not None:
+                        node_samples = dict([(node, node_samples.get(node))
+                                             for node in subscription.nodes])
+                    try:
+                        if subscription.update(node_samples):
+                            changed = True
+                    except Exception:
+                        subscription.error = sys.exc_info()
+                        subscription.finish(None)
+
+                if changed:
+                    interval = self.MIN_INTERVAL
+                else:
+                    interval = min(interval * 2, self.MAX_INTERVAL)
+                self.cond.acquire()
+                try:
+                    # a new subscription wakes us up early
+                    if self.subscribed == subscribed:
+                        self.cond.wait(interval)
+                finally:
+                    self.cond.release()
+        except:
+            self._close()
+            raise
+
+    def _refresh_nodes(self):
+        if not self.nodes_stale and time.time() - self.nodes_fetched < self.NODES_REFRESH:
+            return
+        # a wait that starts while the list is fetched marks it stale again
+        self.nodes_stale = False
+        fetched = time.time()
+        nodes = {}
+        try:
+            for node in RestConnection(self.master).get_nodes():
+                nodes["{0}:{1}".format(node.ip, node.port)] = node
+        except Exception as ex:
+            log.error("unable to get the nodes of {0} : {1}".format(self.node_key(self.master), ex))
+            self.nodes_stale = True
+            return
+        for key in self.clients.keys():
+            if key not in nodes and key not in self.pinned:
+                self.clients.pop(key).close()
+        self.nodes = nodes
+        self.nodes_fetched = fetched
+
+    def _sample(self, subscriptions):
+        self._refresh_nodes()
+        wanted = {"mc": set(), "rest": set()}
+        for subscription in subscriptions:
+            wanted[subscription.source].update(subscription.nodes or self.nodes.keys())
+        rest = RestConnection(self.master)
+        samples = {}
+        samples["mc"] = rest.fan_out(wanted["mc"], self._mc_stats)
+        samples["rest"] = rest.fan_out(wanted["rest"], self._rest_stats)
+        return samples
+
+    def _node(self, key):
+        return self.nodes.get(key) or self.pinned.get(key)
+
+    def _mc_stats(self, key):
+        node = self._node(key)
+        if node is None:
+            return None
+        try:
+            client = self.clients.get(key)
+            if client is None:
+                client = MemcachedClientHelper.direct_client(node, self.bucket)
+                self.clients[key] = client
+            return client.stats()
+        except Exception as ex:
+            log.error("unable to get stats from {0} : {1}".format(key, ex))
+            client = self.clients.pop(key, None)
+            if client:
+                client.close()
+            return None
+
+    def _rest_stats(self, key):
+        node = self._node(key)
+        if node is None:
+            return None
+        try:
+            return RestConnection(node).get_bucket_stats(self.bucket)
+        except Exception as ex:
+            log.error("unable to get bucket stats from {0} : {1}".format(key, ex))
+            return None
+
+    def _close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+        self.nodes_stale = True
@@ -5,29 +5,98 @@ from threading import Thread
 import time
 from membase.api.rest_client import RestConnection
 from memcached.helper.data_helper import MemcachedClientHelper
-from remote.remote_util import RemoteMachineShellConnection, RemoteMachineHelper
+from remote.remote_util import RemoteMachineShellConnection, ClusterShell
 import testconstants
-import gzip
-
-# The histo dict is returned by add_timing_sample().
-# The percentiles must be sorted, ascending, like [0.90, 0.99].
-def histo_percentile(histo, percentiles):
-   v_sum = 0
-   bins = histo.keys()
-   bins.sort()
-   for bin in bins:
-      v_sum += histo[bin]
-   v_sum = float(v_sum)
-   v_cur = 0 # Running total.
-   rv = []
-   for bin in bins:
-      if not percentiles:
-         return rv
-      v_cur += histo[bin]
-      while percentiles and (v_cur / v_sum) >= percentiles[0]:
-         rv.append((percentiles[0], bin))
-         percentiles.pop(0)
-   return rv
+from histogram import Histogram
+from membase.performance.stats_stream import StatsStream, convert
+
+LATENCY_PERCENTILES = [0.90, 0.95, 0.99]
+
+# Sample lists of the exported json document, present even when empty.
+EXPORT_LISTS = ["membasestats", "systemstats", "totalops", "ops",
+                "ns_server_data", "ns_server_data_system", "hoststats", "timings",
+                "dispatcher", "bucket-size", "data-size",
+                "latency-set", "latency-set-recent",
+                "latency-get", "latency-get-recent",
+                "latency-delete", "latency-delete-recent"]
+
+# Fields of /proc/<pid>/stat, in order.
+PROC_STAT_FIELDS = ('pid comm state ppid pgrp session tty_nr tpgid flags minflt '
+                    'cminflt majflt cmajflt utime stime cutime cstime priority '
+                    'nice num_threads itrealvalue starttime vsize rss rsslim '
+                    'startcode endcode startstack kstkesp kstkeip signal blocked '
+                    'sigignore sigcatch wchan nswap cnswap exit_signal '
+                    'processor rt_priority policy delayacct_blkio_ticks '
+                    'guest_time cguest_time ').split(' ')
+
+# Lines of /proc/<pid>/status added to the systemstats samples.
+PROC_STATUS_FIELDS = ["VmPeak", "VmSize", "VmHWM", "VmRSS", "VmSwap", "Threads",
+                      "voluntary_ctxt_switches", "nonvoluntary_ctxt_switches"]
+
+# Columns of the cpu line of /proc/stat.
+CPU_FIELDS = ["user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal"]
+
+
+class ProcSampler(object):
+    """Samples /proc on one node with a single ssh command.
+
+    The command looks up the first process of every name, like
+    RemoteMachineHelper.is_process_running, and prints its /proc/<pid>/stat
+    and /proc/<pid>/status, then the host's /proc/stat and /proc/meminfo,
+    every section behind a "@@" marker line. sample(shell) runs it on the
+    node of shell and returns the per process dicts and the host dict."""
+
+    def __init__(self, pnames):
+        self.pnames = pnames
+        parts = []
+        for pname in pnames:
+            parts.append("pid=$(ps -Ao pid=,comm= | awk '$2 == \"{0}\" {{print $1; exit}}'); "
+                         "if [ -n \"$pid\" ]; then echo \"@@proc {0} $pid\"; cat /proc/$pid/stat; "
+                         "echo @@status; cat /proc/$pid/status; fi".format(pname))
+        parts.append("echo @@stat; cat /proc/stat; echo @@meminfo; cat /proc/meminfo")
+        self.command = "; ".join(parts)
+
+    def sample(self, shell):
+        # /proc is world readable, so there is no need for sudo
+        output, error = shell.execute_command_raw(self.command, debug=False)
+        return self.parse(output)
+
+    @staticmethod
+    def parse(lines):
+        procs = []
+        host = {}
+        section = None
+        proc = None
+        for line in lines:
+            if line.startswith("@@"):
+                words = line[2:].split()
+                section = words[0]
+                if section == "proc":
+                    proc = {"name": words[1], "id": words[2]}
+                    procs.append(proc)
+                    section = "pidstat"
+                continue
+            if section == "pidstat":
+                proc.update(zip(PROC_STAT_FIELDS, line.split(' ')))
+            elif section == "status":
+                key, _, value = line.partition(":")
+                if key in PROC_STATUS_FIELDS:
+                    proc[key] = value.split()[0]
+            elif section == "stat":
+                words = line.split()
+                if not words:
+                    continue
+                if words[0] == "cpu":
+                    for field, value in zip(CPU_FIELDS, words[1:]):
+                        host["cpu_" + field] = value
+                elif words[0] in ("ctxt", "processes", "procs_running", "procs_blocked"):
+                    host[words[0]] = words[1]
+            elif section == "meminfo":
+                key, _, value = line.partition(":")
+                if value.strip():
+                    host[key] = value.split()[0]
+        return procs, host
+
 
 class StatsCollector(object):
     _task = {}
@@ -44,15 +113,13 @@ class StatsCollector(object):
         self._task = {"state": "running", "threads": []}
         self._task["name"] = name
         self._task["time"] = time.time()
-        self._task["ops"] = []
-        self._task["totalops"] = []
         self._task["ops-temp"] = []
-        self._task["latency"] = {}
-        self._task["data_size_stats"] = []
+        self._task["histograms"] = {}
         rest = RestConnection(nodes[0])
         info = rest.get_nodes_self()
         self.data_path = info.storage[0].get_data_path()
         self.client_id = str(client_id)
+        self._stream = StatsStream("{0}.ndjson.gz".format(self._filename(name)))
 
         if collect_server_stats:
             mbstats_thread = Thread(target=self.membase_stats,
@@ -88,82 +155,55 @@ class StatsCollector(object):
     def sample(self, cur):
         pass
 
+    #samples are streamed to disk while the test runs; export converts
+    #the stream into the single json document the R scripts expect
     def export(self, name, test_params):
-        for latency in self._task["latency"].keys():
-            histos = self._task["latency"].get(latency, [])
-            key = 'percentile-' + latency
-            self._task["latency"][key] = []
-            for histo in histos:
-                temp = []
-                delta = histo['delta']
-                del histo['delta']
-                p = histo_percentile(histo, [0.90, 0.95, 0.99])
-                # p is list of tuples
-                for val in p:
-                    temp.append(val[-1])
-                temp.append(self.client_id)
-                temp.append(delta)
-                self._task["latency"][key].append(temp)
-
-        obj = {"buildinfo": self._task.get("buildstats", {}),
-               "machineinfo": self._task.get("machinestats", {}),
-               "membasestats": self._task.get("membasestats", []),
-               "systemstats": self._task.get("systemstats", []),
-               "name": name,
-               "totalops":self._task["totalops"],
-               "ops":self._task["ops"],
-               "time": self._task["time"],
-               "info": test_params,
-               "ns_server_data": self._task.get("ns_server_stats", []),
-               "ns_server_data_system": self._task.get("ns_server_stats_system", []),
-               "timings": self._task.get("timings", []),
-               "dispatcher": self._task.get("dispatcher", []),
-               "bucket-size":self._task.get("bucket_size", []),
-               "data-size": self._task.get("data_size_stats", []),
-               "latency-set":self._task["latency"].get('percentile-latency-set', []),
-               "latency-set-recent":self._task["latency"].get('percentile-latency-set-recent', []),
-               "latency-get":self._task["latency"].get('percentile-latency-get', []),
-               "latency-get-recent":self._task["latency"].get('percentile-latency-get-recent', []),
-               "latency-delete":self._task["latency"].get('percentile-latency-delete', []),
-               "latency-delete-recent":self._task["latency"].get('percentile-latency-delete-recent', []),
+        self._stream.close()
+        histograms = {}
+        for (latency, source), histo in self._task["histograms"].items():
+            if latency in histograms:
+                histograms[latency].merge(histo)
+            else:
+                histograms[latency] = histo.copy()
+
+        extra = {"buildinfo": {},
+                 "machineinfo": {},
+                 "name": name,
+                 "time": self._task["time"],
+                 "info": test_params,
+                 "histograms": dict([(latency, histo.to_json())
+                                     for latency, histo in histograms.items()]),
         }
+        convert(self._stream.path, "{0}.json.gz".format(self._filename(name)),
+                extra, EXPORT_LISTS)
+        os.remove(self._stream.path)
 
+    def _filename(self, name):
         if self.client_id:
             filename = str(self.client_id)+'.loop'
             if re.search('load$', self._task["name"]):
                 filename = str(self.client_id)+'.load'
-            file = gzip.open("{0}.json.gz".format(filename), 'wb')
-            file.write("{0}".format(json.dumps(obj)))
-            file.close()
-        else:
-            file = gzip.open("{0}.json.gz".format(name), 'wb')
-            file.write("{0}".format(json.dumps(obj)))
-            file.close()
+            return filename
+        return name
 
     def get_bucket_size(self, bucket, rest, frequency):
-        self._task["bucket_size"] = []
-        d = []
         while not self._aborted():
             print "Collecting bucket size stats"
             status, db_size = rest.get_database_disk_size(bucket)
             if status:
-                d.append(db_size)
+                self._stream.append("bucket-size", db_size)
             else:
                 print "Enable to read bucket stats"
             time.sleep(frequency)
 
-        self._task["bucket_size"] = d
         print "finished bucket size stats"
 
     def get_data_file_size(self, nodes, frequency, bucket):
-        shells = []
-        for node in nodes:
-            try:
-                shells.append(RemoteMachineShellConnection(node))
-            except:
-                pass
+        shell = RemoteMachineShellConnection(nodes[0])
+        membase_installed = shell.is_membase_installed()
+        shell.disconnect()
         paths = []
-        if shells[0].is_membase_installed():
+        if membase_installed:
             paths.append(self.data_path+'/{0}-data'.format(bucket))
         else:
             bucket_path = self.data_path+'/{0}'.format(bucket)
@@ -171,27 +211,23 @@ class StatsCollector(object):
             view_path = bucket_path +'/set_view_{0}_design'.format(bucket)
             paths.append(view_path)
 
-        d = {"snapshots": []}
         start_time = str(self._task["time"])
 
         while not self._aborted():
             time.sleep(frequency)
             current_time = time.time()
-            i = 0
-            for shell in shells:
-                node = nodes[i]
+            sizes = ClusterShell.call_all(nodes, lambda shell: [shell.get_data_file_size(path)
+                                                                for path in paths])
+            for node, node_sizes in zip(nodes, sizes):
                 unique_id = node.ip+'-'+start_time
-                value = {}
-                for path in paths:
-                    size = shell.get_data_file_size(path)
+                for path, size in zip(paths, node_sizes):
+                    value = {}
                     value["file"] = path.split('/')[-1]
                     value["size"] = size
                     value["unique_id"] = unique_id
                     value["time"] = current_time
                     value["ip"] = node.ip
-                    d["snapshots"].append(value.copy())
-                i +=  1
-        self._task["data_size_stats"] = d["snapshots"]
+                    self._stream.append("data-size", value)
         print " finished data_size_stats"
 
     #ops stats
@@ -201,17 +237,18 @@ class StatsCollector(object):
         self._task["ops-temp"].append(ops_stat)
         if len(self._task["ops-temp"]) >= 100:
             merged = self._merge()
-            self._task["ops"].append(merged)
+            self._stream.append("ops", merged)
             self._task["ops-temp"] = []
 
-        #if self._task["ops"] has more than 1000 elements try to aggregate them ?
-
-    def latency_stats(self, latency_cmd, latency_stat):
-        if self._task["latency"].get(latency_cmd) is None:
-            self._task["latency"][latency_cmd] = []
-        temp_latency_stat = latency_stat.copy()
-        temp_latency_stat['delta'] =  time.time() - self._task['time']
-        self._task["latency"][latency_cmd].append(temp_latency_stat)
+    #latency_stat is a Histogram; a row of its percentiles is recorded
+    #now and the cumulative histograms of each source are kept for export
+    def latency_stats(self, latency_cmd, latency_stat, source=None):
+        temp = [val for _, val in latency_stat.percentiles(LATENCY_PERCENTILES)]
+        temp.append(self.client_id)
+        temp.append(time.time() - self._task['time'])
+        self._stream.append(latency_cmd, temp)
+        if not latency_cmd.endswith('-recent'):
+            self._task["histograms"][(latency_cmd, source)] = latency_stat
 
     def _merge(self):
         first = self._task["ops-temp"][0]
@@ -233,63 +270,75 @@ class StatsCollector(object):
 
     def total_stats(self, ops_stat):
         ops_stat["time"] = time.time()
-        self._task["totalops"].append(ops_stat)
+        self._stream.append("totalops", ops_stat)
 
     def build_stats(self,nodes):
         json_response = StatUtil.build_info(nodes[0])
-        self._task["buildstats"] = json_response
+        self._stream.set("buildinfo", json_response)
 
     def machine_stats(self,nodes):
         machine_stats = StatUtil.machine_info(nodes[0])
-        self._task["machinestats"] = machine_stats
+        self._stream.set("machineinfo", machine_stats)
 
     def _extract_proc_info(self, shell, pid):
         o, r = shell.execute_command("cat /proc/{0}/stat".format(pid))
-        fields = ('pid comm state ppid pgrp session tty_nr tpgid flags minflt '
-                  'cminflt majflt cmajflt utime stime cutime cstime priority '
-                  'nice num_threads itrealvalue starttime vsize rss rsslim '
-                  'startcode endcode startstack kstkesp kstkeip signal blocked '
-                  'sigignore sigcatch wchan nswap cnswap exit_signal '
-                  'processor rt_priority policy delayacct_blkio_ticks '
-                  'guest_time cguest_time ').split(' ')
-
-        d = dict(zip(fields, o[0].split(' ')))
+        d = dict(zip(PROC_STAT_FIELDS, o[0].split(' ')))
         return d
 
     def system_stats(self, nodes, pnames, frequency, verbosity=False):
-        shells = []
+        sampled = []
         for node in nodes:
             try:
                 bucket = RestConnection(node).get_buckets()[0].name
                 MemcachedClientHelper.direct_client(node, bucket)
-                shells.append(RemoteMachineShellConnection(node))
+                RemoteMachineShellConnection(node).disconnect()
+                sampled.append(node)
             except:
                 pass
-        d = {"snapshots": []}
-        #        "pname":"x","pid":"y","snapshots":[{"time":time,"value":value}]
-
+        if not sampled:
+            print " finished system_stats"
+            return
+        sampler = ProcSampler(pnames)
         start_time = str(self._task["time"])
+        # ticks are scheduled from the start, so slow samples do not make
+        # the interval drift, and every node is sampled at once and stamped
+        # with the same tick time
+        next_tick = time.time() + frequency
         while not self._aborted():
-            time.sleep(frequency)
-            current_time = time.time()
-            i = 0
-            for shell in shells:
-                node = nodes[i]
+            time.sleep(max(0, next_tick - time.time()))
+            current_time = next_tick
+            next_tick += frequency
+            while next_tick < time.time():
+                next_tick += frequency
+            try:
+                samples = ClusterShell.call_all(sampled, lambda shell: self._proc_samples(shell, sampler))
+            except BaseException as ex:
+                # BaseException, as a failed ssh login calls exit()
+                print "unable to sample /proc: {0}".format(ex)
+                continue
+            for node, sample in zip(sampled, samples):
+                if sample is None:
+                    continue
+                procs, host = sample
                 unique_id = node.ip+'-'+start_time
-                for pname in pnames:
-                    obj = RemoteMachineHelper(shell).is_process_running(pname)
-                    if obj and obj.pid:
-                        value = self._extract_proc_info(shell, obj.pid)
-                        value["name"] = pname
-                        value["id"] = obj.pid
-                        value["unique_id"] = unique_id
-                        value["time"] = current_time
-                        value["ip"] = node.ip
-                        d["snapshots"].append(value)
-                i +=  1
-        self._task["systemstats"] = d["snapshots"]
+                for value in procs:
+                    value["unique_id"] = unique_id
+                    value["time"] = current_time
+                    value["ip"] = node.ip
+                    self._stream.append("systemstats", value)
+                host["unique_id"] = unique_id
+                host["time"] = current_time
+                host["ip"] = node.ip
+                self._stream.append("hoststats", host)
         print " finished system_stats"
 
+    def _proc_samples(self, shell, sampler):
+        try:
+            return sampler.sample(shell)
+        except Exception as ex:
+            print "unable to sample /proc on {0}: {1}".format(shell.ip, ex)
+            return None
+
     def couchdb_stats(nodes):
         pass
 
@@ -301,14 +350,7 @@ class StatsCollector(object):
                 mcs.append(MemcachedClientHelper.direct_client(node, bucket))
             except:
                 pass
-        self._task["membasestats"] = []
-        self._task["timings"] = []
-        self._task["dispatcher"] = []
-        d = {}
-        #        "pname":"x","pid":"y","snapshots":[{"time":time,"value":value}]
-        for mc in mcs:
-            d[mc.host] = {"snapshots": [], "timings":[], "dispatcher":[]}
-
+        start_time = str(self._task["time"])
         while not self._aborted():
             time_left = frequency
             # at minimum we want to check for aborted every minute
@@ -316,69 +358,48 @@ class StatsCollector(object):
                 time.sleep(min(time_left, 60))
                 time_left -= 60
             for mc in mcs:
+                ip = mc.host
+                unique_id = ip+'-'+start_time
+                current_time = time.time()
                 stats = mc.stats()
-                stats["time"] = time.time()
-                stats["ip"] = mc.host
-                d[mc.host]["snapshots"].append(stats)
                 timings = mc.stats('timings')
-                d[mc.host]["timings"].append(timings)
                 dispatcher = mc.stats('dispatcher')
-                d[mc.host]["dispatcher"].append(dispatcher)
-
-        start_time = str(self._task["time"])
-        for mc in mcs:
-            ip = mc.host
-            unique_id = ip+'-'+start_time
-            current_time = time.time()
-            for snapshot in d[mc.host]["snapshots"]:
-                snapshot['unique_id'] = unique_id
-                snapshot['time'] = current_time
-                snapshot['ip'] = ip
-                self._task["membasestats"].append(snapshot)
-            for timing in d[mc.host]["timings"]:
-                timing['unique_id'] = unique_id
-                timing['time'] = current_time
-                timing['ip'] = ip
-                self._task["timings"].append(timing)
-            for dispatcher in d[mc.host]["dispatcher"]:
-                dispatcher['unique_id'] = unique_id
-                dispatcher['time'] = current_time
-                dispatcher['ip'] = ip
-                self._task["dispatcher"].append(dispatcher)
+                for key, snapshot in [("membasestats", stats),
+                                      ("timings", timings),
+                                      ("dispatcher", dispatcher)]:
+                    snapshot['unique_id'] = unique_id
+                    snapshot['time'] = current_time
+                    snapshot['ip'] = ip
+                    self._stream.append(key, snapshot)
 
         print " finished membase_stats"
 
     def ns_server_stats(self, nodes, bucket, frequency, verbose=False):
 
-        self._task["ns_server_stats"] = []
-        self._task["ns_server_stats_system"] = []
-        d = {}
-        for node in nodes:
-            d[node] = {"snapshots": [], "system_snapshots": [] }
-
         while not self._aborted():
             time.sleep(frequency)
             print "Collecting ns_server_stats"
-            for node in nodes:
-                os.system("curl -X GET http://Administrator:password@{1}:8091/pools/{0}/buckets/{0}/stats?zoom=minute -o  ns_server_data".format(bucket, node.ip))
-                #f.close()
-                dict  = open("./ns_server_data","r").read()
-                data_json = json.loads(dict)
-                d[node]["snapshots"].append(data_json)
-                os.system("curl -X GET http://Administrator:password@{1}:8091/pools/{0} -o  ns_server_data_system_stats".format(bucket, node.ip))
-                #f.close()
-                dict  = open("./ns_server_data_system_stats","r").read()
-                data_json = json.loads(dict)
-                d[node]["system_snapshots"].append(data_json)
-
-        for node in nodes:
-           for snapshot in d[node]["snapshots"]:
-               self._task["ns_server_stats"].append(snapshot)
-           for snapshot in d[node]["system_snapshots"]:
-               self._task["ns_server_stats_system"].append(snapshot)
+            # every node is asked at once, but the samples are still
+            # appended in node order
+            rest = RestConnection(nodes[0])
+            samples = rest.fan_out(range(len(nodes)),
+                                   lambda i: self._ns_server_samples(nodes[i], bucket))
+            for i in range(len(nodes)):
+                data_json, system_json = samples[i]
+                self._stream.append("ns_server_data", data_json)
+                self._stream.append("ns_server_data_system", system_json)
 
         print " finished ns_server_stats"
 
+    def _ns_server_samples(self, node, bucket):
+        rest = RestConnection(node)
+        api = rest.baseUrl + "pools/{0}/buckets/{0}/stats?zoom=minute".format(bucket)
+        status, content = rest._http_request(api)
+        data_json = json.loads(content)
+        status, content = rest._http_request(rest.baseUrl + "pools/{0}".format(bucket))
+        system_json = json.loads(content)
+        return data_json, system_json
+
     def _aborted(self):
         return self._task["state"] == "stopped"
 
@@ -0,0 +1,112 @@
+import gzip
+import json
+import tempfile
+import threading
+import time
+
+# How often the gzip stream is flushed, so a crashed run leaves a
+# readable file behind.
+FLUSH_INTERVAL = 10
+
+#appends stats samples to a gzip'ed newline-delimited json file as they
+#arrive, one {"key": ..., "value": ...} record per line, so no samples
+#are kept in memory
+class StatsStream(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'wb')
+        self.last_flush = time.time()
+
+    #appends value to the list stored under key
+    def append(self, key, value):
+        self._write({"key": key, "value": value})
+
+    #stores a single value under key, replacing any earlier one
+    def set(self, key, value):
+        self._write({"key": key, "value": value, "set": True})
+
+    def _write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(line)
+            if time.time() - self.last_flush > FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+#yields (key, value, is_set) for every record of a stats stream, stopping
+#quietly at a truncated tail left behind by a crashed run
+def read_records(path):
+    file = gzip.open(path, 'rb')
+    try:
+        while True:
+            try:
+                line = file.readline()
+            except (IOError, EOFError):
+                return
+            if not line:
+                return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            yield record["key"], record["value"], record.get("set", False)
+    finally:
+        file.close()
+
+
+#converts a stats stream into the single json document that export()
+#used to write and the R scripts read. extra holds additional top level
+#values, and every key in lists is present even when it has no samples.
+#the samples are spooled into one temporary file per key, so memory use
+#does not grow with the length of the run.
+def convert(src, dst, extra=None, lists=None):
+    singles = dict(extra or {})
+    spools = {}
+    for key in lists or []:
+        spools[key] = [tempfile.TemporaryFile(), 0]
+    for key, value, is_set in read_records(src):
+        if is_set:
+            singles[key] = value
+            continue
+        spool = spools.get(key)
+        if spool is None:
+            spool = [tempfile.TemporaryFile(), 0]
+            spools[key] = spool
+        spool[0].write(json.dumps(value) + "\n")
+        spool[1] += 1
+
+    file = gzip.open(dst, 'wb')
+    file.write("{")
+    first = True
+    for key, value in singles.items():
+        if key in spools:
+            continue
+        if not first:
+            file.write(", ")
+        first = False
+        file.write("{0}: {1}".format(json.dumps(key), json.dumps(value)))
+    for key, (spool, count) in spools.items():
+        if not first:
+            file.write(", ")
+        first = False
+        file.write("{0}: [".format(json.dumps(key)))
+        spool.seek(0)
+        for i in range(count):
+            if i:
+                file.write(", ")
+            file.write(spool.readline()[:-1])
+        file.write("]")
+        spool.close()
+    file.write("}")
+    file.close()
@@ -20,6 +20,8 @@ CMD_GETQ = 9
 CMD_NOOP = 10
 CMD_VERSION = 11
 CMD_STAT = 0x10
+CMD_SETQ = 0x11
+CMD_DELETEQ = 0x14
 CMD_APPEND = 0x0e
 CMD_PREPEND = 0x0f
 CMD_TOUCH = 0x1c
@@ -9,14 +9,16 @@ from TestInput import TestInputServer
 from TestInput import TestInputSingleton
 import logger
 import crc32
+import itertools
+import select
 import threading
 from mc_bin_client import MemcachedClient, MemcachedError
+from memcacheConstants import ERR_NOT_FOUND
 from mc_ascii_client import MemcachedAsciiClient
 from membase.api.rest_client import RestConnection, RestHelper
 import json
 import sys
 sys.path.append('./pytests/performance/')
-import mcsoda
 
 
 class MemcachedClientHelperExcetion(Exception):
@@ -172,7 +174,7 @@ class MemcachedClientHelper(object):
                                         moxi=True,
                                         delete_ratio=0,
                                         expiry_ratio=0):
-        inserted_keys = []
+        inserted_keys = KeySpace()
         rejected_keys = []
         log = logger.Logger.get_logger()
         threads = MemcachedClientHelper.create_threads(servers,
@@ -348,22 +350,20 @@ class MutationThread(threading.Thread):
                 {"name": "user-${prefix}", "payload": "memcached-json-${prefix}-${padding}",
                  "size": 1024, "seed": self.seed})
         client = MemcachedClientHelper.proxy_client(self.serverInfo, self.name)
-        counter = 0
-        for value in values:
+        for key, value in itertools.izip(self.keys, values):
             try:
                 if self.op == "set":
-                    client.set(self.keys[counter], 0, 0, value)
+                    client.set(key, 0, 0, value)
                     self._mutated_count += 1
             except MemcachedError:
                 self._rejected_count += 1
-                self._rejected_keys.append({"key": self.keys[counter], "value": value})
+                self._rejected_keys.append({"key": key, "value": value})
             except Exception as e:
-                self.log.info("unable to mutate {0} due to {1}".format(self.keys[counter], e))
+                self.log.info("unable to mutate {0} due to {1}".format(key, e))
                 self._rejected_count += 1
-                self._rejected_keys.append({"key": self.keys[counter], "value": value})
+                self._rejected_keys.append({"key": key, "value": value})
                 client.close()
                 client = MemcachedClientHelper.proxy_client(self.serverInfo, self.name)
-            counter = counter + 1
         self.log.info("mutation failed {0} times".format(self._rejected_count))
         client.close()
 
@@ -422,6 +422,94 @@ class ReaderThread(object):
         client.close()
 
 
+class KeySpace(object):
+    """Compact description of a set of loaded keys.
+
+    Generated keys are kept as (prefix, size, start, stop) ranges, which
+    stand for the keys "prefix-size-i" with start <= i < stop, minus the
+    rejected ones. Any other keys are kept as a plain list. The keys are
+    generated on the fly when iterated, so a KeySpace can be passed
+    wherever a list of keys is read."""
+
+    def __init__(self, ranges=None, rejected=None, keys=None):
+        self.ranges = [tuple(r) for r in ranges or []]
+        self.rejected = set(rejected or [])
+        self.keys = list(keys or [])
+
+    def add_range(self, prefix, size, start, stop):
+        if stop > start:
+            self.ranges.append((str(prefix), size, start, stop))
+
+    def reject(self, key):
+        self.rejected.add(key)
+
+    # A KeySpace is merged range by range, anything else is taken as an
+    # iterable of keys.
+    def extend(self, other):
+        if isinstance(other, KeySpace):
+            self.ranges.extend(other.ranges)
+            self.rejected.update(other.rejected)
+            self.keys.extend(other.keys)
+        else:
+            self.keys.extend(other)
+
+    def __iter__(self):
+        rejected = self.rejected
+        for prefix, size, start, stop in self.ranges:
+            fmt = "{0}-{1}-".format(prefix, size) + "{0}"
+            for i in xrange(start, stop):
+                key = fmt.format(i)
+                if key not in rejected:
+                    yield key
+        for key in self.keys:
+            yield key
+
+    def __len__(self):
+        count = sum([stop - start for prefix, size, start, stop in self.ranges])
+        count -= len([key for key in self.rejected if self._in_ranges(key)])
+        return count + len(self.keys)
+
+    def __contains__(self, key):
+        if key in self.rejected:
+            return False
+        return self._in_ranges(key) or key in self.keys
+
+    def _in_ranges(self, key):
+        try:
+            prefix, size, i = key.rsplit("-", 2)
+            i = int(i)
+        except ValueError:
+            return False
+        for r_prefix, r_size, start, stop in self.ranges:
+            if r_prefix == prefix and str(r_size) == size and start <= i < stop:
+                return True
+        return False
+
+    def dump(self, path):
+        file = open(path, "w")
+        try:
+            json.dump({"ranges": self.ranges,
+                       "rejected": sorted(self.rejected),
+                       "keys": self.keys}, file)
+        finally:
+            file.close()
+
+    @staticmethod
+    def load(path):
+        file = open(path)
+        try:
+            obj = json.load(file)
+        finally:
+            file.close()
+        return KeySpace([(str(prefix), size, start, stop) for prefix, size, start, stop in obj["ranges"]],
+                        [str(key) for key in obj["rejected"]],
+                        [str(key) for key in obj["keys"]])
+
+    def __repr__(self):
+        return "<KeySpace ranges={0} rejected={1} keys={2}>".format(
+            len(self.ranges), len(self.rejected), len(self.keys))
+
+
 #mutation ? let' do two cycles , first run and then try to mutate all those itesm
 #and return
 class WorkerThread(threading.Thread):
@@ -476,21 +564,14 @@ class WorkerThread(threading.Thread):
     def rejected_keys_count(self):
         return self._rejected_keys_count
 
-    #smart functin that gives you sth you can use to
-    #get inserted keys
-    #we should just expose an iterator instead which
-    #generates the key,values on fly
+    #returns the inserted keys as a KeySpace, which generates the keys
+    #on the fly, and the rejected items
     def keys_set(self):
-        #let's construct the inserted keys set
-        #TODO: hard limit , let's only populated up to 1 million keys
-        inserted_keys = []
+        inserted_keys = KeySpace()
         for item in self._value_list_copy:
-            for i in range(0, (int(item['how_many']))):
-                key = "{0}-{1}-{2}".format(self._base_uuid, item['size'], i)
-                if key not in self._rejected_keys:
-                    inserted_keys.append(key)
-                if len(inserted_keys) > 2 * 1024 * 1024:
-                    break
+            inserted_keys.add_range(self._base_uuid, item['size'], 0, int(item['how_many']))
+        for item in self._rejected_keys:
+            inserted_keys.reject(item["key"])
         return inserted_keys, self._rejected_keys
 
     def run(self):
@@ -589,11 +670,11 @@ class WorkerThread(threading.Thread):
                 if not self.moxi:
                     awareness.done()
                     try:
-                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name)
+                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name, max_age=0)
                     except Exception:
                         #vbucket map is changing . sleep 5 seconds
                         time.sleep(5)
-                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name)
+                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name, max_age=0)
                     self.log.info("now connected to {0} memcacheds".format(len(awareness.memcacheds)))
                     if isinstance(self.serverInfo, dict):
                         self.log.error(
@@ -618,9 +699,9 @@ class WorkerThread(threading.Thread):
                 if not self.moxi:
                     awareness.done()
                     try:
-                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name)
+                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name, max_age=0)
                     except Exception:
-                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name)
+                        awareness = VBucketAwareMemcached(RestConnection(self.serverInfo), self.name, max_age=0)
                     self.log.info("now connected to {0} memcacheds".format(len(awareness.memcacheds)))
                 if isinstance(self.serverInfo, dict):
                     self.log.error("error {0} from {1}".format(ex, self.serverInfo["ip"]))
@@ -683,65 +764,178 @@ class WorkerThread(threading.Thread):
         return self.aborted or len(self._rejected_keys) > self.ignore_how_many_errors
 
 
+class VBucketMapCache(object):
+    """Process-wide vbucket map and connection pool of one bucket.
+
+    All VBucketAwareMemcached instances of a (cluster, bucket) share one
+    cache, so the map is fetched once per refresh instead of once per
+    instance, and connections are leased out of the pool instead of
+    being opened (and SASL authenticated) per instance. A lease is
+    exclusive until it is returned with release()."""
+
+    # Maps younger than this are reused instead of being fetched again,
+    # unless the caller just got a NOT_MY_VBUCKET and asks for max_age=0.
+    MAX_AGE = 2
+
+    _lock = threading.Lock()
+    _caches = {}
+
+    @staticmethod
+    def get(rest, bucket):
+        key = (rest.ip, rest.port, bucket)
+        VBucketMapCache._lock.acquire()
+        try:
+            cache = VBucketMapCache._caches.get(key)
+            if cache is None:
+                cache = VBucketMapCache(bucket)
+                VBucketMapCache._caches[key] = cache
+            return cache
+        finally:
+            VBucketMapCache._lock.release()
+
+    def __init__(self, bucket):
+        self.log = logger.Logger.get_logger()
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.version = 0
+        self.fetched = 0
+        self.vBucketMap = {}
+        self.vBucketMapReplica = {}
+        self.servers = {}
+        self.generations = {}
+        self.idle = {}
+        self.bucket_info = None
+
+    def refresh(self, rest, seen_version=None, max_age=0):
+        """Fetches the map again, unless another thread already did since
+        seen_version or the map is younger than max_age seconds. Pooled
+        connections are dropped only for servers whose node changed."""
+        self.lock.acquire()
+        try:
+            if seen_version is not None and seen_version != self.version:
+                return
+            if self.version and time.time() - self.fetched < max_age:
+                return
+            vb_ready = RestHelper(rest).vbucket_map_ready(self.bucket, 60)
+            if not vb_ready:
+                raise Exception("vbucket map is not ready for bucket {0}".format(self.bucket))
+            vBuckets = rest.get_vbuckets(self.bucket)
+            nodes = rest.get_nodes()
+            self.bucket_info = rest.get_bucket(self.bucket)
+
+            vBucketMap = {}
+            vBucketMapReplica = {}
+            servers = {}
+            for vBucket in vBuckets:
+                vBucketMap[vBucket.id] = vBucket.master
+                vBucketMapReplica[vBucket.id] = vBucket.replica
+                for server_str in [vBucket.master] + vBucket.replica:
+                    if server_str in servers or ":" not in server_str:
+                        continue
+                    serverIp = server_str.split(":")[0]
+                    serverPort = int(server_str.split(":")[1])
+                    for node in nodes:
+                        if node.ip == serverIp and node.memcached == serverPort:
+                            servers[server_str] = (serverIp, serverPort, node.port)
+                            break
+
+            for server_str in self.servers:
+                if servers.get(server_str) != self.servers[server_str]:
+                    self._invalidate(server_str)
+            self.vBucketMap = vBucketMap
+            self.vBucketMapReplica = vBucketMapReplica
+            self.servers = servers
+            self.version += 1
+            self.fetched = time.time()
+        finally:
+            self.lock.release()
+
+    def _invalidate(self, server_str):
+        self.generations[server_str] = self.generations.get(server_str, 0) + 1
+        for client in self.idle.pop(server_str, []):
+            client.close()
+
+    def lease(self, server_str):
+        """Returns a (client, generation) connection to server_str."""
+        self.lock.acquire()
+        try:
+            generation = self.generations.get(server_str, 0)
+            idle = self.idle.get(server_str, [])
+            while idle:
+                client = idle.pop()
+                # An idle connection has nothing to read, unless the
+                # server closed it while it sat in the pool.
+                readable, _, _ = select.select([client.s], [], [], 0)
+                if not readable and client.rstart == client.rend:
+                    return client, generation
+                client.close()
+            serverIp, serverPort, restPort = self.servers[server_str]
+            bucket_info = self.bucket_info
+            vbucket_count = len(self.vBucketMap)
+        finally:
+            self.lock.release()
+
+        self.log.info("creating direct client {0}:{1} {2}".format(serverIp, serverPort, self.bucket))
+        client = MemcachedClient(serverIp, serverPort)
+        client.vbucket_count = vbucket_count
+        client.sasl_auth_plain(bucket_info.name.encode('ascii'),
+                               bucket_info.saslPassword.encode('ascii'))
+        return client, generation
+
+    def release(self, server_str, client, generation):
+        """Returns a leased connection to the pool, or closes it when its
+        server was invalidated in the meantime."""
+        self.lock.acquire()
+        try:
+            if generation == self.generations.get(server_str, 0) and \
+               server_str in self.servers:
+                self.idle.setdefault(server_str, []).append(client)
+                return
+        finally:
+            self.lock.release()
+        client.close()
+
+
 class VBucketAwareMemcached(object):
-    def __init__(self, rest, bucket, info=None):
+    # max_age=0 fetches the map again, e.g. after a NOT_MY_VBUCKET reply
+    def __init__(self, rest, bucket, info=None, max_age=VBucketMapCache.MAX_AGE):
         self.log = logger.Logger.get_logger()
         self.info = info
         self.bucket = bucket
         self.memcacheds = {}
         self.vBucketMap = {}
         self.vBucketMapReplica = {}
-        self.reset(rest)
-
+        self.cache = VBucketMapCache.get(rest, bucket)
+        self.version = None
+        self.generations = {}
+        self.cache.refresh(rest, max_age=max_age)
+        self._lease_all()
+
+    # reset() follows errors, which may leave replies in flight on our
+    # connections, so they are closed rather than pooled.
     def reset(self, rest=None):
-        m, v, r = self.request_map(rest or RestConnection(self.info), self.bucket)
-        self.memcacheds = m
-        self.vBucketMap = v
-        self.vBucketMapReplica = r
-
-    def request_map(self, rest, bucket):
-        memcacheds = {}
-        vBucketMap = {}
-        vBucketMapReplica = {}
-        vb_ready = RestHelper(rest).vbucket_map_ready(bucket, 60)
-        if not vb_ready:
-            raise Exception("vbucket map is not ready for bucket {0}".format(bucket))
-        vBuckets = rest.get_vbuckets(bucket)
-        for vBucket in vBuckets:
-            vBucketMap[vBucket.id] = vBucket.master
-            self.add_memcached(vBucket.master, memcacheds, rest, bucket)
-
-            vBucketMapReplica[vBucket.id] = vBucket.replica
-            for replica in vBucket.replica:
-                self.add_memcached(replica, memcacheds, rest, bucket)
-        return memcacheds, vBucketMap, vBucketMapReplica
-
-    def add_memcached(self, server_str, memcacheds, rest, bucket):
-        if not server_str in memcacheds:
-            serverIp = server_str.split(":")[0]
-            serverPort = int(server_str.split(":")[1])
-            nodes = rest.get_nodes()
-
-            server = TestInputServer()
-            server.ip = serverIp
-            server.port = rest.port
-            server.rest_username = rest.username
-            server.rest_password = rest.password
-            try:
-                for node in nodes:
-                    if node.ip == serverIp and node.memcached == serverPort:
-                        server.port = node.port
-                        memcacheds[server_str] =\
-                            MemcachedClientHelper.direct_client(server, bucket)
-                        break
-            except Exception as ex:
-                msg = "unable to establish connection to {0}.cleanup open connections"
-                self.log.warn(msg.format(serverIp))
-                self.done()
-                raise ex
+        self.cache.refresh(rest or RestConnection(self.info), self.version)
+        self.done()
+        self._lease_all()
+
+    def _lease_all(self):
+        cache = self.cache
+        self.version = cache.version
+        self.vBucketMap = cache.vBucketMap
+        self.vBucketMapReplica = cache.vBucketMapReplica
+        try:
+            for server_str in cache.servers:
+                client, generation = cache.lease(server_str)
+                self.memcacheds[server_str] = client
+                self.generations[server_str] = generation
+        except Exception as ex:
+            msg = "unable to establish connection to {0}.cleanup open connections"
+            self.log.warn(msg.format(server_str))
+            self.done()
+            raise ex
 
     def memcached(self, key, replica_index=None):
-        vBucketId = crc32.crc32_hash(key) & (len(self.vBucketMap) - 1)
+        vBucketId = crc32.vbucket_id(key, len(self.vBucketMap))
         if replica_index is None:
             return self.memcached_for_vbucket(vBucketId)
         else:
@@ -766,14 +960,156 @@ class VBucketAwareMemcached(object):
         return self.memcacheds[self.vBucketMapReplica[vBucketId][replica_index]]
 
     def not_my_vbucket_memcached(self, key):
-        vBucketId = crc32.crc32_hash(key) & (len(self.vBucketMap) - 1)
+        vBucketId = crc32.vbucket_id(key, len(self.vBucketMap))
         which_mc = self.vBucketMap[vBucketId]
         for server in self.memcacheds:
             if server != which_mc:
                 return self.memcacheds[server]
 
-    def done(self):
-        [self.memcacheds[ip].close() for ip in self.memcacheds]
+    # closes the connections. pool=True returns them to the shared pool
+    # instead, which is only safe when every reply has been read, e.g.
+    # not after an error or an unanswered send_set()
+    def done(self, pool=False):
+        for server_str, client in self.memcacheds.items():
+            if pool:
+                self.cache.release(server_str, client,
+                                   self.generations.get(server_str, 0))
+            else:
+                client.close()
+        self.memcacheds = {}
+        self.generations = {}
+
+
+class VerificationReport(object):
+    """Outcome of a KeyVerifier run.
+
+    failed maps each key that did not verify to its last memcached
+    status (0 when the key was found but failed the check) and a reason.
+    vbuckets counts the failed keys per vbucket."""
+
+    def __init__(self, total):
+        self.total = total
+        self.failed = {}
+        self.vbuckets = {}
+        self.attempts = 0
+
+    def ok(self):
+        return not self.failed
+
+    def log_failures(self, log, limit=100):
+        for key, (status, reason) in itertools.islice(self.failed.iteritems(), limit):
+            log.error("key {0} : {1} (status {2})".format(key, reason, status))
+        if self.vbuckets:
+            log.error("failed keys per vbucket : {0}".format(self.vbuckets))
+
+    def __repr__(self):
+        return "<VerificationReport total={0} failed={1} attempts={2}>".format(
+            self.total, len(self.failed), self.attempts)
+
+
+class KeyVerifier(object):
+    """Verifies many keys at once against the servers that own them.
+
+    Keys are hashed to vbuckets in bulk and grouped by master server;
+    every server then gets its own thread streaming pipelined GETQ/NOOP
+    windows (MemcachedClient.get_multi) over a pooled connection. Keys
+    that fail are retried, after a vbucket map refresh, up to retries
+    more times; keys that verified are never fetched again."""
+
+    def __init__(self, server, bucket="default", window=1024,
+                 retries=0, retry_sleep=1):
+        self.log = logger.Logger.get_logger()
+        self.server = server
+        self.bucket = bucket
+        self.window = window
+        self.retries = retries
+        self.retry_sleep = retry_sleep
+
+    # check(key, flags, value) returns None when the value is right, or
+    # a reason string. With missing=True the keys are expected not to
+    # exist, and any key that does is a failure.
+    def verify(self, keys, check=None, missing=False):
+        report = VerificationReport(len(keys))
+        rest = RestConnection(self.server)
+        awareness = VBucketAwareMemcached(rest, self.bucket)
+        # connections that failed in the middle of a get_multi may still
+        # have responses on the wire, they must not go back to the pool
+        broken = True
+        try:
+            pending = keys
+            while True:
+                report.attempts += 1
+                io_errors = []
+                failed = self._verify_once(awareness, pending, check, missing, io_errors)
+                if not failed or report.attempts > self.retries:
+                    break
+                msg = "attempt #{0} : {1} of {2} keys left to verify"
+                self.log.info(msg.format(report.attempts, len(failed), report.total))
+                time.sleep(self.retry_sleep)
+                # closes the connections in use
+                awareness.reset(rest)
+                pending = failed.keys()
+            report.failed = failed
+            vbucket_count = len(awareness.vBucketMap)
+            for vbucket in crc32.crc32_hash_many(failed.keys(), vbucket_count):
+                report.vbuckets[vbucket] = report.vbuckets.get(vbucket, 0) + 1
+            broken = bool(io_errors)
+        finally:
+            awareness.done(pool=not broken)
+        return report
+
+    def _verify_once(self, awareness, keys, check, missing, io_errors):
+        groups = {}
+        vbucket_ids = crc32.crc32_hash_many(keys, len(awareness.vBucketMap))
+        for key, vbucket in itertools.izip(keys, vbucket_ids):
+            groups.setdefault(awareness.vBucketMap.get(vbucket), []).append(key)
+
+        failed = {}
+        threads = []
+        for server_str, server_keys in groups.iteritems():
+            client = awareness.memcacheds.get(server_str)
+            if client is None:
+                reason = "no connection to vbucket master {0}".format(server_str)
+                for key in server_keys:
+                    failed[key] = (None, reason)
+                continue
+            results = {}
+            t = threading.Thread(target=self._verify_server,
+                                 name="verify-{0}".format(server_str),
+                                 args=(client, server_keys, check, missing, results, io_errors))
+            t.start()
+            threads.append((t, results))
+        for t, results in threads:
+            t.join()
+            failed.update(results)
+        return failed
+
+    def _verify_server(self, client, keys, check, missing, failed, io_errors):
+        for start in xrange(0, len(keys), self.window):
+            chunk = keys[start:start + self.window]
+            try:
+                responses = client.get_multi(chunk, window=self.window)
+                for key, (status, flags, cas, value) in responses.iteritems():
+                    if missing:
+                        if status == 0:
+                            failed[key] = (status, "key should not exist")
+                        elif status != ERR_NOT_FOUND:
+                            failed[key] = (status, value)
+                    elif status:
+                        failed[key] = (status, value or "key not found")
+                    elif check:
+                        reason = check(key, flags, value)
+                        if reason:
+                            failed[key] = (status, reason)
+            except Exception as ex:
+                # Whatever went wrong, from a broken connection to a garbled
+                # reply or a failing check(), the connection is in an unknown
+                # state; report the rest of the keys and let the retry
+                # reconnect, rather than let them pass unchecked.
+                io_errors.append(ex)
+                for key in keys[start:]:
+                    failed[key] = (None, "{0}: {1}".format(ex.__class__.__name__, ex))
+                return
 
 
 def start_reader_process(info, keyset, queue):
@@ -781,12 +1117,23 @@ def start_reader_process(info, keyset, queue):
 
 
 class GeneratedDocuments(object):
+    """Iterator over items json documents built from kv_template.
+
+    The template is compiled once into a %-format string, where every
+    ${prefix} is a %d slot and ${padding} and ${seed} are already
+    substituted, so a document is a single string formatting operation.
+    The output is byte for byte what json.dumps() of the document dict
+    gives. Documents can be generated out of order with doc(i) or seek(),
+    so parallel workers can each produce a disjoint range."""
+
     def __init__(self, items, kv_template, options=dict(size=1024)):
         self._items = items
         self._kv_template = kv_template
         self._options = options
         self._pointer = 0
         self._pad = DocumentGenerator._random_string(options["size"])
+        self._format = None
+        self._slots = 0
 
     # Required for the for-in syntax
     def __iter__(self):
@@ -795,25 +1142,63 @@ class GeneratedDocuments(object):
     def __len__(self):
         return self._items
 
+    def _compile(self):
+        seed = "{0}".format(self._options["seed"])
+        fields = {"_id": None}
+        templated = {"_id": ["", "-" + seed]}
+        for k in self._kv_template:
+            v = self._kv_template[k]
+            fields[k] = v
+            if isinstance(v, str):
+                templated[k] = [part.replace("${padding}", self._pad).replace("${seed}", seed)
+                                for part in v.split("${prefix}")]
+            else:
+                templated.pop(k, None)
+        # Every document has the same keys, inserted in the same order, so
+        # they all serialize in the order of this dict.
+        fragments = []
+        slots = 0
+        for k in fields:
+            v = fields[k]
+            fragments.append(json.dumps({k: 0})[1:-2].replace("%", "%%"))
+            if k in templated:
+                parts = [json.dumps(part)[1:-1].replace("%", "%%") for part in templated[k]]
+                fragments.append('"' + "%d".join(parts) + '"')
+                slots += len(parts) - 1
+            else:
+                fragments.append(json.dumps(v).replace("%", "%%"))
+        self._format = "{" + ", ".join([fragments[j] + fragments[j + 1]
+                                        for j in range(0, len(fragments), 2)]) + "}"
+        self._slots = slots
+
+    def doc(self, i):
+        """Returns document i, without moving the iterator."""
+        if self._format is None:
+            self._compile()
+        return self._format % ((i,) * self._slots)
+
+    def seek(self, i):
+        self._pointer = max(0, min(i, self._items))
+
     # Returns the next value of the iterator
     def next(self):
         if self._pointer == self._items:
             raise StopIteration
-        else:
-            i = self._pointer
-            doc = {"_id": "{0}-{1}".format(i, self._options["seed"])}
-            for k in self._kv_template:
-                v = self._kv_template[k]
-                if isinstance(v, str) and v.find("${prefix}") != -1:
-                    v = v.replace("${prefix}", "{0}".format(i))
-                    #how about the value size
-                if isinstance(v, str) and v.find("${padding}") != -1:
-                    v = v.replace("${padding}", self._pad)
-                if isinstance(v, str) and v.find("${seed}") != -1:
-                    v = v.replace("${seed}", "{0}".format(self._options["seed"]))
-                doc[k] = v
+        doc = self.doc(self._pointer)
         self._pointer += 1
-        return json.dumps(doc)
+        return doc
+
+    def next_batch(self, n):
+        """Returns a list of up to the next n documents, which is empty
+        once the iterator is exhausted."""
+        if self._format is None:
+            self._compile()
+        start = self._pointer
+        end = min(start + n, self._items)
+        fmt = self._format
+        slots = self._slots
+        self._pointer = end
+        return [fmt % ((i,) * slots) for i in xrange(start, end)]
 
 
 class DocumentGenerator(object):
@@ -897,5 +1282,7 @@ class LoadWithMcsoda(object):
         return self.cfg
 
     def load_data(self):
+        # mcsoda is only needed by the loaders that use it
+        import mcsoda
         cur, start_time, end_time = mcsoda.run(self.cfg, {}, self.protocol, self.host_port, self.user, self.pswd)
         return cur
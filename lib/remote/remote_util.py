@@ -1,10 +1,9 @@
 import os
 import sys
+import threading
 import uuid
-import paramiko
 import logger
 import time
-from builds.build_query import BuildQuery
 import testconstants
 
 log = logger.Logger.get_logger()
@@ -72,6 +71,14 @@ class RemoteMachineHelper(object):
 
 class RemoteMachineShellConnection:
     _ssh_client = None
+    # ssh clients given back by disconnect(), per (ip, ssh username), are
+    # handed to the next connection to the same host instead of logging in
+    # again
+    MAX_IDLE = 4
+    _lock = threading.Lock()
+    _idle_clients = {}
+    # extract_remote_info() per ip, a machine does not change during a run
+    _remote_infos = {}
 
     def __init__(self, username='root',
                  pkey_location='',
@@ -80,6 +87,8 @@ class RemoteMachineShellConnection:
         self.use_sudo = True
         if self.username == 'root':
            self.use_sudo = False
+        # paramiko is slow to import, only load it to connect
+        import paramiko
         #let's create a connection
         self._ssh_client = paramiko.SSHClient()
         self.ip = ip
@@ -103,8 +112,14 @@ class RemoteMachineShellConnection:
         self.use_sudo = True
         if self.username == 'root':
            self.use_sudo = False
-        self._ssh_client = paramiko.SSHClient()
         self.ip = serverInfo.ip
+        self._pool_key = (serverInfo.ip, serverInfo.ssh_username)
+        self._ssh_client = self._lease_client()
+        if self._ssh_client is not None:
+            return
+        # paramiko is slow to import, only load it to connect
+        import paramiko
+        self._ssh_client = paramiko.SSHClient()
         self._ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         msg = 'connecting to {0} with username : {1} password : {2} ssh_key: {3}'
         log.info(msg.format(serverInfo.ip, serverInfo.ssh_username, serverInfo.ssh_password, serverInfo.ssh_key))
@@ -127,6 +142,32 @@ class RemoteMachineShellConnection:
             exit(1)
         log.info("Connected")
 
+    def _lease_client(self):
+        RemoteMachineShellConnection._lock.acquire()
+        try:
+            idle = RemoteMachineShellConnection._idle_clients.get(self._pool_key, [])
+            while idle:
+                client = idle.pop()
+                transport = client.get_transport()
+                if transport and transport.is_active():
+                    return client
+                client.close()
+            return None
+        finally:
+            RemoteMachineShellConnection._lock.release()
+
+    @staticmethod
+    def close_all():
+        """Closes the idle ssh clients of every host."""
+        RemoteMachineShellConnection._lock.acquire()
+        try:
+            for idle in RemoteMachineShellConnection._idle_clients.values():
+                for client in idle:
+                    client.close()
+            RemoteMachineShellConnection._idle_clients = {}
+        finally:
+            RemoteMachineShellConnection._lock.release()
+
     def get_running_processes(self):
         #if its linux ,then parse each line
         #26989 ?        00:00:51 pdflush
@@ -788,6 +829,8 @@ bOpt2=0' > /cygdrive/c/automation/css_win2k8_64_uninstall.iss"
         type = info.distribution_type.lower()
         if type == 'windows':
             product = "cb"
+            # BuildQuery pulls in BeautifulSoup, only import it when needed
+            from builds.build_query import BuildQuery
             query = BuildQuery()
             builds, changes = query.get_all_builds()
             os_type = "exe"
@@ -912,6 +955,8 @@ bOpt2=0' > /cygdrive/c/automation/css_win2k8_64_uninstall.iss"
         type = info.distribution_type.lower()
         if type == 'windows':
             product = "mb"
+            # BuildQuery pulls in BeautifulSoup, only import it when needed
+            from builds.build_query import BuildQuery
             query = BuildQuery()
             builds, changes = query.get_all_builds()
             os_type = "exe"
@@ -1034,6 +1079,34 @@ bOpt2=0' > /cygdrive/c/automation/css_win2k8_64_uninstall.iss"
         stderro.close()
         return output, error
 
+    def execute_command_status(self, command, debug=True):
+        """Like execute_command(), but also returns the exit status."""
+        info = getattr(self, "info", None)
+        if info is None:
+            info = self.extract_remote_info()
+            self.info = info
+
+        if info.type.lower() == 'windows':
+            self.use_sudo = False
+
+        if self.use_sudo:
+            command = "sudo " + command
+        if debug:
+            log.info("running command.raw  {0}".format(command))
+        channel = self._ssh_client.get_transport().open_session()
+        if self.use_sudo:
+            channel.get_pty()
+        channel.exec_command(command)
+        stdout = channel.makefile('rb')
+        stderro = channel.makefile_stderr('rb')
+        output = stdout.read().splitlines()
+        error = stderro.read().splitlines()
+        status = channel.recv_exit_status()
+        stdout.close()
+        stderro.close()
+        channel.close()
+        return output, error, status
+
     def terminate_process(self, info=None, process_name=''):
         if info is None:
             info = self.extract_remote_info()
@@ -1044,10 +1117,31 @@ bOpt2=0' > /cygdrive/c/automation/css_win2k8_64_uninstall.iss"
             o, r = self.execute_command("killall -9 {0}".format(process_name))
             self.log_command_output(o, r)
 
+    # the ssh client goes back to the pool, see _lease_client()
     def disconnect(self):
-        self._ssh_client.close()
+        client, self._ssh_client = self._ssh_client, None
+        if client is None:
+            return
+        transport = client.get_transport()
+        if transport and transport.is_active():
+            RemoteMachineShellConnection._lock.acquire()
+            try:
+                idle = RemoteMachineShellConnection._idle_clients.setdefault(self._pool_key, [])
+                if len(idle) < self.MAX_IDLE:
+                    idle.append(client)
+                    return
+            finally:
+                RemoteMachineShellConnection._lock.release()
+        client.close()
 
     def extract_remote_info(self):
+        info = RemoteMachineShellConnection._remote_infos.get(self.ip)
+        if info is None:
+            info = self._extract_remote_info()
+            RemoteMachineShellConnection._remote_infos[self.ip] = info
+        return info
+
+    def _extract_remote_info(self):
         #use ssh to extract remote machine info
         #use sftp to if certain types exists or not
         sftp = self._ssh_client.open_sftp()
@@ -1221,3 +1315,67 @@ bOpt2=0' > /cygdrive/c/automation/css_win2k8_64_uninstall.iss"
                     return size[0]
                 else:
                     return 0
+
+
+class RemoteCommandResult(object):
+    def __init__(self, ip):
+        self.ip = ip
+        self.output = []
+        self.error = []
+        self.exit_status = None
+        # seconds
+        self.elapsed = 0
+        self.exception = None
+
+
+class ClusterShell(object):
+    """Runs the same work on many servers at once, one thread and one
+    pooled RemoteMachineShellConnection per server."""
+
+    @staticmethod
+    def call_all(servers, function):
+        """Calls function(shell) for every server and returns the results in
+        the order of servers. If any call raised, the first exception is
+        raised again once all calls are over."""
+        results = [None] * len(servers)
+        errors = []
+
+        def call(i):
+            try:
+                shell = RemoteMachineShellConnection(servers[i])
+                try:
+                    results[i] = function(shell)
+                finally:
+                    shell.disconnect()
+            except BaseException:
+                # BaseException, as a failed login calls exit()
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=call, args=(i,),
+                                    name="ssh-{0}".format(server.ip))
+                   for i, server in enumerate(servers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    @staticmethod
+    def run_all(servers, command, debug=False):
+        """Runs command on every server and returns a RemoteCommandResult
+        per server, in the order of servers. A command that could not be run
+        has its exception set instead of an exit status."""
+        def run(shell):
+            result = RemoteCommandResult(shell.ip)
+            start = time.time()
+            try:
+                result.output, result.error, result.exit_status = \
+                    shell.execute_command_status(command, debug=debug)
+            except Exception as ex:
+                result.exception = ex
+            result.elapsed = time.time() - start
+            return result
+
+        return ClusterShell.call_all(servers, run)
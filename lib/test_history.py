@@ -0,0 +1,102 @@
+import json
+import os
+import time
+
+# Runs kept per test.
+MAX_RUNS = 20
+
+# A run regresses when it takes REGRESSION_FACTOR times the usual time of
+# the test and at least REGRESSION_MIN_SECONDS more, with at least
+# REGRESSION_MIN_RUNS earlier passing runs to compare against.
+REGRESSION_FACTOR = 1.5
+REGRESSION_MIN_SECONDS = 30
+REGRESSION_MIN_RUNS = 3
+
+#
+# TestHistory keeps the duration and result of the last MAX_RUNS runs of
+# every test in a json file, keyed by the test name as given in the
+# runlist, parameters included
+#
+class TestHistory(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.tests = {}
+        if os.path.exists(path):
+            try:
+                self.tests = json.load(open(path))
+            except ValueError:
+                print "ignoring unreadable test history {0}".format(path)
+
+    # records a run and saves the history right away, so a run that dies
+    # half way still counts
+    def record(self, name, result, duration):
+        runs = self.tests.setdefault(name, [])
+        runs.append({"result": result, "time": duration, "at": time.time()})
+        del runs[:-MAX_RUNS]
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        tmp_file = open(tmp_path, "w")
+        json.dump(self.tests, tmp_file)
+        tmp_file.close()
+        os.rename(tmp_path, self.path)
+
+    # median duration of the passing runs of name, or None. failed runs
+    # often stop early, so they only count when nothing passed.
+    def estimate(self, name):
+        runs = self.tests.get(name)
+        if not runs:
+            return None
+        times = [run["time"] for run in runs if run["result"] == "pass"] or \
+                [run["time"] for run in runs]
+        return _median(times)
+
+    def is_flaky(self, name):
+        results = set([run["result"] for run in self.tests.get(name, [])])
+        return len(results) > 1
+
+    # returns the usual duration of name if duration is a regression
+    # against it, None otherwise
+    def regression(self, name, duration):
+        times = [run["time"] for run in self.tests.get(name, []) if run["result"] == "pass"]
+        if len(times) < REGRESSION_MIN_RUNS:
+            return None
+        usual = _median(times)
+        if duration > usual * REGRESSION_FACTOR and duration - usual > REGRESSION_MIN_SECONDS:
+            return usual
+        return None
+
+    # longest first, so the last tests to finish on each of several
+    # clusters are short ones. tests never run before go first, they may
+    # be long.
+    def order(self, names):
+        unknown = [name for name in names if self.estimate(name) is None]
+        known = [name for name in names if self.estimate(name) is not None]
+        known.sort(key=self.estimate, reverse=True)
+        return unknown + known
+
+    # returns (seconds, number of tests without history) for running names
+    # on the given number of clusters, in the order() order. tests without
+    # history are assumed to take the median of the others.
+    def eta(self, names, clusters=1):
+        estimates = [self.estimate(name) for name in names]
+        known = [estimate for estimate in estimates if estimate is not None]
+        default = _median(known) if known else 0
+        finish = [0] * clusters
+        for name in self.order(names):
+            estimate = self.estimate(name)
+            if estimate is None:
+                estimate = default
+            i = finish.index(min(finish))
+            finish[i] += estimate
+        return max(finish), len(estimates) - len(known)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
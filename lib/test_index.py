@@ -0,0 +1,146 @@
+import ast
+import imp
+import json
+import os
+import sys
+
+# Bases every test class ends in.
+TEST_CASE_BASES = ["unittest.TestCase", "TestCase", "object"]
+
+#
+# TestIndex lists the test methods of a TestCase class from the source of
+# its module, without importing it, and caches what it read in a json
+# file keyed by module file and modification time. bases are followed
+# into the modules they are imported from. when a class or one of its
+# bases can not be found that way, test_names() returns None and the
+# caller has to import the module.
+#
+class TestIndex(object):
+
+    def __init__(self, path, search_path=None):
+        self.path = path
+        self.search_path = search_path or sys.path
+        self.modules = {}
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                self.modules = json.load(open(path))
+            except ValueError:
+                pass
+
+    # name is "module.Class", returns its test method names sorted the way
+    # unittest.TestLoader sorts them, or None
+    def test_names(self, name):
+        module_name, _, class_name = name.rpartition(".")
+        if not module_name:
+            return None
+        filename = self._find(module_name, self.search_path)
+        if filename is None:
+            return None
+        methods = set()
+        if not self._collect(filename, class_name, methods, set()):
+            return None
+        return sorted([str(method) for method in methods])
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        tmp_file = open(tmp_path, "w")
+        json.dump(self.modules, tmp_file)
+        tmp_file.close()
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def _collect(self, filename, class_name, methods, seen):
+        if (filename, class_name) in seen:
+            return True
+        seen.add((filename, class_name))
+        module = self._module(filename)
+        cls = module["classes"].get(class_name)
+        if cls is None:
+            return False
+        methods.update(cls["methods"])
+        for base in cls["bases"]:
+            if base in TEST_CASE_BASES:
+                continue
+            base_filename, base_name = filename, base
+            head = base.split(".")[0]
+            if head in module["imports"]:
+                # "import perf" and perf.PerfBase, or "from perf import PerfBase"
+                target = module["imports"][head] + base[len(head):]
+                target_module, _, base_name = target.rpartition(".")
+                # python 2 looks next to the importing module first
+                base_filename = self._find(target_module,
+                                           [os.path.dirname(filename)] + self.search_path)
+                if base_filename is None:
+                    return False
+            if not self._collect(base_filename, base_name, methods, seen):
+                return False
+        return True
+
+    def _find(self, module_name, path):
+        filename = None
+        for part in module_name.split("."):
+            if filename is not None:
+                # a module inside a module
+                return None
+            try:
+                file, pathname, description = imp.find_module(part, path)
+            except ImportError:
+                return None
+            if file:
+                file.close()
+            if description[2] == imp.PKG_DIRECTORY:
+                path = [pathname]
+            elif description[2] == imp.PY_SOURCE:
+                filename = pathname
+            else:
+                return None
+        if filename is None:
+            return None
+        return os.path.abspath(filename)
+
+    # the classes of a module, with their bases and test methods, and the
+    # names its top level imports bind
+    def _module(self, filename):
+        mtime = os.path.getmtime(filename)
+        cached = self.modules.get(filename)
+        if cached and cached["mtime"] == mtime:
+            return cached
+        classes = {}
+        imports = {}
+        try:
+            tree = ast.parse(open(filename).read(), filename)
+        except SyntaxError:
+            tree = None
+        if tree is not None:
+            for node in tree.body:
+                if isinstance(node, ast.ClassDef):
+                    classes[node.name] = {
+                        "bases": [_dotted_name(base) for base in node.bases],
+                        "methods": [item.name for item in node.body
+                                    if isinstance(item, ast.FunctionDef) and item.name.startswith("test")]}
+                elif isinstance(node, ast.Import):
+                    for alias in node.names:
+                        if alias.asname:
+                            imports[alias.asname] = alias.name
+                        else:
+                            head = alias.name.split(".")[0]
+                            imports[head] = head
+                elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                    for alias in node.names:
+                        imports[alias.asname or alias.name] = node.module + "." + alias.name
+        module = {"mtime": mtime, "classes": classes, "imports": imports}
+        self.modules[filename] = module
+        self.dirty = True
+        return module
+
+
+def _dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return _dotted_name(node.value) + "." + node.attr
+    # something computed, which can not be resolved from the source
+    return "?"
@@ -240,18 +240,25 @@ def activate_vbucket(server, vbucket):
 def set_items(server, vbucket, num_of_items):
     client = mc_bin_client.MemcachedClient(server.host, server.moxi_port)
     client.vbucketId = vbucket
+    items = []
     for i in range(num_of_items):
         key = "key_" + `vbucket` + "_" + `i`
         payload = generate_payload(key + '\0\r\n\0\0\n\r\0', random.randint(100, 1024))
         flag = socket.htonl(ctypes.c_uint32(zlib.adler32(payload)).value)
-        backoff_sec = 0
-        while backoff_sec < 4 :
-            (opaque, cas, data) = client.set(key,0,flag,payload)
-            if cas > 0:
-                break
-            backoff_sec = backoff_sec + 0.1 + (backoff_sec / 20)
-            print "set %s failed and retry in %f sec" % (key, backoff_sec)
-            time.sleep(backoff_sec)
+        items.append((key, 0, flag, payload))
+    backoff_sec = 0
+    while items:
+        status = client.set_multi(items)
+        items = [item for item in items if status[item[0]]]
+        if not items:
+            break
+        if backoff_sec >= 4:
+            # give up on these keys, validate_items() will not count them
+            print "set %d items failed, giving up" % (len(items))
+            break
+        backoff_sec = backoff_sec + 0.1 + (backoff_sec / 20)
+        print "set %d items failed and retry in %f sec" % (len(items), backoff_sec)
+        time.sleep(backoff_sec)
 
     client.close()
 
@@ -260,16 +267,15 @@ def validate_items(server, vbucket, num_of_items):
     client = mc_bin_client.MemcachedClient(server.host,server.moxi_port)
     client.vbucketId = vbucket
     count = 0
-    for cur_op in range(num_of_items):
-        key = "key_" + `vbucket` + "_" + `cur_op`
-        try:
-            flag, keyx, value = client.get(key)
-            assert (flag)
-            hflag = socket.ntohl(flag)
-            if hflag == ctypes.c_uint32(zlib.adler32(value)).value:
-                count = count + 1
-        except (mc_bin_client.MemcachedError):
+    keys = ["key_" + `vbucket` + "_" + `cur_op` for cur_op in range(num_of_items)]
+    for key, (status, flag, cas, value) in client.get_multi(keys).iteritems():
+        if status:
             continue
+        assert (flag)
+        hflag = socket.ntohl(flag)
+        if hflag == ctypes.c_uint32(zlib.adler32(value)).value:
+            count = count + 1
+    client.close()
     return count
 
 
@@ -1,4 +1,6 @@
+import re
 import xml.dom.minidom
+from xml.sax.saxutils import escape, quoteattr
 
 # a junit compatible xml example
 #<?xml version="1.0" encoding="UTF-8"?>
@@ -39,25 +41,35 @@ class XUnitTestCaseError(object):
 
 #
 
+#
+# with a prefix, every suite is streamed to {prefix}-{suite name}.xml as
+# its tests are added, see XUnitSuiteWriter, and write() has nothing left
+# to do. without one, the tests are kept in memory until write().
+#
 class XUnitTestResult(object):
 
-    def __init__(self):
+    def __init__(self, prefix=None):
+        self.prefix = prefix
         self.suites = []
+        self._suites = {}
+        self._writers = {}
 
     def add_test(self, name, time=0, errorType=None, errorMessage=None, status='pass'):
         #classname
         class_name = name[:name.rfind(".")]
-        matched = False
-        for suite in self.suites:
-            if suite.name == class_name:
-                suite.add_test(name,time,errorType,errorMessage,status)
-                matched = True
-                break
-        if not matched:
+        suite = self._suites.get(class_name)
+        if suite is None:
             suite = XUnitTestSuite()
             suite.name = class_name
-            suite.add_test(name, time, errorType, errorMessage, status)
+            if self.prefix:
+                suite.keep_tests = False
+                self._writers[class_name] = XUnitSuiteWriter(
+                    "{0}-{1}.xml".format(self.prefix, class_name), suite)
+            self._suites[class_name] = suite
             self.suites.append(suite)
+        test = suite.add_test(name, time, errorType, errorMessage, status)
+        if self.prefix:
+            self._writers[class_name].add(test)
 
 
     def to_xml(self,suite):
@@ -87,25 +99,25 @@ class XUnitTestResult(object):
         return doc.toprettyxml()
 
     def write(self,prefix):
+        if prefix == self.prefix:
+            return
         for suite in self.suites:
             report_xml_file = open("{0}-{1}.xml".format(prefix, suite.name), 'w')
             report_xml_file.write(self.to_xml(suite))
             report_xml_file.close()
 
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
     def print_summary(self):
         for suite in self.suites:
-            oks = []
-            errors = []
-            for test in suite.tests:
-                if test.error:
-                    errors.append(test.name)
-                else:
-                    oks.append(test.name)
             msg = "summary so far suite {0} , pass {1} , fail {2}"
-            print msg.format(suite.name, len(oks), len(errors))
-            if errors:
+            print msg.format(suite.name, suite.passes, len(suite.failed))
+            if suite.failed:
                 print "failures so far..."
-                for error in errors:
+                for error in suite.failed:
                     print error
 
 
@@ -114,9 +126,15 @@ class XUnitTestSuite(object):
         self.name = ""
         self.time = 0
         self.tests = []
+        self.count = 0
         self.errors = 0
         self.failures = 0
         self.skips = 0
+        self.passes = 0
+        # names of the failed tests
+        self.failed = []
+        # with False, add_test() only counts the tests
+        self.keep_tests = True
 
     # create a new XUnitTestCase and update the errors/failures/skips count
     def add_test(self, name, time=0, errorType=None, errorMessage=None, status='pass'):
@@ -131,14 +149,91 @@ class XUnitTestSuite(object):
             error.type = errorType
             error.message = errorMessage
             test.error = error
-        self.tests.append(test)
+        if self.keep_tests:
+            self.tests.append(test)
         if status == 'fail':
             self.failures += 1
             self.errors += 1
+            self.failed.append(name)
         elif status == 'skip':
             self.skips += 1
+        else:
+            self.passes += 1
         self.time += time
+        self.count += 1
+        return test
 
 
     # generate the junit xml representation from the XUnitTestSuite object
     # todo : create an element for errorMessage and append it to to error node
+
+
+# characters xml 1.0 does not allow, even escaped
+_INVALID_XML_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# room for the testsuite attributes that change as tests are added
+_HEADER_SIZE = 200
+
+
+#
+# XUnitSuiteWriter appends every testcase of a suite to its report file
+# once, as it is added, and keeps the file a complete report after every
+# test: the testsuite start tag is padded to a fixed size and rewritten in
+# place with the new counts, and the closing tag is overwritten by the
+# next testcase. a run that dies still leaves a readable report behind.
+#
+class XUnitSuiteWriter(object):
+
+    def __init__(self, path, suite):
+        self.suite = suite
+        self.file = open(path, 'w')
+        self.file.write('<?xml version="1.0" ?>\n')
+        self.header_offset = self.file.tell()
+        self.header_size = len(self._header()) + _HEADER_SIZE
+        self.end_offset = self.header_offset + self.header_size + 1
+        self._write_header()
+        self.file.write("\n")
+        self._write_footer()
+
+    def add(self, test):
+        self.file.seek(self.end_offset)
+        self.file.write(self._testcase(test))
+        self.end_offset = self.file.tell()
+        self._write_footer()
+        self._write_header()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def _header(self):
+        suite = self.suite
+        return '<testsuite errors="{0}" failures="{1}" name={2} skip="{3}" tests="{4}" time="{5}"'.format(
+            suite.errors, suite.failures, quoteattr(_xml_text(suite.name)), suite.skips,
+            suite.count, suite.time)
+
+    def _write_header(self):
+        header = self._header()
+        self.file.seek(self.header_offset)
+        self.file.write(header + " " * (self.header_size - len(header) - 1) + ">")
+
+    def _write_footer(self):
+        self.file.write("</testsuite>\n")
+        self.file.truncate()
+
+    def _testcase(self, test):
+        testcase = '\t<testcase name={0} time="{1}"'.format(quoteattr(_xml_text(test.name)), test.time)
+        if not test.error:
+            return testcase + '/>\n'
+        error = '\t\t<error type={0}'.format(quoteattr(_xml_text(test.error.type or "")))
+        if test.error.message:
+            error += '>{0}</error>\n'.format(escape(_xml_text(test.error.message)))
+        else:
+            error += '/>\n'
+        return testcase + '>\n' + error + '\t</testcase>\n'
+
+
+def _xml_text(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _INVALID_XML_CHARS.sub(u'?', text).encode('utf-8')
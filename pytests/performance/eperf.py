@@ -17,6 +17,7 @@ from membase.helper.cluster_helper import ClusterOperationHelper
 from membase.helper.rebalance_helper import RebalanceHelper
 from membase.performance.stats import StatsCollector, CallbackStatsCollector
 from remote.remote_util import RemoteMachineShellConnection, RemoteMachineHelper
+from histogram import Histogram
 
 import testconstants
 import perf
@@ -80,6 +81,13 @@ class EPerfMaster(perf.PerfBase):
              if latency.startswith('latency'):
                  merge_keys.append(str(latency))
 
+        # Per-client percentile rows are kept side by side, while the
+        # latency histograms are merged so the overall percentiles
+        # cover every client's samples.
+        histograms = {}
+        for latency, value in final_json.get("histograms", {}).items():
+             histograms[latency] = Histogram.from_json(value)
+
         for i in range(i, len_clients):
              file  = gzip.open("{0}.loop.json.gz".format(i),'rb')
              dict = file.read()
@@ -88,6 +96,19 @@ class EPerfMaster(perf.PerfBase):
              for key, value in dict.items():
                  if key in merge_keys:
                      final_json[key].extend(value)
+             for latency, value in dict.get("histograms", {}).items():
+                 histo = Histogram.from_json(value)
+                 if latency in histograms:
+                     histograms[latency].merge(histo)
+                 else:
+                     histograms[latency] = histo
+
+        final_json["histograms"] = {}
+        final_json["percentiles"] = {}
+        for latency, histo in histograms.items():
+             final_json["histograms"][latency] = histo.to_json()
+             final_json["percentiles"][latency] = \
+                 [val for _, val in histo.percentiles([0.90, 0.95, 0.99])]
 
         file = gzip.open("{0}.json.gz".format('final'), 'wb')
         file.write("{0}".format(json.dumps(final_json)))
@@ -4,13 +4,21 @@ import re
 import os
 import sys
 import math
+import mmap
 import time
 import heapq
+import errno
+import select
 import socket
 import string
+import array
 import struct
 import random
+import tempfile
 import threading
+import multiprocessing
+import Queue
+import collections
 
 sys.path.append("lib")
 sys.path.append(".")
@@ -34,6 +42,8 @@ import crc32
 import mc_bin_client
 import memcacheConstants
 
+from histogram import Histogram
+
 from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE
 from memcacheConstants import ERR_NOT_MY_VBUCKET, ERR_ENOMEM, ERR_EBUSY, ERR_ETMPFAIL
 from memcacheConstants import REQ_PKT_FMT, RES_PKT_FMT, MIN_RECV_PACKET
@@ -42,6 +52,11 @@ from memcacheConstants import CMD_ADD, CMD_REPLACE, CMD_PREPEND, CMD_APPEND # "A
 
 LARGE_PRIME = 9576890767
 
+# Precompiled request header layouts, without and with the SET-style
+# (flags, expiration) extras, for packing requests in place.
+REQ_HDR = struct.Struct(REQ_PKT_FMT)
+REQ_HDR_SET = struct.Struct(REQ_PKT_FMT + SET_PKT_FMT[1:])
+
 # --------------------------------------------------------
 
 INT_TYPE = type(123)
@@ -57,6 +72,9 @@ def dict_to_s_inner(d, level, res, suffix, ljust):
    scalars = []
    complex = []
 
+   d = dict([(k, isinstance(v, Histogram) and v.to_dict() or v)
+             for k, v in d.items()])
+
    for key in d.keys():
       if type(d[key]) == dtype:
          complex.append(key)
@@ -103,34 +121,93 @@ def dict_to_s_inner(d, level, res, suffix, ljust):
 
    return res
 
-# The histo dict is returned by add_timing_sample().
-# The percentiles must be sorted, ascending, like [0.90, 0.99].
-def histo_percentile(histo, percentiles):
-   v_sum = 0
-   bins = histo.keys()
-   bins.sort()
-   for bin in bins:
-      v_sum += histo[bin]
-   v_sum = float(v_sum)
-   v_cur = 0 # Running total.
-   rv = []
-   for bin in bins:
-      if not percentiles:
-         return rv
-      v_cur += histo[bin]
-      while percentiles and (v_cur / v_sum) >= percentiles[0]:
-         rv.append((percentiles[0], bin))
-         percentiles.pop(0)
-   return rv
-
 # --------------------------------------------------------
 
 MIN_VALUE_SIZE = [10]
 
+def parse_rate_schedule(s):
+   """Parses a rate-schedule like "30:0-1,300:1,10:4,60:1" into
+      (secs, start, end) segments of max-ops-per-sec multipliers.
+      "0-1" ramps linearly across its segment, "4" holds steady.
+      A last multiplier of 0 stops the load at the end of the schedule."""
+   rv = []
+   for segment in filter(None, string.split(s or "", ",")):
+      secs, mult = string.split(segment, ":")
+      start, end = (string.split(mult, "-") + [mult])[:2]
+      secs, start, end = float(secs), float(start), float(end)
+      if secs <= 0:
+         raise ValueError("rate-schedule segment %s must last more than 0 secs"
+                          % segment)
+      rv.append((secs, start, end))
+   return rv
+
+class RatePacer:
+   """Token bucket handing out evenly spaced, open-loop arrival times
+      at rate ops/sec, scaled over time by a rate schedule.
+
+      The state is [t_start, ops handed out]; it starts on the first
+      wait().  When state is a multiprocessing.Array, every thread and
+      worker process using the pacer draws from the same bucket."""
+
+   def __init__(self, rate, schedule=None, state=None, lock=None):
+      self.rate = float(rate)
+      self.schedule = schedule or []
+      self.state = state or [0.0, 0.0]
+      self.lock = lock or threading.Lock()
+
+   def arrival(self, n):
+      """Returns how many seconds after the start op n is due, by
+         inverting the ops-so-far curve of the schedule, or None when
+         the schedule ends at 0 ops/sec before op n."""
+      t = 0.0
+      for secs, start, end in self.schedule:
+         a = self.rate * start                   # Rate is a + b * t
+         b = self.rate * (end - start) / secs    # across this segment.
+         ops = a * secs + b * secs * secs / 2.0
+         if n < ops:
+            if not b:
+               return t + n / a
+            return t + (math.sqrt(a * a + 2.0 * b * n) - a) / b
+         n -= ops
+         t += secs
+      if self.schedule:
+         if not self.schedule[-1][2]:
+            return None
+         return t + n / (self.rate * self.schedule[-1][2])
+      return t + n / self.rate
+
+   def reserve(self):
+      """Returns the intended start time of the next op, or None when
+         there is none."""
+      with self.lock:
+         if not self.state[0]:
+            self.state[0] = time.time()
+         n = self.state[1]
+         self.state[1] = n + 1
+         arrival = self.arrival(n)
+         if arrival is None:
+            return None
+         return self.state[0] + arrival
+
+   def wait(self):
+      t_next = self.reserve()
+      if t_next is None:
+         return None
+      d = t_next - time.time()
+      if d > 0:
+         time.sleep(d)
+      return t_next
+
+def global_pacer(cfg):
+   if cfg.get('max-ops-per-sec-global', 0) > 0:
+      state = multiprocessing.Array('d', [0.0, 0.0])
+      return RatePacer(cfg['max-ops-per-sec-global'],
+                       parse_rate_schedule(cfg.get('rate-schedule', '')),
+                       state, state.get_lock())
+
 def run_worker(ctl, cfg, cur, store, prefix):
     i = 0
     t_last_flush = time.time()
-    o_last_flush = store.num_ops(cur)
     t_last = time.time()
     o_last = store.num_ops(cur)
     xfer_sent_last = 0
@@ -138,10 +215,18 @@ def run_worker(ctl, cfg, cur, store, prefix):
 
     report = cfg.get('report', 0)
     hot_shift = cfg.get('hot-shift', 0)
-    max_ops_per_sec = cfg.get('max-ops-per-sec', 0)
 
-    if cfg.get('max-ops-per-sec', 0) > 0 and not 'batch' in cur:
-       cur['batch'] = 10
+    pacers = []
+    if cfg.get('max-ops-per-sec', 0) > 0:
+       pacers.append(RatePacer(cfg['max-ops-per-sec'],
+                               parse_rate_schedule(cfg.get('rate-schedule', ''))))
+    if cfg.get('pacer'):
+       pacers.append(cfg['pacer'])
+
+    if pacers and not 'batch' in cur:
+       # Open-loop load: send requests as they arrive instead of
+       # holding them back to fill a large batch.
+       cur['batch'] = 1
 
     while ctl.get('run_ok', True):
         num_ops = cur.get('cur-gets', 0) + cur.get('cur-sets', 0)
@@ -153,6 +238,12 @@ def run_worker(ctl, cfg, cur, store, prefix):
            cfg.get('max-creates', 0) <= cur.get('cur-creates', 0):
            break
 
+        if pacers:
+           intended = [pacer.wait() for pacer in pacers]
+           if None in intended:
+              break # The rate schedule ended at 0 ops/sec.
+           store.intended = max(intended)
+
         flushed = store.command(next_cmd(cfg, cur, store))
         i += 1
 
@@ -188,22 +279,13 @@ def run_worker(ctl, cfg, cur, store, prefix):
 
         if flushed:
            t_curr_flush = time.time()
-           o_curr_flush = store.num_ops(cur)
 
            d = t_curr_flush - t_last_flush
 
            if hot_shift > 0:
               cur['cur-base'] = cur.get('cur-base', 0) + (hot_shift * d)
 
-           if max_ops_per_sec > 0:
-              ops = o_curr_flush - o_last_flush
-              ops_per_sec = float(ops) / d
-              if ops_per_sec > max_ops_per_sec:
-                 s = (float(ops) / float(max_ops_per_sec)) - d
-                 time.sleep(s)
-
            t_last_flush = t_curr_flush
-           o_last_flush = o_curr_flush
 
     store.flush()
 
@@ -249,19 +331,15 @@ def next_cmd(cfg, cur, store):
                   cmd = 'arpa'
                   cur['cur-arpas'] = cur.get('cur-arpas', 0) + 1
 
-            key_num = choose_key_num(cur.get('cur-items', 0),
-                                     cfg.get('ratio-hot', 0),
-                                     cfg.get('ratio-hot-sets', 0),
-                                     cur.get('cur-sets', 0),
-                                     cur.get('cur-base', 0),
-                                     cfg.get('random', 0),
-                                     cur)
+            key_num = choose_created_key_num(cfg, cur,
+                                             cfg.get('ratio-hot-sets', 0),
+                                             cur.get('cur-sets', 0))
 
         expiration = 0
         if cmd[0] == 's' and cfg.get('ratio-expirations', 0.0) * 100 > cur_sets % 100:
            expiration = cfg.get('expiration', 0)
 
-        key_str = prepare_key(key_num, cfg.get('prefix', ''))
+        key_str = cfg_key(cfg, key_num)
         if itm_gen:
            itm_val = store.gen_doc(key_num, key_str,
                                    choose_entry(cfg.get('min-value-size', MIN_VALUE_SIZE),
@@ -274,14 +352,10 @@ def next_cmd(cfg, cur, store):
 
         do_get_hit = (cfg.get('ratio-misses', 0) * 100) <= (cur.get('cur-gets', 0) % 100)
         if do_get_hit:
-            key_num = choose_key_num(cur.get('cur-items', 0),
-                                     cfg.get('ratio-hot', 0),
-                                     cfg.get('ratio-hot-gets', 0),
-                                     cur.get('cur-gets', 0),
-                                     cur.get('cur-base', 0),
-                                     cfg.get('random', 0),
-                                     cur)
-            key_str = prepare_key(key_num, cfg.get('prefix', ''))
+            key_num = choose_created_key_num(cfg, cur,
+                                             cfg.get('ratio-hot-gets', 0),
+                                             cur.get('cur-gets', 0))
+            key_str = cfg_key(cfg, key_num)
 
             return (cmd, key_num, key_str, itm_val, 0)
         else:
@@ -307,17 +381,42 @@ def choose_key_num(num_items, ratio_hot, ratio_hot_choice,
 
     return int(base + (x % positive(range)))
 
+def choose_created_key_num(cfg, cur, ratio_hot_choice, num_ops):
+    """Picks a key to read or update among the created ones.  A worker
+       process skips the 'skip-keys' (start, count) range of keys that
+       other workers create, as they may not exist yet."""
+    num_items = cur.get('cur-items', 0)
+    skip = cfg.get('skip-keys')
+    if skip:
+       num_items -= skip[1]
+    key_num = choose_key_num(num_items,
+                             cfg.get('ratio-hot', 0),
+                             ratio_hot_choice,
+                             num_ops,
+                             cur.get('cur-base', 0),
+                             cfg.get('random', 0),
+                             cur)
+    if skip and key_num >= skip[0]:
+       key_num += skip[1]
+    return key_num
+
 def positive(x):
     if x > 0:
         return x
     return 1
 
 def prepare_key(key_num, prefix=None):
-    key_hash = md5(str(key_num)).hexdigest()[0:16]
+    key_hash = md5(str(key_num)).hexdigest()[0:KEY_HASH_LEN]
     if prefix and len(prefix) > 0:
         return prefix + "-" + key_hash
     return key_hash
 
+def cfg_key(cfg, key_num):
+    table = cfg.get('table')
+    if table is not None and key_num in table:
+        return table.key(key_num)
+    return prepare_key(key_num, cfg.get('prefix', ''))
+
 def choose_entry(arr, n):
     return arr[n % len(arr)]
 
@@ -336,13 +435,17 @@ class Store:
        log.info("first 5 keys...")
        for i in range(5):
           print("echo get %s | nc %s %s" %
-                (self.cmd_line_get(i, prepare_key(i, self.cfg.get('prefix', ''))),
+                (self.cmd_line_get(i, cfg_key(self.cfg, i)),
                  self.target.split(':')[0],
                  self.target.split(':')[1]))
 
     def stats_collector(self, sc):
         self.sc = sc
 
+    # Intended (paced) start time of the next command, or None.
+    intended = None
+    queue_intended = None
+
     def command(self, c):
         cmd, key_num, key_str, data, expiration = c
         if cmd[0] == 'g':
@@ -374,18 +477,13 @@ class Store:
 
         return gen_doc_string(key_num, key_str, min_value_size,
                               self.cfg['suffix'][min_value_size],
-                              json, cache=cache)
+                              json, cache=cache, table=self.cfg.get('table'))
 
     def cmd_line_get(self, key_num, key_str):
         return key_str
 
-    def readbytes(self, skt, nbytes, buf):
-        while len(buf) < nbytes:
-           data = skt.recv(max(nbytes - len(buf), 4096))
-           if not data:
-              return None, ''
-           buf += data
-        return buf[:nbytes], buf[nbytes:]
+    def recv_buffer(self, skt):
+        return RecvBuffer(skt, self.cfg.get('recv-buffer-size', RECV_BUFFER_SIZE))
 
     def add_timing_sample(self, cmd, delta, prefix="latency-"):
        base = prefix + cmd
@@ -393,17 +491,9 @@ class Store:
           key = base + suffix
           histo = self.cur.get(key, None)
           if histo is None:
-             histo = {}
+             histo = Histogram(self.cfg.get("histo-precision", 2))
              self.cur[key] = histo
-          bucket = round(self.histo_bucket(delta), 6)
-          histo[bucket] = histo.get(bucket, 0) + 1
-
-    def histo_bucket(self, samp):
-       hp = self.cfg.get("histo-precision", 2)
-       if samp > 0:
-          p = 10 ** (math.floor(math.log10(samp)) - (hp - 1))
-          r = round(samp / p)
-          return r * p
+          histo.record(delta)
 
     def drange(self, start, stop, step):
         r = start
@@ -426,7 +516,7 @@ class StoreMemcachedBinary(Store):
         self.cmds = 0
         self.ops = 0
         self.previous_ops = 0
-        self.buf = ''
+        self.free_bufs = []
         self.arpa = [ (CMD_ADD,     True),
                       (CMD_REPLACE, True),
                       (CMD_APPEND,  False),
@@ -438,6 +528,10 @@ class StoreMemcachedBinary(Store):
         self.conn = mc_bin_client.MemcachedClient(host, port)
         if user:
            self.conn.sasl_auth_plain(user, pswd)
+        # The socket is read directly from here on, and a slow server must
+        # stall the load rather than fail it with socket.timeout.
+        self.conn.s.settimeout(None)
+        self.rbuf = self.recv_buffer(self.conn.s)
 
     def inflight_reinit(self, inflight=0):
         self.inflight = inflight
@@ -450,26 +544,36 @@ class StoreMemcachedBinary(Store):
         self.inflight_grp = None
 
     def inflight_start(self):
-        return []
+        return self.batch_buffer()
 
-    def inflight_complete(self, inflight_arr):
-        return ''.join(inflight_arr)
+    def inflight_complete(self, inflight_buf):
+        return inflight_buf
 
-    def inflight_send(self, inflight_msg):
-        self.conn.s.send(inflight_msg)
-        return len(inflight_msg)
+    def inflight_send(self, inflight_buf):
+        sent = len(inflight_buf)
+        self.conn.s.sendall(inflight_buf.view())
+        self.release_buffer(inflight_buf)
+        return sent
+
+    def batch_buffer(self):
+        if self.free_bufs:
+           return self.free_bufs.pop()
+        return BatchBuffer()
+
+    def release_buffer(self, b):
+        b.reset()
+        self.free_bufs.append(b)
 
     def inflight_recv(self, inflight, inflight_arr, expectBuffer=None):
-        received = 0
-        for i in range(inflight):
-           cmd, keylen, extralen, errcode, datalen, opaque, val, buf = self.recvMsg()
-           received += datalen + MIN_RECV_PACKET
+        received, errcodes = recv_msgs(self.rbuf, inflight)
         return received
 
     def inflight_append_buffer(self, grp, vbucketId, opcode, opaque):
         return grp
 
     def command(self, c):
+        if not self.queue:
+           self.queue_intended = self.intended
         self.queue.append(c)
         if len(self.queue) > self.flush_level():
             self.flush()
@@ -480,16 +584,18 @@ class StoreMemcachedBinary(Store):
         return self.cur.get('batch') or \
                self.cfg.get('batch', 100)
 
-    def header(self, op, key, val, opaque=0, extra='', cas=0,
-               dtype=0, vbucketId=0,
-               fmt=REQ_PKT_FMT,
-               magic=REQ_MAGIC_BYTE):
+    def vbucket_id(self, key_num, key_str):
         vbuckets = self.cfg.get("vbuckets", 0)
-        if vbuckets > 0:
-           vbucketId = crc32.crc32_hash(key) & (vbuckets - 1)
-        return struct.pack(fmt, magic, op,
-                           len(key), len(extra), dtype, vbucketId,
-                           len(key) + len(extra) + len(val), opaque, cas), vbucketId
+        if vbuckets <= 0:
+           return 0
+        ids = self.cfg.get('vbucket-ids')
+        if ids is not None and 0 <= key_num < len(ids):
+           vbucketId = ids[key_num]
+           if vbucketId < 0:
+              vbucketId = crc32.vbucket_id(key_str, vbuckets)
+              ids[key_num] = vbucketId
+           return vbucketId
+        return crc32.vbucket_id(key_str, vbuckets)
 
     def flush(self):
         next_inflight = 0
@@ -518,6 +624,7 @@ class StoreMemcachedBinary(Store):
         latency_cmd = None
         latency_start = 0
         latency_end = 0
+        latency_intended = self.queue_intended
 
         delta_gets = 0
         delta_sets = 0
@@ -569,6 +676,11 @@ class StoreMemcachedBinary(Store):
 
         if latency_cmd:
             self.add_timing_sample(latency_cmd, latency_end - latency_start)
+            if latency_intended:
+                # Coordinated-omission corrected: measured from when the
+                # pacer meant the request to start, not when it got sent.
+                self.add_timing_sample(latency_cmd, latency_end - latency_intended,
+                                       prefix="latency-co-")
 
         if self.sc:
             if self.ops - self.previous_ops > 10000:
@@ -582,58 +694,41 @@ class StoreMemcachedBinary(Store):
               if histo:
                  self.sc.latency_stats(key, histo)
                  if key.endswith('-recent'):
-                    self.cur[key] = {}
+                    histo.reset()
         self.sc.sample(self.cur)
 
     def cmd_append(self, cmd, key_num, key_str, data, expiration, grp):
        self.cmds += 1
+       vbucketId = self.vbucket_id(key_num, key_str)
        if cmd[0] == 'g':
-          hdr, vbucketId = self.header(CMD_GET, key_str, '', opaque=self.cmds)
-          m = self.inflight_append_buffer(grp, vbucketId, CMD_GET, self.cmds)
-          m.append(hdr)
-          m.append(key_str)
+          b = self.inflight_append_buffer(grp, vbucketId, CMD_GET, self.cmds)
+          pack_request(b, CMD_GET, vbucketId, self.cmds, key_str)
           return 1, 0, 0, 0
        elif cmd[0] == 'd':
-          hdr, vbucketId = self.header(CMD_DELETE, key_str, '', opaque=self.cmds)
-          m = self.inflight_append_buffer(grp, vbucketId, CMD_DELETE, self.cmds)
-          m.append(hdr)
-          m.append(key_str)
+          b = self.inflight_append_buffer(grp, vbucketId, CMD_DELETE, self.cmds)
+          pack_request(b, CMD_DELETE, vbucketId, self.cmds, key_str)
           return 0, 0, 1, 0
 
        rv = (0, 1, 0, 0)
        curr_cmd = CMD_SET
-       curr_extra = struct.pack(SET_PKT_FMT, 0, expiration)
+       have_extra = True
 
        if cmd[0] == 'a':
           rv = (0, 0, 0, 1)
           curr_cmd, have_extra = self.arpa[self.cur.get('cur-sets', 0) % len(self.arpa)]
-          if not have_extra:
-             curr_extra = ''
-
-       hdr, vbucketId = self.header(curr_cmd, key_str, data,
-                                    extra=curr_extra, opaque=self.cmds)
-       m = self.inflight_append_buffer(grp, vbucketId, curr_cmd, self.cmds)
-       m.append(hdr)
-       if curr_extra:
-          m.append(curr_extra)
-       m.append(key_str)
-       m.append(data)
+
+       if not have_extra:
+          expiration = None
+
+       b = self.inflight_append_buffer(grp, vbucketId, curr_cmd, self.cmds)
+       pack_request(b, curr_cmd, vbucketId, self.cmds, key_str, data, expiration)
        return rv
 
     def num_ops(self, cur):
         return self.ops
 
     def recvMsg(self):
-        sock = self.conn.s
-        buf = self.buf
-        pkt, buf = self.readbytes(sock, MIN_RECV_PACKET, buf)
-        magic, cmd, keylen, extralen, dtype, errcode, datalen, opaque, cas = \
-            struct.unpack(RES_PKT_FMT, pkt)
-        if magic != RES_MAGIC_BYTE:
-           raise Exception("Unexpected recvMsg magic: " + str(magic))
-        val, buf = self.readbytes(sock, datalen, buf)
-        self.buf = buf
-        return cmd, keylen, extralen, errcode, datalen, opaque, val, buf
+        return recv_msg(self.rbuf)
 
 
 class StoreMembaseBinary(StoreMemcachedBinary):
@@ -655,27 +750,23 @@ class StoreMembaseBinary(StoreMemcachedBinary):
         return f * len(self.awareness.memcacheds)
 
     def inflight_start(self):
-        return { 's_bufs': {}, # Key is server str, value is [] of buffer.
+        return { 's_bufs': {}, # Key is server str, value is a BatchBuffer.
                  's_cmds': {}  # Key is server str, value is int (number of cmds).
                }
 
     def inflight_complete(self, inflight_grp):
-        rv = [] # Array of tuples (server, buffer).
-        s_bufs = inflight_grp['s_bufs']
-        for server in s_bufs.keys():
-           buffers = s_bufs[server]
-           rv.append((server, ''.join(buffers)))
-        return rv
+        return inflight_grp['s_bufs'].items() # Array of tuples (server, buffer).
 
     def inflight_send(self, inflight_msg):
         sent = 0
         for server, buf in inflight_msg:
            try:
               conn = self.awareness.memcacheds[server]
-              conn.s.send(buf)
+              conn.s.sendall(buf.view())
               sent += len(buf)
            except:
               pass
+           self.release_buffer(buf)
         return sent
 
     def inflight_recv(self, inflight, inflight_grp, expectBuffer=None):
@@ -687,29 +778,26 @@ class StoreMembaseBinary(StoreMemcachedBinary):
         for server in s_cmds.keys():
            try:
               conn = self.awareness.memcacheds[server]
-              try:
-                 recvBuf = conn.recvBuf
-              except:
-                 recvBuf = ''
-              if expectBuffer == False and recvBuf != '':
+              rbuf = getattr(conn, 'soda_rbuf', None)
+              if rbuf is None or rbuf.skt is not conn.s:
+                 rbuf = self.recv_buffer(conn.s)
+                 conn.soda_rbuf = rbuf
+              if expectBuffer == False and len(rbuf) != 0:
                  raise Exception("Was expecting empty buffer, but have (" + \
-                                    str(len(recvBuf)) + "): " + recvBuf)
-              cmds = s_cmds[server]
-              for i in range(cmds):
-                 try:
-                    rcmd, keylen, extralen, errcode, datalen, ropaque, val, recvBuf = \
-                        self.recvMsgSockBuf(conn.s, recvBuf)
-                    received += datalen + MIN_RECV_PACKET
+                                    str(len(rbuf)) + ")")
+              try:
+                 r, errcodes = recv_msgs(rbuf, s_cmds[server])
+                 received += r
+                 for errcode in errcodes:
                     if errcode == ERR_NOT_MY_VBUCKET:
                        reset_my_awareness = True
                     elif errcode == ERR_ENOMEM or \
                          errcode == ERR_EBUSY or \
                          errcode == ERR_ETMPFAIL:
                        backoff = True
-                 except:
-                    reset_my_awareness = True
-                    backoff = True
-              conn.recvBuf = recvBuf
+              except:
+                 reset_my_awareness = True
+                 backoff = True
            except:
               reset_my_awareness = True
               backoff = True
@@ -731,28 +819,226 @@ class StoreMembaseBinary(StoreMemcachedBinary):
 
         return received
 
-    def recvMsgSockBuf(self, sock, buf):
-        pkt, buf = self.readbytes(sock, MIN_RECV_PACKET, buf)
-        magic, cmd, keylen, extralen, dtype, errcode, datalen, opaque, cas = \
-            struct.unpack(RES_PKT_FMT, pkt)
-        if magic != RES_MAGIC_BYTE:
-           raise Exception("Unexpected recvMsg magic: " + str(magic))
-        val, buf = self.readbytes(sock, datalen, buf)
-        return cmd, keylen, extralen, errcode, datalen, opaque, val, buf
-
     def inflight_append_buffer(self, grp, vbucketId, opcode, opaque):
        s_bufs = grp['s_bufs']
        s_cmds = grp['s_cmds']
        s = self.awareness.vBucketMap[vbucketId]
        m = s_bufs.get(s, None)
        if m is None:
-          m = []
+          m = self.batch_buffer()
           s_bufs[s] = m
           s_cmds[s] = 0
        s_cmds[s] += 1
        return m
 
 
+class EventPoller:
+   """Level-triggered readiness polling of many sockets, using epoll
+      where available and select() elsewhere."""
+
+   def __init__(self):
+      self.epoll = None
+      if hasattr(select, 'epoll'):
+         self.epoll = select.epoll()
+      self.fds = {} # fd -> whether we wait for it to become writable.
+
+   def register(self, fd, want_write=False):
+      self.fds[fd] = want_write
+      if self.epoll:
+         self.epoll.register(fd, self.mask(want_write))
+
+   def modify(self, fd, want_write):
+      if self.fds[fd] != want_write:
+         self.fds[fd] = want_write
+         if self.epoll:
+            self.epoll.modify(fd, self.mask(want_write))
+
+   def mask(self, want_write):
+      if want_write:
+         return select.EPOLLIN | select.EPOLLOUT
+      return select.EPOLLIN
+
+   def poll(self, timeout):
+      """Returns (fd, readable, writable) tuples of the ready sockets,
+         waiting up to timeout secs, or for ever when timeout is None."""
+      if self.epoll:
+         if timeout is None:
+            timeout = -1
+         return [(fd, bool(ev & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)),
+                  bool(ev & select.EPOLLOUT))
+                 for fd, ev in self.epoll.poll(timeout)]
+      r, w, _ = select.select(self.fds.keys(),
+                              [fd for fd, ww in self.fds.items() if ww],
+                              [], timeout)
+      w = set(w)
+      return [(fd, True, fd in w) for fd in r] + \
+             [(fd, False, True) for fd in w.difference(r)]
+
+
+class EventConn:
+   """One non-blocking connection of a StoreMemcachedBinaryEvents."""
+
+   def __init__(self, mc, rbuf):
+      self.mc = mc # Keeps the socket open.
+      self.skt = mc.s
+      self.fd = mc.s.fileno()
+      self.rbuf = rbuf
+      self.out = BatchBuffer()
+      self.out_sent = 0
+      # Requests in the order their responses will arrive, as
+      # (opaque, cmd, deltas, t_start, t_intended).
+      self.pending = collections.deque()
+
+
+class StoreMemcachedBinaryEvents(StoreMemcachedBinary):
+   """Drives cfg['connections'] non-blocking connections from a single
+      thread with an event loop, instead of one blocking connection.
+      Each connection keeps up to cfg['window'] requests in flight, and
+      every request is timed from when it was queued."""
+
+   def connect_host_port(self, host, port, user, pswd):
+      self.poller = EventPoller()
+      self.conns = {}
+      for i in range(max(1, self.cfg.get('connections', 1))):
+         mc = mc_bin_client.MemcachedClient(host, port)
+         if user:
+            mc.sasl_auth_plain(user, pswd)
+         mc.s.setblocking(0)
+         conn = EventConn(mc, self.recv_buffer(mc.s))
+         self.conns[conn.fd] = conn
+         self.poller.register(conn.fd)
+      self.conn_list = self.conns.values()
+      self.conn_next = 0
+      self.conn = self.conn_list[0]
+      self.dirty = {}   # Connections with unsent requests, by fd.
+      self.unsent = 0
+      self.pending = 0
+      self.batch_reinit()
+
+   def batch_reinit(self):
+      self.batch_ops = 0
+      self.batch_gets = 0
+      self.batch_sets = 0
+      self.batch_deletes = 0
+      self.batch_arpas = 0
+      self.batch_start_time = time.time()
+
+   def window(self):
+      return self.cfg.get('window', 0) or self.flush_level()
+
+   def next_conn(self):
+      window = self.window()
+      while True:
+         for i in xrange(len(self.conn_list)):
+            conn = self.conn_list[self.conn_next]
+            self.conn_next = (self.conn_next + 1) % len(self.conn_list)
+            if len(conn.pending) < window:
+               return conn
+         self.pump(None)
+
+   def command(self, c):
+      conn = self.next_conn()
+      cmd, key_num, key_str, data, expiration = c
+      deltas = self.cmd_append(cmd, key_num, key_str, data, expiration,
+                               conn.out)
+      conn.pending.append((self.cmds, cmd, deltas, time.time(), self.intended))
+      self.dirty[conn.fd] = conn
+      self.pending += 1
+      self.unsent += 1
+      if self.unsent > self.flush_level():
+         return self.pump(0) > 0
+      return False
+
+   def flush(self):
+      while self.pending > 0:
+         self.pump(None)
+
+   def pump(self, timeout):
+      """Sends the queued requests and handles the responses that have
+         arrived, waiting up to timeout secs (None: until at least one
+         completes).  Returns the # of completed requests."""
+      for conn in self.dirty.values():
+         self.send(conn)
+      self.unsent = 0
+      done = 0
+      while True:
+         for fd, readable, writable in self.poller.poll(timeout):
+            conn = self.conns[fd]
+            if writable:
+               self.send(conn)
+            if readable:
+               done += self.recv(conn)
+         if done or timeout is not None or self.pending <= 0:
+            return done
+
+   def send(self, conn):
+      if conn.out_sent < len(conn.out):
+         try:
+            sent = conn.skt.send(conn.out.view()[conn.out_sent:])
+         except socket.error, e:
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+               raise
+            sent = 0
+         conn.out_sent += sent
+         self.xfer_sent += sent
+      if conn.out_sent >= len(conn.out):
+         conn.out.reset()
+         conn.out_sent = 0
+         self.dirty.pop(conn.fd, None)
+         self.poller.modify(conn.fd, False)
+      else:
+         self.poller.modify(conn.fd, True)
+
+   def recv(self, conn):
+      try:
+         received = conn.rbuf.recv_some()
+      except socket.error, e:
+         if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+            raise
+         return 0
+      if received <= 0:
+         raise Exception("Connection closed during recvMsg")
+      self.xfer_recv += received
+
+      done = 0
+      t_end = time.time()
+      while conn.pending:
+         msg = parse_msg(conn.rbuf)
+         if msg is None:
+            break
+         opaque, cmd, deltas, t_start, t_intended = conn.pending.popleft()
+         if msg[-1] != opaque:
+            raise Exception("Unexpected recvMsg opaque: %s, expected: %s" %
+                            (msg[-1], opaque))
+         self.add_timing_sample(cmd, t_end - t_start)
+         if t_intended:
+            self.add_timing_sample(cmd, t_end - t_intended,
+                                   prefix="latency-co-")
+         self.batch_gets += deltas[0]
+         self.batch_sets += deltas[1]
+         self.batch_deletes += deltas[2]
+         self.batch_arpas += deltas[3]
+         done += 1
+
+      self.pending -= done
+      self.ops += done
+      self.batch_ops += done
+
+      if self.sc:
+         if self.batch_ops >= self.flush_level():
+            self.sc.ops_stats({ 'tot-gets':    self.batch_gets,
+                                'tot-sets':    self.batch_sets,
+                                'tot-deletes': self.batch_deletes,
+                                'tot-arpas':   self.batch_arpas,
+                                'start-time':  self.batch_start_time,
+                                'end-time':    t_end })
+            self.batch_reinit()
+         if self.ops - self.previous_ops > 10000:
+            self.previous_ops = self.ops
+            self.save_stats()
+      return done
+
+
 class StoreMemcachedAscii(Store):
 
     def connect(self, target, user, pswd, cfg, cur):
@@ -764,10 +1050,10 @@ class StoreMemcachedAscii(Store):
         self.skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.skt.connect(tuple(self.host_port))
+        self.rbuf = self.recv_buffer(self.skt)
         self.queue = []
         self.ops = 0
         self.previous_ops = 0
-        self.buf = ''
         self.arpa = [ 'add', 'replace', 'append', 'prepend' ]
         self.xfer_sent = 0
         self.xfer_recv = 0
@@ -793,22 +1079,23 @@ class StoreMemcachedAscii(Store):
                                             len(data), data)
 
     def command_recv(self, cmd, key_num, key_str, data, expiration):
-        buf = self.buf
+        rbuf = self.rbuf
         if cmd[0] == 'g':
             # GET...
-            line, buf = self.readline(self.skt, buf)
+            line = rbuf.readline()
             while line and line != 'END':
                 # line == "VALUE k flags len"
                 rvalue, rkey, rflags, rlen = line.split()
-                data, buf = self.readbytes(self.skt, int(rlen) + 2, buf)
-                line, buf = self.readline(self.skt, buf)
+                if not rbuf.fill(int(rlen) + 2):
+                    break
+                rbuf.skip(int(rlen) + 2)
+                line = rbuf.readline()
         elif cmd[0] == 'd':
             # DELETE...
-            line, buf = self.readline(self.skt, buf) # line == "DELETED"
+            line = rbuf.readline() # line == "DELETED"
         else:
             # SET...
-            line, buf = self.readline(self.skt, buf) # line == "STORED"
-        self.buf = buf
+            line = rbuf.readline() # line == "STORED"
 
     def flush(self):
         m = []
@@ -828,16 +1115,173 @@ class StoreMemcachedAscii(Store):
     def num_ops(self, cur):
         return self.ops
 
-    def readline(self, skt, buf):
-        while True:
-            index = buf.find('\r\n')
-            if index >= 0:
-                break
-            data = skt.recv(4096)
-            if not data:
-                return '', ''
-            buf += data
-        return buf[:index], buf[index+2:]
+# --------------------------------------------------------
+
+BATCH_BUFFER_SIZE = 64 * 1024
+
+class BatchBuffer:
+   """A reusable, growable bytearray that a whole pipeline of requests
+      is packed into with pack_request(), then sent in one go."""
+
+   def __init__(self, size=BATCH_BUFFER_SIZE):
+      self.buf = bytearray(size)
+      self.n = 0
+
+   def __len__(self):
+      return self.n
+
+   def reserve(self, nbytes):
+      """Returns the offset of nbytes of space appended to the buffer."""
+      off = self.n
+      if off + nbytes > len(self.buf):
+         self.buf.extend(bytearray(max(nbytes, len(self.buf))))
+      self.n = off + nbytes
+      return off
+
+   def reset(self):
+      self.n = 0
+
+   def view(self):
+      return memoryview(self.buf)[0:self.n]
+
+def pack_request(b, opcode, vbucketId, opaque, key, val='', expiration=None):
+   """Packs a binary protocol request into BatchBuffer b.  When an
+      expiration is given, SET-style (flags, expiration) extras are
+      packed after the header."""
+   keylen = len(key)
+   vallen = len(val)
+   if expiration is None:
+      hdr = REQ_HDR
+      off = b.reserve(hdr.size + keylen + vallen)
+      hdr.pack_into(b.buf, off, REQ_MAGIC_BYTE, opcode, keylen, 0, 0,
+                    vbucketId, keylen + vallen, opaque, 0)
+   else:
+      hdr = REQ_HDR_SET
+      extlen = hdr.size - MIN_RECV_PACKET
+      off = b.reserve(hdr.size + keylen + vallen)
+      hdr.pack_into(b.buf, off, REQ_MAGIC_BYTE, opcode, keylen, extlen, 0,
+                    vbucketId, extlen + keylen + vallen, opaque, 0,
+                    0, expiration)
+   off += hdr.size
+   b.buf[off:off + keylen] = key
+   if vallen:
+      off += keylen
+      b.buf[off:off + vallen] = val
+
+# --------------------------------------------------------
+
+RECV_BUFFER_SIZE = 256 * 1024
+
+class RecvBuffer:
+   """A reusable receive buffer for one socket.  Data is read with
+      recv_into() straight into a bytearray and consumed by moving the
+      start offset, so responses can be parsed in place with
+      struct.unpack_from() without building or slicing strings."""
+
+   def __init__(self, skt, size=RECV_BUFFER_SIZE):
+      self.skt = skt
+      self.buf = bytearray(size)
+      self.view = memoryview(self.buf)
+      self.start = 0 # Offset of the first unconsumed byte.
+      self.end = 0   # Offset just past the last received byte.
+
+   def __len__(self):
+      return self.end - self.start
+
+   def fill(self, nbytes):
+      """Receives until at least nbytes are buffered past start.
+         Returns False if the connection was closed first."""
+      while self.end - self.start < nbytes:
+         if self.start + nbytes > len(self.buf):
+            self.compact(nbytes)
+         n = self.skt.recv_into(self.view[self.end:], len(self.buf) - self.end)
+         if n <= 0:
+            return False
+         self.end += n
+      return True
+
+   def compact(self, nbytes):
+      """Moves the unconsumed bytes to the front of the buffer,
+         growing the buffer if it cannot hold nbytes."""
+      avail = self.end - self.start
+      if nbytes > len(self.buf):
+         buf = bytearray(max(nbytes, 2 * len(self.buf)))
+         buf[0:avail] = self.view[self.start:self.end]
+         self.buf = buf
+         self.view = memoryview(buf)
+      elif avail > 0:
+         self.buf[0:avail] = self.view[self.start:self.end].tobytes()
+      self.start = 0
+      self.end = avail
+
+   def recv_some(self):
+      """Does one recv_into() of whatever has arrived, for sockets
+         driven by an event loop.  Returns the # of bytes received."""
+      if self.end == len(self.buf):
+         self.compact(self.start and 1 or len(self.buf) + 1)
+      n = self.skt.recv_into(self.view[self.end:], len(self.buf) - self.end)
+      self.end += n
+      return n
+
+   def skip(self, nbytes):
+      self.start += nbytes
+      if self.start == self.end:
+         self.start = 0
+         self.end = 0
+
+   def readline(self):
+      """Returns the next line without its '\\r\\n', or '' on close."""
+      while True:
+         index = self.buf.find('\r\n', self.start, self.end)
+         if index >= 0:
+            line = str(self.buf[self.start:index])
+            self.skip(index + 2 - self.start)
+            return line
+         if not self.fill(self.end - self.start + 1):
+            return ''
+
+def recv_msg(rbuf):
+   """Consumes one binary protocol response from rbuf, skipping over
+      its body, and returns its header fields."""
+   if not rbuf.fill(MIN_RECV_PACKET):
+      raise Exception("Connection closed during recvMsg")
+   magic, cmd, keylen, extralen, dtype, errcode, datalen, opaque, cas = \
+       struct.unpack_from(RES_PKT_FMT, rbuf.buf, rbuf.start)
+   if magic != RES_MAGIC_BYTE:
+      raise Exception("Unexpected recvMsg magic: " + str(magic))
+   if not rbuf.fill(MIN_RECV_PACKET + datalen):
+      raise Exception("Connection closed during recvMsg")
+   rbuf.skip(MIN_RECV_PACKET + datalen)
+   return cmd, keylen, extralen, errcode, datalen, opaque
+
+def parse_msg(rbuf):
+   """Like recv_msg(), but only consumes a response that is already
+      complete in rbuf, returning None instead of receiving more."""
+   avail = rbuf.end - rbuf.start
+   if avail < MIN_RECV_PACKET:
+      return None
+   magic, cmd, keylen, extralen, dtype, errcode, datalen, opaque, cas = \
+       struct.unpack_from(RES_PKT_FMT, rbuf.buf, rbuf.start)
+   if magic != RES_MAGIC_BYTE:
+      raise Exception("Unexpected recvMsg magic: " + str(magic))
+   if avail < MIN_RECV_PACKET + datalen:
+      if rbuf.start + MIN_RECV_PACKET + datalen > len(rbuf.buf):
+         rbuf.compact(MIN_RECV_PACKET + datalen)
+      return None
+   rbuf.skip(MIN_RECV_PACKET + datalen)
+   return cmd, keylen, extralen, errcode, datalen, opaque
+
+def recv_msgs(rbuf, count):
+   """Consumes count binary protocol responses from rbuf.  Returns the
+      number of bytes received and a list of the non-zero errcodes."""
+   received = 0
+   errcodes = []
+   for i in xrange(count):
+      cmd, keylen, extralen, errcode, datalen, opaque = recv_msg(rbuf)
+      received += datalen + MIN_RECV_PACKET
+      if errcode:
+         errcodes.append(errcode)
+   return received, errcodes
 
 # --------------------------------------------------------
 
@@ -874,7 +1318,8 @@ def key_to_achievements(key_num, key_str):
 doc_cache = {}
 
 def gen_doc_string(key_num, key_str, min_value_size, suffix, json,
-                   cache=None, key_name="key", suffix_ex="", whitespace=True):
+                   cache=None, key_name="key", suffix_ex="", whitespace=True,
+                   table=None):
     global doc_cache
 
     c = "{"
@@ -882,11 +1327,21 @@ def gen_doc_string(key_num, key_str, min_value_size, suffix, json,
         c = "*"
 
     d = None
-    if cache:
+    if table is not None and key_num in table and \
+       key_name == "key" and whitespace:
+       d = table.doc_body(key_num)
+    elif cache:
        d = doc_cache.get(key_num, None)
 
     if d is None:
-       d = """"%s":"%s",
+       d = gen_doc_body(key_num, key_str, key_name, whitespace)
+       if cache:
+          doc_cache[key_num] = d
+
+    return "%s%s%s%s" % (c, d, suffix_ex, suffix)
+
+def gen_doc_body(key_num, key_str, key_name="key", whitespace=True):
+    d = """"%s":"%s",
  "key_num":%s,
  "name":"%s",
  "email":"%s",
@@ -903,12 +1358,118 @@ def gen_doc_string(key_num, key_str, min_value_size, suffix, json,
                           key_to_realm(key_num, key_str),
                           key_to_coins(key_num, key_str),
                           key_to_achievements(key_num, key_str))
-       if not whitespace:
-          d = d.replace("\n ", "")
-       if cache:
-          doc_cache[key_num] = d
+    if not whitespace:
+       d = d.replace("\n ", "")
+    return d
 
-    return "%s%s%s%s" % (c, d, suffix_ex, suffix)
+# --------------------------------------------------------
+
+# A compact, precomputed table of the keys and doc bodies for key_nums
+# in [0, num_items), so that next_cmd() and gen_doc() do no per-op md5
+# hashing or doc formatting.  Keys are fixed width in one contiguous
+# region and doc bodies are found through an offsets region, so both
+# lookups are O(1).  The table lives in an mmap of either a named file,
+# which is reused by later runs with the same prefix, or of an
+# anonymous temp file; either way forked worker processes share it.
+#
+# File layout: header | keys (KEY_HASH_LEN * n) | offsets (n + 1) | bodies
+
+KEY_HASH_LEN = 16
+KEY_TABLE_MAGIC = "mcsoda-key-table-1"
+KEY_TABLE_HDR_FMT = "!32sQ32s" # magic, num_items, md5 of prefix.
+KEY_TABLE_OFF_FMT = "LL"       # Native, to match array('L').
+
+class KeyTable:
+
+   def __init__(self, num_items, prefix="", path=None):
+      self.prefix = prefix or ""
+      self.key_prefix = ""
+      if self.prefix:
+         self.key_prefix = self.prefix + "-"
+
+      f = None
+      if path and os.path.exists(path):
+         f = open(path, 'rb')
+         n = self.read_header(f, num_items)
+         if n is None:
+            f.close()
+            f = None
+            log.info("key-table: regenerating " + path)
+         else:
+            num_items = n
+      if f is None:
+         if path:
+            f = open(path, 'w+b')
+         else:
+            f = tempfile.TemporaryFile()
+         self.generate(f, num_items)
+
+      self.num_items = num_items
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      f.close()
+
+      self.offs_size = array.array('L').itemsize
+      self.keys_start = struct.calcsize(KEY_TABLE_HDR_FMT)
+      self.offs_start = self.keys_start + KEY_HASH_LEN * num_items
+      self.body_start = self.offs_start + self.offs_size * (num_items + 1)
+
+   def __len__(self):
+      return self.num_items
+
+   def __contains__(self, key_num):
+      return 0 <= key_num < self.num_items
+
+   def key(self, key_num):
+      i = self.keys_start + KEY_HASH_LEN * key_num
+      return self.key_prefix + self.mm[i:i + KEY_HASH_LEN]
+
+   def doc_body(self, key_num):
+      start, end = struct.unpack_from(KEY_TABLE_OFF_FMT, self.mm,
+                                      self.offs_start + self.offs_size * key_num)
+      return self.mm[self.body_start + start:self.body_start + end]
+
+   def read_header(self, f, num_items):
+      """Returns the number of items in an existing table file, or None
+         if the file is not a usable table for num_items and our prefix."""
+      hdr = f.read(struct.calcsize(KEY_TABLE_HDR_FMT))
+      if len(hdr) != struct.calcsize(KEY_TABLE_HDR_FMT):
+         return None
+      magic, n, prefix_hash = struct.unpack(KEY_TABLE_HDR_FMT, hdr)
+      if magic.rstrip('\0') != KEY_TABLE_MAGIC or \
+         prefix_hash != md5(self.prefix).hexdigest() or \
+         n < num_items:
+         return None
+      return n
+
+   def generate(self, f, num_items):
+      log.info("key-table: generating %s items..." % (num_items))
+      gen_start = time.time()
+
+      keys = bytearray(KEY_HASH_LEN * num_items)
+      offs = array.array('L')
+
+      f.seek(struct.calcsize(KEY_TABLE_HDR_FMT) +
+             KEY_HASH_LEN * num_items + offs.itemsize * (num_items + 1))
+      pos = 0
+      for key_num in xrange(num_items):
+         key_hash = md5(str(key_num)).hexdigest()[0:KEY_HASH_LEN]
+         i = KEY_HASH_LEN * key_num
+         keys[i:i + KEY_HASH_LEN] = key_hash
+         offs.append(pos)
+         d = gen_doc_body(key_num, self.key_prefix + key_hash)
+         f.write(d)
+         pos += len(d)
+      offs.append(pos)
+
+      f.seek(0)
+      f.write(struct.pack(KEY_TABLE_HDR_FMT, KEY_TABLE_MAGIC, num_items,
+                          md5(self.prefix).hexdigest()))
+      f.write(keys)
+      offs.tofile(f)
+      f.flush()
+
+      log.info("key-table: generating...done (elapsed: %s)" %
+               (time.time() - gen_start))
 
 # --------------------------------------------------------
 
@@ -918,6 +1479,9 @@ PROTOCOL_STORE = { 'memcached-ascii': StoreMemcachedAscii,
                    'none-binary': Store,
                    'none': Store }
 
+# Stores used instead when cfg['connections'] > 0.
+EVENT_STORE = { 'memcached-binary': StoreMemcachedBinaryEvents }
+
 def run(cfg, cur, protocol, host_port, user, pswd,
         stats_collector = None, stores = None, ctl = None):
    if type(cfg['min-value-size']) == type(""):
@@ -937,8 +1501,30 @@ def run(cfg, cur, protocol, host_port, user, pswd,
                              md5(str(len(cfg['body'][mvs]))).hexdigest()
        cfg['suffix'][mvs] = "\"body\":\"" + cfg['body'][mvs] + "\"}"
 
+   # The runtime objects below go into a copy, as callers hand their cfg
+   # on to the stats collector, which exports it.
+   cfg = cfg.copy()
+
+   if (cfg.get('key-table', 0) > 0 or cfg.get('key-table-file', '')) and \
+      cfg.get('table') is None:
+      cfg['table'] = KeyTable(max(0, cfg.get('max-items', 0)),
+                              cfg.get('prefix', ''),
+                              cfg.get('key-table-file', '') or None)
+
+   if cfg.get('table') is not None and cfg.get('vbuckets', 0) > 0 and \
+      cfg.get('vbucket-ids') is None:
+      cfg['vbucket-ids'] = array.array('i', [-1]) * max(0, cfg.get('max-items', 0))
+
+   if not isinstance(ctl, ProcessCtl):
+      # Worker processes share the pacer their parent made.
+      cfg['pacer'] = global_pacer(cfg)
+
    ctl = ctl or { 'run_ok': True }
 
+   if cfg.get('workers', 0) > 1 and not stores:
+      return run_processes(cfg, cur, protocol, host_port, user, pswd,
+                           stats_collector=stats_collector, ctl=ctl)
+
    threads = []
 
    for i in range(cfg.get('threads', 1)):
@@ -947,7 +1533,10 @@ def run(cfg, cur, protocol, host_port, user, pswd,
           store = stores[i]
 
       if store is None:
-         store = PROTOCOL_STORE[protocol]()
+         if cfg.get('connections', 0) > 0 and protocol in EVENT_STORE:
+            store = EVENT_STORE[protocol]()
+         else:
+            store = PROTOCOL_STORE[protocol]()
 
       log.info("store: %s - %s" % (i, store.__class__))
 
@@ -960,7 +1549,8 @@ def run(cfg, cur, protocol, host_port, user, pswd,
 
    store.show_some_keys()
 
-   if cfg.get("doc-cache", 0) > 0 and cfg.get("doc-gen", 0) > 0:
+   if cfg.get("doc-cache", 0) > 0 and cfg.get("doc-gen", 0) > 0 and \
+      cfg.get('table') is None:
       min_value_size = cfg['min-value-size'][0]
       json = cfg.get('json', 1) > 0
       cache = cfg.get('doc-cache', 0)
@@ -1015,6 +1605,229 @@ def run(cfg, cur, protocol, host_port, user, pswd,
 
 # --------------------------------------------------------
 
+# Multi-process mode, when cfg['workers'] > 1.  Each worker process
+# runs the normal, threaded run() with its own Store(s) against a
+# disjoint slice of the remaining creates and ops, so a single client
+# box is no longer limited to one core by the GIL.  Stats calls are
+# forwarded to the parent over a queue and the final worker cur dicts
+# are merged back into the caller's cur.
+
+# Counters where workers each advance the same shared quantity, so
+# the merged delta is the max instead of the sum.
+MERGE_MAX_KEYS = [ 'cur-base' ]
+
+class ProcessCtl:
+   """The ctl dict as seen by a worker process, where run_ok is
+      shared with the parent and all the other workers."""
+
+   def __init__(self, run_ok):
+      self.run_ok = run_ok
+
+   def get(self, key, default=None):
+      if key == 'run_ok':
+         return self.run_ok.value != 0
+      return default
+
+   def __setitem__(self, key, value):
+      if key == 'run_ok':
+         self.run_ok.value = int(bool(value))
+
+
+class StatsCollectorProxy:
+   """Forwards a worker's stats collector calls to the parent."""
+
+   def __init__(self, worker, queue):
+      self.worker = worker
+      self.queue = queue
+
+   def ops_stats(self, ops_stat):
+      self.queue.put(('ops_stats', self.worker, ops_stat.copy()))
+
+   def latency_stats(self, latency_cmd, latency_stat):
+      self.queue.put(('latency_stats', self.worker,
+                      (latency_cmd, latency_stat.copy(), self.worker)))
+
+   def sample(self, cur):
+      self.queue.put(('sample', self.worker, cur_counters(cur)))
+
+
+def cur_counters(cur):
+   """Returns a copy of cur without the latency histograms."""
+   return dict([(k, v) for k, v in cur.items()
+                if type(v) != DICT_TYPE and not isinstance(v, Histogram)])
+
+def worker_slices(cfg, cur, workers):
+   """Returns a (cfg, cur) pair per worker, splitting the remaining
+      creates into disjoint key ranges and the remaining ops evenly.
+      Reads and updates stay within the existing items and the keys the
+      worker created itself, like in a single process run."""
+   items = cur.get('cur-items', 0)
+   creates = cur.get('cur-creates', 0)
+   ops = cur.get('cur-gets', 0) + cur.get('cur-sets', 0)
+
+   todo_creates = max(0, cfg.get('max-creates', 0) - creates)
+   if cfg.get('max-items', 0) > 0:
+      todo_creates = min(todo_creates, max(0, cfg['max-items'] - items))
+   todo_ops = max(0, cfg.get('max-ops', 0) - ops)
+
+   rv = []
+   for i in range(workers):
+      lo = i * todo_creates / workers
+      hi = (i + 1) * todo_creates / workers
+
+      w_cfg = cfg.copy()
+      w_cfg['workers'] = 0
+      w_cfg['max-creates'] = creates + (hi - lo)
+      if cfg.get('max-items', 0) > 0:
+         w_cfg['max-items'] = items + hi
+      if cfg.get('max-ops', 0) > 0:
+         w_cfg['max-ops'] = ops + \
+             (i + 1) * todo_ops / workers - i * todo_ops / workers
+
+      w_cur = cur_counters(cur)
+      w_cur['cur-items'] = items + lo
+      w_cur['pos'] = i * items / workers
+      if lo:
+         # Keys items .. items + lo - 1 belong to the workers before.
+         w_cfg['skip-keys'] = (items, lo)
+
+      rv.append((w_cfg, w_cur))
+   return rv
+
+def merge_cur(cur, w_cur_start, w_cur_end):
+   """Adds a worker's counter deltas and histograms into cur."""
+   for key, val in w_cur_end.items():
+      if isinstance(val, Histogram):
+         histo = cur.get(key, None)
+         if histo is None:
+            cur[key] = val.copy()
+         else:
+            histo.merge(val)
+      elif key.startswith('cur-') and type(val) in [INT_TYPE, FLOAT_TYPE]:
+         delta = val - w_cur_start.get(key, 0)
+         if key in MERGE_MAX_KEYS:
+            cur[key] = max(cur.get(key, 0), w_cur_start.get(key, 0) + delta)
+         else:
+            cur[key] = cur.get(key, 0) + delta
+   return cur
+
+def run_process(worker, cfg, cur, protocol, host_port, user, pswd,
+                stats, run_ok, queue):
+   sc = None
+   if stats:
+      sc = StatsCollectorProxy(worker, queue)
+   try:
+      cur, t_start, t_end = run(cfg, cur, protocol, host_port, user, pswd,
+                                stats_collector=sc, ctl=ProcessCtl(run_ok))
+      queue.put(('done', worker, (cur, t_start, t_end)))
+   except KeyboardInterrupt:
+      queue.put(('error', worker, 'interrupted'))
+   except Exception, e:
+      queue.put(('error', worker, str(e)))
+
+def run_processes(cfg, cur, protocol, host_port, user, pswd,
+                  stats_collector=None, ctl=None):
+   workers = cfg['workers']
+   run_ok = multiprocessing.Value('b', 1)
+   queue = multiprocessing.Queue()
+
+   slices = worker_slices(cfg, cur, workers)
+   procs = []
+   for i in range(workers):
+      w_cfg, w_cur = slices[i]
+      log.info("worker: %s - items: %s, max-creates: %s, max-ops: %s" %
+               (i, w_cur['cur-items'], w_cfg.get('max-creates', 0),
+                w_cfg.get('max-ops', 0)))
+      p = multiprocessing.Process(target=run_process,
+                                  args=(i, w_cfg, w_cur.copy(),
+                                        protocol, host_port, user, pswd,
+                                        stats_collector is not None,
+                                        run_ok, queue))
+      p.daemon = True
+      procs.append(p)
+
+   t_start = time.time()
+   for p in procs:
+      p.start()
+
+   results = {}
+   errors = {}
+   samples = {}
+
+   try:
+      while len(results) + len(errors) < workers:
+         if not ctl.get('run_ok', True):
+            run_ok.value = 0
+         try:
+            kind, i, args = queue.get(True, 1)
+         except Queue.Empty:
+            if not [p for p in procs if p.is_alive()]:
+               log.error("workers exited without reporting results")
+               break
+            continue
+
+         if kind == 'done':
+            results[i] = args
+            if stats_collector:
+               # The worker's last periodic histograms are stale by
+               # up to a stats interval, so hand over the final ones.
+               for key, val in args[0].items():
+                  if isinstance(val, Histogram) and \
+                     key.startswith('latency-') and \
+                     not key.endswith('-recent'):
+                     stats_collector.latency_stats(key, val, i)
+         elif kind == 'error':
+            log.error("worker: %s - error: %s" % (i, args))
+            errors[i] = args
+         elif stats_collector:
+            if kind == 'ops_stats':
+               stats_collector.ops_stats(args)
+            elif kind == 'latency_stats':
+               stats_collector.latency_stats(*args)
+            elif kind == 'sample':
+               samples[i] = args
+               merged = cur_counters(cur)
+               for j in samples.keys():
+                  merge_cur(merged, slices[j][1], samples[j])
+               stats_collector.sample(merged)
+   except KeyboardInterrupt:
+      ctl['run_ok'] = False
+      run_ok.value = 0
+
+   for p in procs:
+      p.join(1)
+
+   t_end = time.time()
+
+   t_starts = []
+   t_ends = []
+   for i in sorted(results.keys()):
+      w_cur_end, w_t_start, w_t_end = results[i]
+      merge_cur(cur, slices[i][1], w_cur_end)
+      t_starts.append(w_t_start)
+      t_ends.append(w_t_end)
+
+   for i in range(workers):
+      if i not in results and i not in errors:
+         errors[i] = "exited without reporting results"
+   if errors:
+      # A partial load is not a result; stop whoever shares ctl too.
+      ctl['run_ok'] = False
+      failed = ", ".join(["%s (%s)" % (i, errors[i]) for i in sorted(errors.keys())])
+      raise Exception("mcsoda workers failed: %s" % failed)
+
+   t_start = min(t_starts or [t_start])
+   t_end = max(t_ends or [t_end])
+
+   log.info("")
+   log.info(dict_to_s(cur))
+   log.info("    ops/sec: %s" %
+            ((cur.get('cur-gets', 0) + cur.get('cur-sets', 0)) / (t_end - t_start)))
+
+   return cur, t_start, t_end
+
+# --------------------------------------------------------
+
 def main(argv, cfg_defaults=None, cur_defaults=None, protocol=None, stores=None):
   cfg_defaults = cfg_defaults or {
      "prefix":             ("",    "Prefix for every item key."),
@@ -1034,16 +1847,24 @@ def main(argv, cfg_defaults=None, cur_defaults=None, protocol=None, stores=None)
      "expiration":         (0,     "Expiration time parameter for SET's"),
      "exit-after-creates": (0,     "Exit after max-creates is reached."),
      "threads":            (1,     "Number of client worker threads to use."),
+     "workers":            (0,     "When >1, # of worker processes, each with threads."),
      "batch":              (100,   "Batch/pipeline up this # of commands per server."),
+     "connections":        (0,     "When >0, # of connections per thread, driven by an event loop."),
+     "window":             (0,     "Max in-flight requests per event loop connection; default batch."),
      "json":               (1,     "Use JSON documents. 0 to generate binary documents."),
      "time":               (0,     "Stop after this many seconds if > 0."),
-     "max-ops-per-sec":    (0,     "When >0, max ops/second target performance."),
+     "max-ops-per-sec":    (0,     "When >0, max ops/second target performance per thread."),
+     "max-ops-per-sec-global": (0, "When >0, max ops/second across all threads and workers."),
+     "rate-schedule":      ("",    "Max ops/sec multipliers over time, like 30:0-1,300:1,10:4."),
      "report":             (40000, "Emit performance output after this many requests."),
      "histo-precision":    (1,     "Precision of histogram bins."),
      "vbuckets":           (0,     "When >0, vbucket hash in memcached-binary protocol."),
      "doc-cache":          (1,     "When 1, cache docs; faster, but uses O(N) memory."),
      "doc-gen":            (1,     "When 1 and doc-cache, pre-generate docs at start."),
+     "key-table":          (0,     "When 1, precompute keys and docs into a compact table."),
+     "key-table-file":     ("",    "Path of a key-table file to mmap; generated if missing."),
      "backoff-factor":     (2.0,   "Exponential backoff factor on ETMPFAIL errors."),
+     "recv-buffer-size":   (262144, "Initial receive buffer size (bytes) per connection."),
      "hot-shift":          (0,     "# of keys/sec that hot item subset should shift."),
      "random":             (0,     "When 1, use random keys for gets and updates.")
      }
@@ -12,6 +12,7 @@ from membase.api.rest_client import RestConnection, RestHelper
 from membase.helper.bucket_helper import BucketOperationHelper
 from membase.helper.cluster_helper import ClusterOperationHelper
 from membase.helper.rebalance_helper import RebalanceHelper
+from membase.helper.stats_watcher import ClusterStatsWatcher, StatsSubscription
 from membase.performance.stats import StatsCollector
 from remote.remote_util import RemoteMachineShellConnection
 import testconstants
@@ -305,7 +306,10 @@ class PerfBase(unittest.TestCase):
                 'doc-cache': doc_cache,
                 'prefix': prefix,
                 'report': report,
-                'hot-shift': hot_shift
+                'hot-shift': hot_shift,
+                'workers': self.parami("workers", 0),
+                'key-table': self.parami("key_table", 0),
+                'key-table-file': self.param("key_table_file", "")
                 }
         cur = {}
         if start_at >= 0:
@@ -441,7 +445,13 @@ class PerfBase(unittest.TestCase):
                 'vbuckets': self.vbucket_count,
                 'doc-cache': doc_cache,
                 'prefix': prefix,
-                'report': report
+                'report': report,
+                'workers': self.parami("workers", 0),
+                'key-table': self.parami("key_table", 0),
+                'key-table-file': self.param("key_table_file", ""),
+                'max-ops-per-sec': self.parami("max_ops_per_sec", 0),
+                'max-ops-per-sec-global': self.parami("max_ops_per_sec_global", 0),
+                'rate-schedule': self.param("rate_schedule", "")
                 }
         cfg_params = cfg.copy()
         cfg_params['test_time'] = time.time()
@@ -508,10 +518,17 @@ class PerfBase(unittest.TestCase):
         master = self.input.servers[0]
         bucket = self.param("bucket", "default")
 
-        RebalanceHelper.wait_for_stats_on_all(master, bucket, 'ep_queue_size', 0, \
-                                              fn=RebalanceHelper.wait_for_stats_no_timeout)
-        RebalanceHelper.wait_for_stats_on_all(master, bucket, 'ep_flusher_todo', 0, \
-                                              fn=RebalanceHelper.wait_for_stats_no_timeout)
+        # one subscription for both stats, so the drain is seen on the
+        # first sample where the queue and the flusher are both empty
+        def drained(samples):
+            return [stats is not None and stats.get('ep_queue_size') == 0 and
+                    stats.get('ep_flusher_todo') == 0
+                    for stats in samples.values()]
+
+        subscription = StatsSubscription("rest", drained,
+                                         lambda value: bool(value) and all(value),
+                                         name="ep_queue_size and ep_flusher_todo")
+        ClusterStatsWatcher.get(master, bucket).wait(subscription)
 
         return time.time()
 
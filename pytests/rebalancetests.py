@@ -9,7 +9,7 @@ from membase.api.rest_client import RestConnection, RestHelper
 from membase.helper.bucket_helper import BucketOperationHelper
 from membase.helper.cluster_helper import ClusterOperationHelper as ClusterHelper, ClusterOperationHelper
 from membase.helper.rebalance_helper import RebalanceHelper
-from memcached.helper.data_helper import MemcachedClientHelper, MutationThread, VBucketAwareMemcached
+from memcached.helper.data_helper import MemcachedClientHelper, MutationThread, VBucketAwareMemcached, KeySpace
 from threading import Thread
 
 
@@ -146,7 +146,7 @@ class RebalanceBaseTest(unittest.TestCase):
         for bucket in buckets:
             bucket_data[bucket.name] = {}
             bucket_data[bucket.name]['items_inserted_count'] = 0
-            bucket_data[bucket.name]['inserted_keys'] = []
+            bucket_data[bucket.name]['inserted_keys'] = KeySpace()
         return bucket_data
 
 
@@ -656,7 +656,7 @@ class IncrementalRebalanceWithParallelReadTests(unittest.TestCase):
                     self.log.info(ex)
                     if not moxi:
                         smartclient.done()
-                        smartclient = VBucketAwareMemcached(rest, name)
+                        smartclient = VBucketAwareMemcached(rest, name, max_age=0)
 
     def test_10k_moxi(self):
         RebalanceBaseTest.common_setup(self._input, self, replica=1)
@@ -4,10 +4,13 @@ import time
 import unittest
 from threading import Thread
 from membase.api.rest_client import RestConnection
+from membase.api.exception import MembaseHttpException
 from viewtests import ViewBaseTests
 from memcached.helper.data_helper import VBucketAwareMemcached, DocumentGenerator
 import json
 import sys
+import socket
+import httplib
 
 class ViewQueryTests(unittest.TestCase):
 
@@ -265,24 +268,42 @@ class View:
                 while attempt < 20 and num_keys != expected_num_docs:
 
                     self.log.info("Quering view {0} with params: {1}".format(view_name, params));
-                    results = ViewBaseTests._get_view_results(tc, rest,
-                        "default", view_name, limit=None, extra_params=params)
-
-                    # check if this is a reduced query using _count
-                    if self.reduce_fn is '_count':
-                        num_keys = self._verify_count_reduce_helper(query, results)
-                        self.log.info("{0}: attempt {1} reduced {2} group(s) to value {3} expected: {4}" \
-                            .format(view_name, attempt, query.expected_num_groups,
-                                    num_keys, expected_num_docs));
-                    else:
-                        num_keys = len(ViewBaseTests._get_keys(self, results))
-                        self.log.info("{0}: attempt {1} retrieved value {2} expected: {3}" \
-                            .format(view_name, attempt, num_keys, expected_num_docs));
+                    rows = ViewBaseTests._get_view_rows(tc, rest, "default", view_name,
+                                                        extra_params=params)
+
+                    try:
+                        # check if this is a reduced query using _count
+                        if self.reduce_fn is '_count':
+                            num_keys = self._verify_count_reduce_helper(query, rows)
+                            self.log.info("{0}: attempt {1} reduced {2} group(s) to value {3} expected: {4}" \
+                                .format(view_name, attempt, query.expected_num_groups,
+                                        num_keys, expected_num_docs));
+                        else:
+                            # the rows are counted as they arrive
+                            num_keys = 0
+                            for row in rows:
+                                num_keys += 1
+                            self.log.info("{0}: attempt {1} retrieved value {2} expected: {3}" \
+                                .format(view_name, attempt, num_keys, expected_num_docs));
+                    except (MembaseHttpException, socket.error, httplib.HTTPException) as ex:
+                        self.log.error("{0}: attempt {1} view_results not ready yet, error {2}" \
+                            .format(view_name, attempt, ex))
+
+                    # like _get_view_results, a view error fails the query
+                    if rows.errors:
+                        msg = "unable to get view_results for {0} due to error {1}".format(view_name,
+                                                                                         rows.errors)
+                        self.log.error(msg)
+                        try:
+                            tc.fail(msg)
+                        except Exception:
+                            self.results.addFailure(tc, sys.exc_info())
+                        break
 
                     attempt += 1
 
                     time.sleep(delay)
-                if(num_keys != expected_num_docs):
+                if not rows.errors and num_keys != expected_num_docs:
                     msg = "Query failed: {0} Documents Retrieved,  expected {1}"
                     val = msg.format(num_keys, expected_num_docs)
                     try:
@@ -293,8 +314,9 @@ class View:
             else:
                 # query without verification
                 self.log.info("Quering view {0} with params: {1}".format(view_name, params));
-                results = ViewBaseTests._get_view_results(tc, rest, "default", view_name,
-                                                          limit=None, extra_params=params)
+                for row in ViewBaseTests._get_view_rows(tc, rest, "default", view_name,
+                                                        extra_params=params):
+                    pass
 
     """
         helper function for verifying results when _count reduce is used.
@@ -305,12 +327,14 @@ class View:
 
         TODO: _sum,_stats? :)
     """
-    def _verify_count_reduce_helper(self, query, results):
+    def _verify_count_reduce_helper(self, query, rows):
 
         num_keys = 0
 
-        for i in range(0,query.expected_num_groups):
-            num_keys += results["rows"][i]["value"]
+        # the rows are read to the end, as view errors follow them
+        for i, row in enumerate(rows):
+            if i < query.expected_num_groups:
+                num_keys += row["value"]
 
         return num_keys
 
@@ -479,6 +479,17 @@ class ViewBaseTests(unittest.TestCase):
                 time.sleep(timeout)
         self.fail("unable to get view_results for {0} after 4 tries".format(view))
 
+    #like _get_view_results, but returns an iterator over all the rows,
+    #which pages through the view instead of loading it in one response
+    @staticmethod
+    def _get_view_rows(self, rest, bucket, view, extra_params={}):
+        params = {"connection_timeout": 60000}
+        params.update(extra_params)
+        if view.find("dev_") == 0:
+            params["full_set"] = True
+        self.log.info("Params {0}".format(params))
+        return rest.view_rows(bucket, view, params)
+
     @staticmethod
     def _setup_cluster(self):
         for server in self.servers:
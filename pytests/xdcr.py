@@ -10,7 +10,6 @@ from membase.helper.cluster_helper import ClusterOperationHelper
 from membase.helper.rebalance_helper import RebalanceHelper
 from memcached.helper.data_helper import MemcachedClientHelper
 from remote.remote_util import RemoteMachineShellConnection
-from couchdb import client
 
 
 class XDCRBaseTest(unittest.TestCase):
@@ -114,6 +113,7 @@ class XDCRBaseTest(unittest.TestCase):
 
         # Insert doc at the source_ip
         couchdb_url = "http://{0}:{1}/".format(source_ip, "9500")
+        from couchdb import client
         server = client.Server(couchdb_url)
         doc = {'continuous': True, 'type': 'xdcr'}
         data = server.replicate(source_url, target_url, **doc)
@@ -0,0 +1,21 @@
+import sys
+
+sys.path.append('.')
+sys.path.append('lib')
+from optparse import OptionParser
+from membase.performance.stats_stream import convert
+
+# Rebuilds the exported stats json document from the <name>.ndjson.gz
+# stream StatsCollector leaves behind when a test dies before export().
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] STREAM.ndjson.gz")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="json.gz file to write, defaults to the stream name")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected one stream file")
+
+    src = args[0]
+    dst = options.output or src.replace(".ndjson.gz", "") + ".json.gz"
+    convert(src, dst)
+    print "wrote {0}".format(dst)